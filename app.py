@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, redirect, url_for, send_file, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, send_file, session, jsonify, Response
 import csv
 import os
 import random
@@ -7,6 +7,23 @@ import io
 import base64
 import time
 import uuid
+import json
+import codecs
+import itertools
+import heapq
+import atexit
+import unicodedata
+import sqlite3
+import threading
+import tempfile
+import hashlib
+import multiprocessing
+import zipfile
+from urllib.parse import quote
+from collections import OrderedDict
+from contextlib import contextmanager
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from reportlab.lib.pagesizes import A4
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
@@ -16,6 +33,11 @@ from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.pdfbase import pdfmetrics
 from reportlab.lib import colors
 
+try:
+    import fcntl  # プロセス間ロック（Linux/macOS）
+except ImportError:
+    fcntl = None  # Windowsではプロセス内ロックのみ
+
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production')
 app.permanent_session_lifetime = timedelta(minutes=30)
@@ -23,8 +45,52 @@ app.permanent_session_lifetime = timedelta(minutes=30)
 # データセット保存ディレクトリ
 DATASETS_DIR = 'datasets'
 
-# オンラインテストセッション管理（メモリ内）
-online_test_sessions = {}
+# 拡張フォーマット: 番号,質問,回答,正解数,総試行回数,習熟度スコア,ID
+DATASET_FIELDNAMES = ['番号', '質問', '回答', '正解数', '総試行回数', '習熟度スコア', 'ID']
+
+# CSVエクスポートで一度にエンコードして送信する行数
+EXPORT_CHUNK_ROWS = 500
+
+# 一括インポート（複数CSV・ZIP）の解析ワーカー数と受け付ける上限（ファイル数・展開後の合計バイト数）
+IMPORT_WORKERS = int(os.environ.get('IMPORT_WORKERS', 4))
+IMPORT_MAX_FILES = int(os.environ.get('IMPORT_MAX_FILES', 100))
+IMPORT_MAX_TOTAL_BYTES = int(os.environ.get('IMPORT_MAX_TOTAL_BYTES', 200 * 1024 * 1024))
+
+# データセットキャッシュの上限（件数・CSVファイルサイズ換算のバイト数）
+DATASET_CACHE_MAX_ENTRIES = int(os.environ.get('DATASET_CACHE_MAX_ENTRIES', 32))
+DATASET_CACHE_MAX_BYTES = int(os.environ.get('DATASET_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+# 判定ジャーナルのコンパクション設定（サイズしきい値のバイト数・定期実行の間隔秒）
+JOURNAL_COMPACT_THRESHOLD = int(os.environ.get('JOURNAL_COMPACT_THRESHOLD', 16 * 1024))
+JOURNAL_COMPACT_INTERVAL = int(os.environ.get('JOURNAL_COMPACT_INTERVAL', 30))
+
+# オンラインテストセッションの保存先（'memory' または複数プロセスで共有する 'sqlite'）と有効期限（秒）
+ONLINE_TEST_SESSION_STORE = os.environ.get('ONLINE_TEST_SESSION_STORE', 'memory')
+ONLINE_TEST_SESSION_TTL = int(os.environ.get('ONLINE_TEST_SESSION_TTL', 60 * 60))
+ONLINE_TEST_SESSION_DB_FILENAME = '.online_test_sessions.sqlite3'
+
+# 生成したPDFのキャッシュ（保存先は未指定の場合 DATASETS_DIR/.pdf_cache、0バイト指定で無効）
+PDF_CACHE_DIR = os.environ.get('PDF_CACHE_DIR')
+PDF_CACHE_DIRNAME = '.pdf_cache'
+PDF_CACHE_MAX_BYTES = int(os.environ.get('PDF_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+# PDF作成ジョブ（プロセス数・実行中と待機中を合わせた受付上限・混雑時に再試行を促す秒数・ファイルの保存秒数）
+PDF_JOB_WORKERS = int(os.environ.get('PDF_JOB_WORKERS', 2))
+PDF_JOB_MAX_PENDING = int(os.environ.get('PDF_JOB_MAX_PENDING', 8))
+PDF_JOB_RETRY_AFTER = int(os.environ.get('PDF_JOB_RETRY_AFTER', 5))
+PDF_JOB_TTL = int(os.environ.get('PDF_JOB_TTL', 30 * 60))
+PDF_JOB_DIRNAME = '.pdf_jobs'
+PDF_JOB_PROGRESS_INTERVAL = 0.5  # 進捗を状態ファイルに書き込む最短間隔（秒）
+
+# PDF1ページあたりの問題数（20行×2列）
+PDF_ITEMS_PER_PAGE = 40
+
+# PDFの描画方式（'auto'・'platypus'・'canvas'）と、'auto' で canvas 版に切り替える問題数
+PDF_RENDERER = os.environ.get('PDF_RENDERER', 'auto')
+PDF_CANVAS_THRESHOLD = int(os.environ.get('PDF_CANVAS_THRESHOLD', 400))
+
+# 問題の順番を入れ替えたバージョンを一度に作成できる上限
+PDF_VARIANTS_MAX = int(os.environ.get('PDF_VARIANTS_MAX', 10))
 
 def set_flash_message(message, message_type='info'):
     """セッションにメッセージを設定"""
@@ -90,78 +156,114 @@ def get_message_and_type(request):
     return get_flash_message()
 
 # 日本語フォントの設定
-def setup_fonts():
-    """日本語フォントの設定"""
-    try:
-        # システムにある日本語フォントを探して登録
-        font_paths = [
-            # Linux系 - 新しくインストールしたフォントを優先
-            '/usr/share/fonts/opentype/ipafont-gothic/ipag.ttf',
-            '/usr/share/fonts/truetype/takao-gothic/TakaoGothic.ttf',
-            '/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc',
-            '/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc',
-            '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
-            '/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf',
-            '/usr/share/fonts/truetype/noto/NotoSansJP-Regular.otf',
-            # macOS
-            '/System/Library/Fonts/Hiragino Sans GB.ttc',
-            '/Library/Fonts/Arial Unicode MS.ttf',
-            '/System/Library/Fonts/Helvetica.ttc',
-            # Windows
-            '/Windows/Fonts/msgothic.ttc',
-            '/Windows/Fonts/meiryo.ttc',
-            '/Windows/Fonts/msmincho.ttc'
-        ]
-        
-        for font_path in font_paths:
-            if os.path.exists(font_path):
-                try:
-                    # より安全なフォント登録
-                    if font_path.endswith('.ttc'):
-                        # .ttcファイルの場合、最初のフォントを使用
-                        pdfmetrics.registerFont(TTFont('Japanese', font_path, subfontIndex=0))
-                    else:
-                        pdfmetrics.registerFont(TTFont('Japanese', font_path))
-                    print(f"Font registered successfully: {font_path}")
-                    
-                    # フォントが正しく登録されたかテスト
-                    from reportlab.lib.fonts import addMapping
-                    addMapping('Japanese', 0, 0, 'Japanese')  # normal
-                    addMapping('Japanese', 1, 0, 'Japanese')  # bold
-                    addMapping('Japanese', 0, 1, 'Japanese')  # italic
-                    addMapping('Japanese', 1, 1, 'Japanese')  # bold italic
-                    
-                    return True
-                except Exception as font_error:
-                    print(f"Failed to register font {font_path}: {font_error}")
-                    continue
+# ダウンロードしたフォントの保存先（起動時に最優先で探す）
+FONTS_DIR = os.environ.get('FONTS_DIR', 'fonts')
+NOTO_FONT_FILENAME = 'NotoSansCJK-Regular.ttc'
+NOTO_FONT_URL = "https://github.com/googlefonts/noto-cjk/raw/main/Sans/OTC/NotoSansCJK-Regular.ttc"
+
+# システムにある日本語フォントの候補
+SYSTEM_FONT_PATHS = [
+    # Linux系 - 新しくインストールしたフォントを優先
+    '/usr/share/fonts/opentype/ipafont-gothic/ipag.ttf',
+    '/usr/share/fonts/truetype/takao-gothic/TakaoGothic.ttf',
+    '/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc',
+    '/usr/share/fonts/truetype/noto/NotoSansCJK-Regular.ttc',
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',
+    '/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf',
+    '/usr/share/fonts/truetype/noto/NotoSansJP-Regular.otf',
+    # macOS
+    '/System/Library/Fonts/Hiragino Sans GB.ttc',
+    '/Library/Fonts/Arial Unicode MS.ttf',
+    '/System/Library/Fonts/Helvetica.ttc',
+    # Windows
+    '/Windows/Fonts/msgothic.ttc',
+    '/Windows/Fonts/meiryo.ttc',
+    '/Windows/Fonts/msmincho.ttc'
+]
+
+class FontRegistry:
+    """PDF用の日本語フォントをプロセスごとに1回だけ探して登録する
+
+    登録結果（フォント名・パス・利用可否）を保持し、PDF作成のたびに
+    フォントファイルを解析し直さない。フォントを追加した場合は refresh() で再検出する。
+    """
+
+    FONT_NAME = 'Japanese'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._info = None
+
+    def candidate_paths(self):
+        """フォントの候補（ダウンロード済みのフォント → システムのフォントの順）"""
+        return [os.path.join(FONTS_DIR, NOTO_FONT_FILENAME)] + SYSTEM_FONT_PATHS
+
+    def get(self):
+        """登録済みフォントの情報（未登録の場合はここで検出・登録）"""
+        info = self._info
+        if info is None:
+            with self._lock:
+                if self._info is None:
+                    self._info = self._register()
+                info = self._info
+        return info
+
+    def refresh(self):
+        """フォントを再検出して登録し直す"""
+        with self._lock:
+            self._info = self._register()
+            return self._info
+
+    def _register(self):
+        from reportlab.lib.fonts import addMapping
+        
+        for font_path in self.candidate_paths():
+            if not os.path.exists(font_path):
+                continue
+            try:
+                # .ttcファイルの場合、最初のフォントを使用
+                if font_path.endswith('.ttc'):
+                    pdfmetrics.registerFont(TTFont(self.FONT_NAME, font_path, subfontIndex=0))
+                else:
+                    pdfmetrics.registerFont(TTFont(self.FONT_NAME, font_path))
+                
+                addMapping(self.FONT_NAME, 0, 0, self.FONT_NAME)  # normal
+                addMapping(self.FONT_NAME, 1, 0, self.FONT_NAME)  # bold
+                addMapping(self.FONT_NAME, 0, 1, self.FONT_NAME)  # italic
+                addMapping(self.FONT_NAME, 1, 1, self.FONT_NAME)  # bold italic
+                print(f"Font registered successfully: {font_path}")
+                return {'available': True, 'font_name': self.FONT_NAME, 'path': font_path}
+            except Exception as font_error:
+                print(f"Failed to register font {font_path}: {font_error}")
+                continue
         
         # デフォルトフォントでUnicode対応を試行
         print("No Japanese font found, trying default Unicode support...")
-        return False
-        
-    except Exception as e:
-        print(f"Font setup error: {e}")
-        return False
+        return {'available': False, 'font_name': None, 'path': None}
+
+font_registry = FontRegistry()
+
+def setup_fonts():
+    """日本語フォントの設定（登録済みの場合は再利用）"""
+    return font_registry.get()['available']
 
 def download_noto_font():
-    """Notoフォントをダウンロードして登録"""
+    """Notoフォントを fonts/ にダウンロードして登録"""
     try:
         import urllib.request
-        font_dir = os.path.join(os.getcwd(), 'fonts')
-        if not os.path.exists(font_dir):
-            os.makedirs(font_dir)
+        if not os.path.exists(FONTS_DIR):
+            os.makedirs(FONTS_DIR)
         
-        font_path = os.path.join(font_dir, 'NotoSansCJK-Regular.ttc')
+        font_path = os.path.join(FONTS_DIR, NOTO_FONT_FILENAME)
         
         if not os.path.exists(font_path):
             print("Downloading Noto Sans CJK font...")
-            url = "https://github.com/googlefonts/noto-cjk/raw/main/Sans/OTC/NotoSansCJK-Regular.ttc"
-            urllib.request.urlretrieve(url, font_path)
+            urllib.request.urlretrieve(NOTO_FONT_URL, font_path)
         
-        pdfmetrics.registerFont(TTFont('Japanese', font_path))
-        print(f"Downloaded font registered: {font_path}")
-        return True
+        # ダウンロードしたフォントは候補の先頭のため、再検出で登録される
+        info = font_registry.refresh()
+        print(f"Downloaded font registered: {info['path']}")
+        return info['path'] == font_path
     except Exception as e:
         print(f"Failed to download font: {e}")
         # フォールバック: reportlabのデフォルトフォントを使用
@@ -179,24 +281,230 @@ def calculate_proficiency_score(correct_count, total_attempts):
     return round(correct_count / total_attempts, 3)
 
 # オンラインテスト機能
+class OnlineTestSessionStore(ABC):
+    """オンラインテストセッションの保存先の共通インターフェース
+
+    セッションデータはJSONに変換できる辞書。変更は update() の中で行う。
+    有効期限は最後の操作から ttl 秒（取得・変更のたびに延長）。
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+
+    @abstractmethod
+    def create(self, session_id, data):
+        pass
+
+    @abstractmethod
+    def get(self, session_id):
+        """セッションデータを取得して有効期限を延長（期限切れ・存在しない場合はNone）"""
+
+    @abstractmethod
+    def update(self, session_id):
+        """セッションデータを排他的に読み込み、ブロックを抜けた時点で保存する（contextmanager）
+
+        期限切れ・存在しない場合は None を渡す。
+        """
+
+    @abstractmethod
+    def cleanup_expired(self):
+        """期限切れのセッションを削除し、削除した件数を返す"""
+
+    @abstractmethod
+    def stats(self):
+        """監視用の件数（有効なセッション数・これまでに期限切れで削除した数）"""
+
+
+class MemoryOnlineTestSessionStore(OnlineTestSessionStore):
+    """プロセス内の辞書に保持する保存先（既定、単一プロセス用）
+
+    期限は (期限, セッションID) の最小ヒープで管理する。操作のたびにヒープを
+    更新せず、先頭を取り出した時点で延長されていれば新しい期限で入れ直す。
+    """
+
+    def __init__(self, ttl):
+        super().__init__(ttl)
+        self._sessions = {}       # セッションID → [期限, データ]
+        self._expiry_heap = []    # (期限, セッションID)
+        self._expired_count = 0
+        self._lock = threading.Lock()
+
+    def create(self, session_id, data):
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._sessions[session_id] = [expires_at, data]
+            heapq.heappush(self._expiry_heap, (expires_at, session_id))
+
+    def _touch(self, session_id):
+        entry = self._sessions.get(session_id)
+        current_time = time.time()
+        if entry is None or entry[0] < current_time:
+            return None
+        entry[0] = current_time + self.ttl
+        return entry[1]
+
+    def get(self, session_id):
+        with self._lock:
+            return self._touch(session_id)
+
+    @contextmanager
+    def update(self, session_id):
+        with self._lock:
+            yield self._touch(session_id)
+
+    def cleanup_expired(self):
+        current_time = time.time()
+        expired = 0
+        with self._lock:
+            heap = self._expiry_heap
+            while heap and heap[0][0] < current_time:
+                _, session_id = heapq.heappop(heap)
+                entry = self._sessions.get(session_id)
+                if entry is None:
+                    continue
+                if entry[0] < current_time:
+                    del self._sessions[session_id]
+                    expired += 1
+                else:
+                    # 期限が延長されていたため入れ直す
+                    heapq.heappush(heap, (entry[0], session_id))
+            self._expired_count += expired
+        return expired
+
+    def stats(self):
+        with self._lock:
+            return {'active_sessions': len(self._sessions), 'expired_sessions': self._expired_count}
+
+
+class SqliteOnlineTestSessionStore(OnlineTestSessionStore):
+    """SQLite（WALモード）に保持する保存先（複数ワーカーでセッションを共有）
+
+    期限切れの削除は expires_at の索引を使い、削除件数は全ワーカー共通で記録する。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS online_test_sessions (
+            id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_online_test_sessions_expires ON online_test_sessions(expires_at);
+        CREATE TABLE IF NOT EXISTS online_test_session_stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            expired_sessions INTEGER NOT NULL DEFAULT 0
+        );
+        INSERT OR IGNORE INTO online_test_session_stats (id) VALUES (1);
+    """
+
+    def __init__(self, ttl, db_path):
+        super().__init__(ttl)
+        self.db_path = db_path
+        self._local = threading.local()
+
+    def _connect(self):
+        """スレッドごとの接続を取得（fork後は作り直す）"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        conn = open_sqlite_connection(self.db_path)
+        conn.executescript(self.SCHEMA)
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def create(self, session_id, data):
+        conn = self._connect()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO online_test_sessions (id, data, expires_at) VALUES (?, ?, ?)',
+                         (session_id, json.dumps(data, ensure_ascii=False), time.time() + self.ttl))
+
+    def _touch(self, conn, session_id):
+        """有効なセッションの期限を延長してデータを返す"""
+        current_time = time.time()
+        updated = conn.execute(
+            'UPDATE online_test_sessions SET expires_at = ? WHERE id = ? AND expires_at >= ?',
+            (current_time + self.ttl, session_id, current_time)).rowcount
+        if not updated:
+            return None
+        row = conn.execute('SELECT data FROM online_test_sessions WHERE id = ?', (session_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get(self, session_id):
+        conn = self._connect()
+        with conn:
+            return self._touch(conn, session_id)
+
+    @contextmanager
+    def update(self, session_id):
+        conn = self._connect()
+        # 書き込みロックを先に取得し、他のワーカーとの読み込み→保存の競合を防ぐ
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            data = self._touch(conn, session_id)
+            yield data
+            if data is not None:
+                conn.execute('UPDATE online_test_sessions SET data = ? WHERE id = ?',
+                             (json.dumps(data, ensure_ascii=False), session_id))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    def cleanup_expired(self):
+        conn = self._connect()
+        with conn:
+            expired = conn.execute('DELETE FROM online_test_sessions WHERE expires_at < ?',
+                                   (time.time(),)).rowcount
+            if expired:
+                conn.execute('UPDATE online_test_session_stats SET expired_sessions = expired_sessions + ?',
+                             (expired,))
+        return expired
+
+    def stats(self):
+        conn = self._connect()
+        active = conn.execute('SELECT COUNT(*) FROM online_test_sessions WHERE expires_at >= ?',
+                              (time.time(),)).fetchone()[0]
+        expired = conn.execute('SELECT expired_sessions FROM online_test_session_stats').fetchone()[0]
+        return {'active_sessions': active, 'expired_sessions': expired}
+
+
+_online_test_session_store = None
+_online_test_session_store_guard = threading.Lock()
+
+def get_online_test_session_store():
+    """設定（ONLINE_TEST_SESSION_STORE）に応じたセッションの保存先を取得"""
+    global _online_test_session_store
+    if _online_test_session_store is None:
+        with _online_test_session_store_guard:
+            if _online_test_session_store is None:
+                if ONLINE_TEST_SESSION_STORE == 'sqlite':
+                    db_path = os.environ.get('ONLINE_TEST_SESSION_DB',
+                                             os.path.join(DATASETS_DIR, ONLINE_TEST_SESSION_DB_FILENAME))
+                    _online_test_session_store = SqliteOnlineTestSessionStore(ONLINE_TEST_SESSION_TTL, db_path)
+                else:
+                    _online_test_session_store = MemoryOnlineTestSessionStore(ONLINE_TEST_SESSION_TTL)
+    return _online_test_session_store
+
 def create_online_test_session(filename, questions, settings, is_quick_10=False):
     """オンラインテストセッションを作成"""
     session_id = str(uuid.uuid4())
     
-    online_test_sessions[session_id] = {
+    get_online_test_session_store().create(session_id, {
         'filename': filename,
         'questions': questions,
         'current_question': 0,
         'user_judgments': [None] * len(questions),  # True/False/None
         'question_states': ['question'] * len(questions),  # "question"/"answer"/"judged"
-        'start_time': datetime.now(),
+        'start_time': time.time(),
         'settings': settings,
         'is_quick_10': is_quick_10,  # クイック10フラグ
+        'batch_key': uuid.uuid4().hex,  # オフラインモードの一括送信用の冪等キー
+        'batch_applied': False,
         'results': {
             'score': 0,
             'total_questions': len(questions)
         }
-    }
+    })
     
     # 期限切れセッションのクリーンアップ
     cleanup_expired_test_sessions()
@@ -204,45 +512,45 @@ def create_online_test_session(filename, questions, settings, is_quick_10=False)
     return session_id
 
 def get_online_test_session(session_id):
-    """オンラインテストセッションを取得"""
-    return online_test_sessions.get(session_id)
+    """オンラインテストセッションを取得（読み取り用）"""
+    return get_online_test_session_store().get(session_id)
+
+def update_online_test_session(session_id):
+    """オンラインテストセッションを変更するためのコンテキスト（ブロックを抜けると保存）"""
+    return get_online_test_session_store().update(session_id)
 
 def cleanup_expired_test_sessions():
-    """期限切れテストセッションを削除（1時間経過）"""
-    current_time = datetime.now()
-    expired_sessions = []
+    """期限切れテストセッションを削除（既定は最後の操作から1時間経過）"""
+    expired = get_online_test_session_store().cleanup_expired()
+    if expired:
+        print(f"Expired {expired} online test sessions")
+    return expired
+
+def apply_judgment_to_item(item, is_correct):
+    """1問分の判定結果を行データに反映"""
+    # 試行回数を増加
+    item['総試行回数'] = int(item['総試行回数']) + 1
     
-    for session_id, session_data in online_test_sessions.items():
-        if current_time - session_data['start_time'] > timedelta(hours=1):
-            expired_sessions.append(session_id)
+    # 正解の場合は正解数を増加
+    if is_correct:
+        item['正解数'] = int(item['正解数']) + 1
     
-    for session_id in expired_sessions:
-        del online_test_sessions[session_id]
+    # 習熟度スコアを再計算
+    item['習熟度スコア'] = calculate_proficiency_score(
+        int(item['正解数']), int(item['総試行回数'])
+    )
+
+def apply_proficiency_judgments(filename, judgments):
+    """複数問題の習熟度データを1回の読み込み・保存でまとめて更新
+
+    judgments: (問題インデックス, 正解かどうか) のリスト
+    戻り値: 更新した問題数（保存に失敗した場合は0）
+    """
+    return get_dataset_store().apply_judgments(filename, judgments)
 
 def update_question_proficiency(filename, question_index, is_correct):
     """問題の習熟度データを更新"""
-    data = load_dataset(filename)
-    
-    if 0 <= question_index < len(data):
-        item = data[question_index]
-        
-        # 試行回数を増加
-        item['総試行回数'] = int(item['総試行回数']) + 1
-        
-        # 正解の場合は正解数を増加
-        if is_correct:
-            item['正解数'] = int(item['正解数']) + 1
-        
-        # 習熟度スコアを再計算
-        item['習熟度スコア'] = calculate_proficiency_score(
-            int(item['正解数']), int(item['総試行回数'])
-        )
-        
-        # データセットを保存
-        fieldnames = ['番号', '質問', '回答', '正解数', '総試行回数', '習熟度スコア']
-        return save_dataset(filename, data, fieldnames)
-    
-    return False
+    return apply_proficiency_judgments(filename, [(question_index, is_correct)]) > 0
 
 
 def ensure_datasets_dir():
@@ -250,37 +558,236 @@ def ensure_datasets_dir():
     if not os.path.exists(DATASETS_DIR):
         os.makedirs(DATASETS_DIR)
 
-def get_datasets():
-    """利用可能なデータセット一覧を取得（統計情報付き）"""
-    ensure_datasets_dir()
-    datasets = []
-    for filename in os.listdir(DATASETS_DIR):
-        if filename.endswith('.csv'):
-            name = filename[:-4]  # .csvを除去
-            stats = get_dataset_stats(filename)
-            datasets.append({
-                'name': name,
-                'filename': filename,
-                'path': os.path.join(DATASETS_DIR, filename),
-                'stats': stats
-            })
+# データセット一覧の並び順に使うロケール（初回のみ設定）
+_sort_locale_name = None
+
+def setup_sort_locale():
+    """日本語対応の名前順ソート用にロケールを設定（プロセス内で1回のみ）"""
+    global _sort_locale_name
+    if _sort_locale_name is not None:
+        return _sort_locale_name
     
-    # 日本語対応の名前順でソート
     import locale
-    try:
-        # 日本語ロケールを設定（利用可能な場合）
-        locale.setlocale(locale.LC_ALL, 'ja_JP.UTF-8')
-    except locale.Error:
+    for locale_name in ['ja_JP.UTF-8', 'C.UTF-8']:
         try:
-            # フォールバック: C.UTF-8ロケール
-            locale.setlocale(locale.LC_ALL, 'C.UTF-8')
+            locale.setlocale(locale.LC_COLLATE, locale_name)
+            _sort_locale_name = locale_name
+            break
         except locale.Error:
-            # フォールバック: デフォルトロケール
-            pass
-    
-    # 名前でソート（日本語対応）
-    datasets.sort(key=lambda x: locale.strxfrm(x['name']))
-    
+            continue
+    else:
+        # フォールバック: デフォルトロケール
+        _sort_locale_name = locale.setlocale(locale.LC_COLLATE)
+    return _sort_locale_name
+
+def make_sort_key(name):
+    """データセット名のソートキーを作成"""
+    import locale
+    setup_sort_locale()
+    return locale.strxfrm(name)
+
+class DatasetCatalog:
+    """データセット一覧用のカタログ（DATASETS_DIR 内のJSONサイドカーファイル）
+
+    各CSVの統計情報・行数・エンコーディング・ソートキーを (mtime, サイズ,
+    判定ジャーナルのサイズ) と共に保持し、一覧表示時はファイルの stat 比較だけで済ませる。
+    アプリ外で編集されたファイルは stat の不一致から検出して再集計する。
+    """
+
+    FILENAME = '.catalog.json'
+    VERSION = 1
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._entries = {}
+        self._loaded_signature = None  # 読み込んだカタログファイルの (mtime, サイズ)
+        self._loaded_dir = None
+        self._local = threading.local()  # batch() 中に書き出しを保留しているエントリ
+
+    def _path(self):
+        return os.path.join(DATASETS_DIR, self.FILENAME)
+
+    def _load(self):
+        """カタログファイルが更新されていればメモリ上に読み直す"""
+        path = self._path()
+        try:
+            stat = os.stat(path)
+            signature = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            signature = None
+        
+        if self._loaded_dir == DATASETS_DIR and signature == self._loaded_signature:
+            return
+        
+        self._entries = {}
+        if signature is not None:
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    payload = json.load(f)
+                if (payload.get('version') == self.VERSION and
+                        payload.get('locale') == setup_sort_locale()):
+                    self._entries = payload.get('datasets', {})
+            except (OSError, ValueError) as e:
+                print(f"Catalog load error: {e}")
+        self._loaded_dir = DATASETS_DIR
+        self._loaded_signature = signature
+
+    def _save(self):
+        """カタログを一時ファイル経由で書き出す"""
+        path = self._path()
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        payload = {
+            'version': self.VERSION,
+            'locale': setup_sort_locale(),
+            'datasets': self._entries
+        }
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(payload, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+            stat = os.stat(path)
+            self._loaded_signature = (stat.st_mtime_ns, stat.st_size)
+        except OSError as e:
+            print(f"Catalog save error: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def _make_entry(self, filename, stat, data, file_info, journal_size=0, stats=None):
+        if stats is None:
+            stats = get_dataset_stats(data)
+        return {
+            'mtime_ns': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'journal_size': journal_size,
+            'row_count': stats['total_problems'],
+            'encoding': file_info.get('encoding'),
+            'delimiter': file_info.get('delimiter'),
+            'sort_key': make_sort_key(filename[:-4]),
+            'stats': stats
+        }
+
+    def list_entries(self):
+        """全データセットのカタログエントリを返す（変更されたファイルのみ再集計）"""
+        with self._lock:
+            self._load()
+            known = dict(self._entries)
+        
+        stale = {}
+        seen = set()
+        with os.scandir(DATASETS_DIR) as it:
+            for dir_entry in it:
+                filename = dir_entry.name
+                if not filename.endswith('.csv') or not dir_entry.is_file():
+                    continue
+                seen.add(filename)
+                stat = dir_entry.stat()
+                entry = known.get(filename)
+                if (entry is None or entry['mtime_ns'] != stat.st_mtime_ns or
+                        entry['size'] != stat.st_size or
+                        entry.get('journal_size', 0) != get_journal_size(filename)):
+                    stale[filename] = stat
+        
+        # 再集計はカタログのロック外で行う（データセットのロック → カタログのロック の順序を守る）
+        fresh = {}
+        for filename, stat in stale.items():
+            # 未コンパクションの判定ジャーナルも反映して集計
+            data, info = load_dataset_entry(filename)
+            try:
+                current = os.stat(os.path.join(DATASETS_DIR, filename))
+            except OSError:
+                continue
+            if (current.st_mtime_ns, current.st_size) != (stat.st_mtime_ns, stat.st_size):
+                # 読み込み中に書き換えられた（ID付与など）場合は書き込み側が登録済み
+                continue
+            fresh[filename] = self._make_entry(filename, stat, data, info, info['journal_offset'])
+        
+        with self._lock:
+            self._load()
+            removed = [filename for filename in self._entries if filename not in seen]
+            if fresh or removed:
+                for filename in removed:
+                    del self._entries[filename]
+                self._entries.update(fresh)
+                self._save()
+            return {filename: entry for filename, entry in self._entries.items() if filename in seen}
+
+    def get_format(self, filename):
+        """記録済みのエンコーディング・区切り文字を返す（未記録の場合はNone）"""
+        with self._lock:
+            self._load()
+            entry = self._entries.get(filename, {})
+            return {'encoding': entry.get('encoding'), 'delimiter': entry.get('delimiter')}
+
+    def update(self, filename, data, file_info, stats=None):
+        """保存直後のデータ（または書き込み中に集計した統計情報）からエントリを更新（再解析なし）"""
+        with self._lock:
+            try:
+                stat = os.stat(os.path.join(DATASETS_DIR, filename))
+            except OSError:
+                return
+            entry = self._make_entry(filename, stat, data, file_info, stats=stats)
+            pending = getattr(self._local, 'pending', None)
+            if pending is not None:
+                pending[filename] = entry
+                return
+            self._load()
+            self._entries[filename] = entry
+            self._save()
+
+    @contextmanager
+    def batch(self):
+        """ブロック内（同じスレッド）の update をまとめ、終了時にカタログを1回だけ書き出す
+
+        ブロック中はロックを保持しないため、データセットのロックと順序が逆転することはない。
+        """
+        if getattr(self._local, 'pending', None) is not None:
+            yield
+            return
+        self._local.pending = {}
+        try:
+            yield
+        finally:
+            pending, self._local.pending = self._local.pending, None
+            if pending:
+                with self._lock:
+                    self._load()
+                    self._entries.update(pending)
+                    self._save()
+
+    def remove(self, filename):
+        """削除されたデータセットのエントリを除去"""
+        with self._lock:
+            self._load()
+            if self._entries.pop(filename, None) is not None:
+                self._save()
+
+
+dataset_catalog = DatasetCatalog()
+
+def get_datasets():
+    """利用可能なデータセット一覧を取得（統計情報付き）"""
+    return get_dataset_store().list_datasets()
+
+def get_due_items(filename, limit):
+    """復習時期が来た問題を期限の早い順に最大 limit 件返す
+
+    データセットから消えた問題の予定は取り出しながら削除し、その分だけ次の問題で補う。
+    """
+    store = get_dataset_store()
+    while True:
+        due_ids = review_schedules.due_items(filename, limit)
+        found = store.get_items_by_ids(filename, due_ids)
+        missing = [item_id for item_id in due_ids if item_id not in found]
+        if not missing:
+            return [found[item_id][1] for item_id in due_ids]
+        review_schedules.forget(filename, missing)
+
+def add_due_counts(datasets):
+    """データセット一覧に今日復習する問題数（due_count）を追加（復習予定のファイルだけを参照）"""
+    for dataset in datasets:
+        dataset['due_count'] = review_schedules.due_count(dataset['filename'])
     return datasets
 
 def get_dataset_stats(data_or_filename):
@@ -288,21 +795,12 @@ def get_dataset_stats(data_or_filename):
     # データまたはファイル名を受け取り、データを取得
     if isinstance(data_or_filename, str):
         # ファイル名が渡された場合
-        data = load_dataset(data_or_filename)
+        data = load_dataset(data_or_filename, readonly=True)
     else:
-        # データリストが直接渡された場合
+        # データリスト（または行を順に返すイテレータ）が直接渡された場合
         data = data_or_filename
     
-    if not data:
-        return {
-            'total_problems': 0,
-            'average_mastery': 0.0,
-            'total_attempts': 0,
-            'total_correct': 0,
-            'studied_problems': 0
-        }
-    
-    total_problems = len(data)
+    total_problems = 0
     total_attempts = 0
     total_correct = 0
     mastery_sum = 0.0
@@ -314,6 +812,7 @@ def get_dataset_stats(data_or_filename):
     untouched_problems = 0     # 習熟度0%（未着手）
     
     for item in data:
+        total_problems += 1
         try:
             correct = int(item.get('正解数', 0) or 0)
             attempts = int(item.get('総試行回数', 0) or 0)
@@ -337,6 +836,15 @@ def get_dataset_stats(data_or_filename):
             untouched_problems += 1
             continue
     
+    if total_problems == 0:
+        return {
+            'total_problems': 0,
+            'average_mastery': 0.0,
+            'total_attempts': 0,
+            'total_correct': 0,
+            'studied_problems': 0
+        }
+    
     # 平均習熟度スコアを計算（0-100の範囲で表示）
     average_mastery = (mastery_sum / total_problems * 100) if total_problems > 0 else 0.0
     
@@ -357,181 +865,2508 @@ def get_dataset_stats(data_or_filename):
         'studied_problems': attempted_problems
     }
 
-def get_weak_problems(data, threshold=0.6):
-    """習熟度が閾値未満の問題を抽出"""
-    weak_problems = []
-    for item in data:
-        try:
-            mastery_score = float(item.get('習熟度スコア', 0.0) or 0.0)
-            if mastery_score < threshold:
-                weak_problems.append(item)
-        except (ValueError, TypeError):
-            # 習熟度スコアが不正な場合は弱点問題として扱う
-            weak_problems.append(item)
-    return weak_problems
+def get_mastery_score(item):
+    """行データの習熟度スコアを数値で取得（不正な値は0.0）"""
+    try:
+        return float(item.get('習熟度スコア', 0.0) or 0.0)
+    except (ValueError, TypeError):
+        return 0.0
+
+def get_weak_problems(data, threshold=0.6):
+    """習熟度が閾値未満の問題を抽出"""
+    weak_problems = []
+    for item in data:
+        try:
+            mastery_score = float(item.get('習熟度スコア', 0.0) or 0.0)
+            if mastery_score < threshold:
+                weak_problems.append(item)
+        except (ValueError, TypeError):
+            # 習熟度スコアが不正な場合は弱点問題として扱う
+            weak_problems.append(item)
+    return weak_problems
+
+def get_mastery_distribution(data):
+    """習熟度分布を取得（UI表示用）"""
+    return MasteryIndex(data).distribution()
+
+class MasteryIndex:
+    """1データセット分の行位置を習熟度の帯（未学習・60%未満・80%未満・80%以上）ごとに保持する索引
+
+    判定で行が変わった場合は update でその行だけを移し替える（O(1)）。update は更新後の行から
+    帯を決めるため、同じ判定を複数のワーカーが反映しても結果は変わらない。行の追加・削除では
+    行位置が変わるため作り直す。
+    """
+
+    BANDS = ('untouched', 'weak', 'moderate', 'strong')
+    # 閾値 → 閾値未満に当たる帯の数（get_weak_problems と同じ境界）
+    THRESHOLD_BANDS = {0.6: 2, 0.8: 3}
+
+    def __init__(self, rows=()):
+        self._lock = threading.Lock()
+        self._bands = []
+        self._positions = [set() for _ in self.BANDS]
+        for position, item in enumerate(rows):
+            band = self.classify(item)
+            self._bands.append(band)
+            self._positions[band].add(position)
+
+    @staticmethod
+    def classify(item):
+        """行データの帯の番号（BANDS の位置）"""
+        try:
+            score = float(item.get('習熟度スコア', 0.0) or 0.0)
+        except (ValueError, TypeError):
+            # 習熟度スコアが不正な場合は弱点問題として扱う
+            return 1
+        if score >= 0.8:
+            return 3
+        if score >= 0.6:
+            return 2
+        try:
+            attempted = int(item.get('総試行回数', 0) or 0) > 0
+        except (ValueError, TypeError):
+            attempted = True
+        return 1 if attempted else 0
+
+    def update(self, position, item):
+        """position の行が item に変わったことを反映"""
+        band = self.classify(item)
+        with self._lock:
+            old_band = self._bands[position]
+            if old_band != band:
+                self._positions[old_band].discard(position)
+                self._positions[band].add(position)
+                self._bands[position] = band
+
+    def positions_below(self, threshold):
+        """習熟度が閾値未満の行位置を昇順で返す（索引で扱えない閾値の場合はNone）"""
+        band_count = self.THRESHOLD_BANDS.get(threshold)
+        if band_count is None:
+            return None
+        with self._lock:
+            positions = set().union(*self._positions[:band_count])
+        return sorted(positions)
+
+    def distribution(self):
+        """get_mastery_distribution と同じ形式の分布（未学習の問題数を含む）"""
+        with self._lock:
+            untouched, weak, moderate, strong = (len(positions) for positions in self._positions)
+        return {
+            'weak': untouched + weak,
+            'moderate': moderate,
+            'strong': strong,
+            'total': len(self._bands),
+            'untouched': untouched
+        }
+
+def selection_weight(item):
+    """重み付き選択での問題の重み（習熟度が低く試行回数が少ないほど大きい。習得済みでも0にはしない）"""
+    try:
+        attempts = int(item.get('総試行回数', 0) or 0)
+    except (ValueError, TypeError):
+        attempts = 0
+    return 0.1 + max(0.0, 1.0 - get_mastery_score(item)) + 1.0 / (1 + attempts)
+
+class WeightedSampler:
+    """問題の重みをFenwick tree（BIT）で保持し、重み付きの非復元抽出を行う
+
+    判定で行が変わった場合は update でその行の重みだけを O(log n) で置き換える。
+    1問の抽出は O(log n) で、抽出済みの問題は一時的に重みを0にして重複を防ぐ。
+    """
+
+    def __init__(self, rows=()):
+        self._lock = threading.Lock()
+        self._weights = [selection_weight(item) for item in rows]
+        self._size = len(self._weights)
+        # 各ノードに自分の担当区間の合計を積み上げて O(n) で構築
+        tree = [0.0] + self._weights
+        for i in range(1, self._size + 1):
+            parent = i + (i & -i)
+            if parent <= self._size:
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _set(self, position, weight):
+        delta = weight - self._weights[position]
+        self._weights[position] = weight
+        i = position + 1
+        while i <= self._size:
+            self._tree[i] += delta
+            i += i & -i
+
+    def _prefix_sum(self, end):
+        """先頭から end 問分の重みの合計"""
+        total = 0.0
+        i = end
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+    def _find(self, value):
+        """累積の重みが value を超える最初の行位置"""
+        position = 0
+        step = 1 << self._size.bit_length()
+        while step:
+            next_position = position + step
+            if next_position <= self._size and self._tree[next_position] <= value:
+                position = next_position
+                value -= self._tree[next_position]
+            step >>= 1
+        return position
+
+    def update(self, position, item):
+        """position の行が item に変わったことを反映"""
+        with self._lock:
+            self._set(position, selection_weight(item))
+
+    def sample(self, count, rng=None, start=0, end=None):
+        """行位置 start 以上 end 未満から count 問を重み付きで非復元抽出し、行位置を抽出順に返す"""
+        rng = rng or random
+        end = self._size if end is None else min(end, self._size)
+        count = min(count, max(0, end - start))
+        taken = []
+        with self._lock:
+            try:
+                base = self._prefix_sum(start)
+                misses = 0
+                while len(taken) < count and misses < 100:
+                    total = self._prefix_sum(end) - base
+                    if total <= 0:
+                        break
+                    position = self._find(base + rng.random() * total)
+                    # 浮動小数点の誤差で範囲外・抽出済みの位置を指した場合は引き直す
+                    if not start <= position < end or self._weights[position] <= 0:
+                        misses += 1
+                        continue
+                    taken.append((position, self._weights[position]))
+                    self._set(position, 0.0)
+            finally:
+                for position, weight in taken:
+                    self._set(position, weight)
+        return [position for position, _ in taken]
+
+def weighted_sample(items, count, rng=None):
+    """行データのリストから count 問を習熟度に応じた重み付きで非復元抽出"""
+    return [items[position] for position in WeightedSampler(items).sample(count, rng)]
+
+# データセット単位のロック・アトミック書き込み
+_lock_state = threading.local()
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+
+def lock_path(filename):
+    """データセットのロックファイルのパス"""
+    lock_dir = os.path.join(DATASETS_DIR, '.locks')
+    os.makedirs(lock_dir, exist_ok=True)
+    return os.path.join(lock_dir, f"{filename}.lock")
+
+def _acquire_thread_lock(filename):
+    """fcntl が使えない環境向けのプロセス内ロック（常に排他）"""
+    with _thread_locks_guard:
+        lock = _thread_locks.get(filename)
+        if lock is None:
+            lock = _thread_locks[filename] = threading.Lock()
+    lock.acquire()
+    return lock
+
+@contextmanager
+def dataset_lock(filename, exclusive=False):
+    """データセット単位の読み書きロック（読み込みは共有、書き込みは排他）
+
+    fcntl.flock によるプロセス間ロックで、複数ワーカー間でも書き込みを直列化する。
+    同一スレッド内での再取得は入れ子として扱い、共有から排他への昇格にも対応する。
+    """
+    held = getattr(_lock_state, 'held', None)
+    if held is None:
+        held = _lock_state.held = {}
+    
+    state = held.get(filename)
+    if state is not None:
+        # 同一スレッドで保持済み: 必要なら排他に昇格して入れ子で使う
+        upgraded = exclusive and not state['exclusive']
+        if upgraded and fcntl is not None:
+            fcntl.flock(state['handle'], fcntl.LOCK_EX)
+            state['exclusive'] = True
+        state['depth'] += 1
+        try:
+            yield
+        finally:
+            state['depth'] -= 1
+            if upgraded and fcntl is not None:
+                fcntl.flock(state['handle'], fcntl.LOCK_SH)
+                state['exclusive'] = False
+        return
+    
+    if fcntl is not None:
+        handle = os.open(lock_path(filename), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        except BaseException:
+            os.close(handle)
+            raise
+    else:
+        handle = _acquire_thread_lock(filename)
+    
+    held[filename] = {'exclusive': exclusive, 'handle': handle, 'depth': 1}
+    try:
+        yield
+    finally:
+        del held[filename]
+        if fcntl is not None:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+            os.close(handle)
+        else:
+            handle.release()
+
+def atomic_write(filepath, encoding, write_func, durable=True):
+    """一時ファイルに書き込んでから置き換える（書き込み途中のファイルを残さない）
+
+    durable=False の場合は fsync を省く（失われても困らない進捗表示などに使う）。
+    """
+    directory = os.path.dirname(filepath) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'w', encoding=encoding, newline='') as f:
+            write_func(f)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def atomic_write_bytes(filepath, data):
+    """バイト列を一時ファイルに書き込んでから置き換える"""
+    directory = os.path.dirname(filepath) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+ITEM_ID_CHARS = frozenset('0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz_-')
+
+def generate_item_id():
+    """問題の永続IDを生成"""
+    return uuid.uuid4().hex[:12]
+
+def is_valid_item_id(item_id):
+    """ジャーナルや復習スケジュールにそのまま書けるID（英数字・_・-のみ）かどうか"""
+    return bool(item_id) and ITEM_ID_CHARS.issuperset(item_id)
+
+def assign_item_ids(rows):
+    """IDがない・使えない文字を含む・重複している行に新しいIDを付与（付与した場合はTrue）"""
+    seen = set()
+    assigned = False
+    for row in rows:
+        item_id = row.get('ID')
+        if not is_valid_item_id(item_id) or item_id in seen:
+            item_id = generate_item_id()
+            while item_id in seen:
+                item_id = generate_item_id()
+            row['ID'] = item_id
+            assigned = True
+        seen.add(item_id)
+    return assigned
+
+def build_id_index(rows):
+    """ID → 行位置 のインデックスを作成"""
+    return {row['ID']: position for position, row in enumerate(rows) if row.get('ID')}
+
+def find_item_index(filename, item_id):
+    """IDから行位置を取得（見つからない場合はNone）"""
+    _, info = load_dataset_entry(filename)
+    return info['id_index'].get(item_id)
+
+def get_item_by_id(filename, item_id):
+    """IDから問題データを取得（読み取り専用、見つからない場合はNone）"""
+    rows, info = load_dataset_entry(filename)
+    position = info['id_index'].get(item_id)
+    return rows[position] if position is not None else None
+
+class DatasetCache:
+    """解析済みデータセットのプロセス内キャッシュ（mtime・サイズで検証するLRU）"""
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # filename -> (signature, rows, info, cost)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, filename, signature):
+        """署名が一致する場合のみ (解析済みの行, ファイル情報) を返す"""
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is None:
+                return None
+            if entry[0] != signature:
+                # ファイルが外部で更新された
+                self._remove(filename)
+                return None
+            self._entries.move_to_end(filename)
+            return entry[1], entry[2]
+
+    def put(self, filename, signature, rows, info, cost):
+        """解析済みの行を登録し、上限を超えた分を古い順に追い出す"""
+        with self._lock:
+            self._remove(filename)
+            if cost > self.max_bytes or self.max_entries <= 0:
+                return
+            self._entries[filename] = (signature, rows, info, cost)
+            self._total_bytes += cost
+            while (len(self._entries) > self.max_entries or
+                   self._total_bytes > self.max_bytes):
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+
+    def invalidate(self, filename=None):
+        """指定データセット（省略時は全て）のキャッシュを破棄"""
+        with self._lock:
+            if filename is None:
+                self._entries.clear()
+                self._total_bytes = 0
+            else:
+                self._remove(filename)
+
+    def _remove(self, filename):
+        entry = self._entries.pop(filename, None)
+        if entry is not None:
+            self._total_bytes -= entry[3]
+
+
+dataset_cache = DatasetCache(DATASET_CACHE_MAX_ENTRIES, DATASET_CACHE_MAX_BYTES)
+
+def empty_dataset_info():
+    """存在しないデータセットのファイル情報"""
+    return {'encoding': None, 'delimiter': None, 'journal_offset': 0, 'id_index': {},
+            'mastery_index': MasteryIndex(), 'weighted_sampler': WeightedSampler(), 'text_signature': None}
+
+def load_dataset_entry(filename):
+    """キャッシュを介してデータセットを読み込み、(行, ファイル情報) を返す
+
+    行には未コンパクションの判定ジャーナルが反映済み。キャッシュ済みの場合は
+    ジャーナルの追記分だけを読み込んで反映する。
+    """
+    filepath = os.path.join(DATASETS_DIR, filename)
+    if not os.path.exists(filepath):
+        return [], empty_dataset_info()
+    
+    with dataset_lock(filename):
+        rows, info, needs_ids = _load_dataset_entry_locked(filename, filepath)
+    
+    if needs_ids and migrate_item_ids(filename):
+        return load_dataset_entry(filename)
+    return rows, info
+
+def _load_dataset_entry_locked(filename, filepath):
+    """共有ロック下でキャッシュの検証・読み込みを行う"""
+    try:
+        stat = os.stat(filepath)
+    except OSError:
+        return [], empty_dataset_info(), False
+    
+    signature = (stat.st_mtime_ns, stat.st_size)
+    journal_size = get_journal_size(filename)
+    entry = dataset_cache.get(filename, signature)
+    if entry is not None and entry[1]['journal_offset'] > journal_size:
+        # ジャーナルがCSVの更新なしに切り詰められた場合は読み直す
+        entry = None
+    
+    if entry is None:
+        rows, file_info = read_dataset_file(filename, filepath)
+        # IDの移行に失敗した場合もメモリ上で付与したIDをキャッシュして使い続ける
+        needs_ids = assign_item_ids(rows) and bool(rows)
+        info = dict(file_info, journal_offset=0, id_index=build_id_index(rows),
+                    mastery_index=MasteryIndex(rows), weighted_sampler=WeightedSampler(rows),
+                    text_signature=compute_text_signature(rows))
+        changed = True
+        if not needs_ids:
+            # CSVが外部で書き換えられた場合に備え、消えた問題の復習予定を削除
+            review_schedules.retain(filename, info['id_index'])
+    else:
+        rows, info = entry
+        needs_ids = False
+        changed = False
+    
+    if journal_size > info['journal_offset']:
+        judgments, offset = read_journal(filename, info['journal_offset'])
+        rows = apply_journal_to_rows(rows, judgments, info['id_index'],
+                                     (info['mastery_index'], info['weighted_sampler']))
+        info = dict(info, journal_offset=offset)
+        changed = True
+    
+    if changed:
+        dataset_cache.put(filename, signature, rows, info, stat.st_size)
+    return rows, info, needs_ids
+
+def migrate_item_ids(filename):
+    """IDのない旧形式のファイルにIDを付与して保存し直す（成功時はTrue）"""
+    filepath = os.path.join(DATASETS_DIR, filename)
+    with dataset_lock(filename, exclusive=True):
+        rows, _ = read_dataset_file(filename, filepath)
+        if not assign_item_ids(rows):
+            return True  # 他のワーカーが移行済み
+        # 保存時にジャーナルは消去されるため、先に反映しておく
+        judgments, _ = read_journal(filename)
+        rows = apply_journal_to_rows(rows, judgments, build_id_index(rows))
+        return save_csv_dataset(filename, rows)
+
+def load_csv_dataset(filename, readonly=False):
+    """CSVファイルからデータセットを読み込み（習熟度データ対応）
+
+    ファイルの (mtime, サイズ) が前回と同じならキャッシュから返す。
+    readonly=True の場合はキャッシュ上の行をそのまま返すため、呼び出し側で変更しないこと。
+    """
+    rows, _ = load_dataset_entry(filename)
+    if readonly:
+        return rows
+    return [row.copy() for row in rows]
+
+# CSVのエンコーディング判定
+ENCODING_SAMPLE_BYTES = 64 * 1024
+CANONICAL_ENCODING = 'utf-8-sig'  # BOM付きUTF-8（Excelでもそのまま開ける）
+DATASET_DEFAULT_ENCODING = os.environ.get('DATASET_DEFAULT_ENCODING', 'shift_jis')
+
+def probe_encoding(sample, encoding):
+    """先頭サンプルが指定エンコーディングでデコードできるか（末尾の途中文字は許容）"""
+    try:
+        codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+        return True
+    except (UnicodeDecodeError, LookupError):
+        return False
+
+def detect_delimiter(first_line):
+    """先頭行からタブ区切りかカンマ区切りかを判定"""
+    return '\t' if first_line.count('\t') > first_line.count(',') else ','
+
+def csv_encoding_candidates(sample, encoding_hint=None):
+    """先頭サンプルからデコードを試すエンコーディングの候補を優先順に返す"""
+    if sample.startswith(codecs.BOM_UTF8):
+        return ['utf-8-sig']
+    candidates = [encoding_hint] if encoding_hint else []
+    # 非ASCIIを含み UTF-8 として妥当ならUTF-8を優先（Shift_JISとして偶然読めることがあるため）
+    if not sample.isascii() and probe_encoding(sample, 'utf-8'):
+        candidates.append('utf-8')
+    candidates += ['shift_jis', 'cp932', 'utf-8']
+    return [encoding for encoding in dict.fromkeys(candidates)
+            if probe_encoding(sample, encoding)] or ['utf-8']
+
+def decode_csv_bytes(raw, encoding_hint=None):
+    """CSVのバイト列を1回でデコードし、(テキスト, エンコーディング, 区切り文字) を返す
+
+    BOMの確認 → 前回の判定結果 → 先頭サンプルによる判定 の順で候補を絞り込むため、
+    通常はファイル全体のデコードは1回で済む。
+    """
+    last_error = None
+    for encoding in csv_encoding_candidates(raw[:ENCODING_SAMPLE_BYTES], encoding_hint):
+        try:
+            content = raw.decode(encoding)
+            break
+        except UnicodeDecodeError as decode_error:
+            # サンプル以降で失敗した場合のみ次の候補へ
+            last_error = decode_error
+    else:
+        raise last_error
+    
+    first_line = content.split('\n', 1)[0]
+    return content, encoding, detect_delimiter(first_line)
+
+def iter_dataset_rows(reader, filename=''):
+    """csv.DictReader の各行を正規化して順に返す（処理できない行は読み飛ばす）"""
+    count = 0
+    for row_num, row in enumerate(reader, 1):
+        try:
+            # フィールド名の前後の空白を除去
+            cleaned_row = {key.strip(): value.strip() if value else ''
+                           for key, value in row.items() if key is not None}
+
+            # 英語ヘッダー（number,question,answer）を統一フォーマットに変換
+            for english_key, japanese_key in [('number', '番号'), ('question', '質問'), ('answer', '回答')]:
+                if english_key in cleaned_row and japanese_key not in cleaned_row:
+                    cleaned_row[japanese_key] = cleaned_row.pop(english_key)
+
+            # 番号がない旧形式の場合はデフォルト値を設定
+            if '番号' not in cleaned_row:
+                cleaned_row['番号'] = count + 1
+
+            # 習熟度データがない旧形式の場合はデフォルト値を設定
+            if '正解数' not in cleaned_row:
+                cleaned_row['正解数'] = 0
+            if '総試行回数' not in cleaned_row:
+                cleaned_row['総試行回数'] = 0
+            if '習熟度スコア' not in cleaned_row:
+                cleaned_row['習熟度スコア'] = 0.0
+
+            # 数値型に変換
+            try:
+                cleaned_row['番号'] = int(cleaned_row['番号']) if cleaned_row['番号'] else count + 1
+                cleaned_row['正解数'] = int(cleaned_row['正解数']) if cleaned_row['正解数'] else 0
+                cleaned_row['総試行回数'] = int(cleaned_row['総試行回数']) if cleaned_row['総試行回数'] else 0
+                cleaned_row['習熟度スコア'] = float(cleaned_row['習熟度スコア']) if cleaned_row['習熟度スコア'] else 0.0
+            except (ValueError, TypeError) as conv_error:
+                print(f"Number conversion error in row {row_num}: {conv_error}")
+                cleaned_row['番号'] = count + 1
+                cleaned_row['正解数'] = 0
+                cleaned_row['総試行回数'] = 0
+                cleaned_row['習熟度スコア'] = 0.0
+
+        except Exception as row_error:
+            print(f"Error processing row {row_num}: {row_error}")
+            continue
+        
+        count += 1
+        yield cleaned_row
+
+def parse_dataset_rows(content, delimiter, filename=''):
+    """デコード済みのCSVテキストを解析して行データのリストを返す"""
+    data = []
+    try:
+        reader = csv.DictReader(io.StringIO(content), delimiter=delimiter)
+        for row in iter_dataset_rows(reader, filename):
+            data.append(row)
+    except Exception as e:
+        print(f"Error loading dataset {filename}: {e}")
+    
+    return data
+
+class CsvImportError(Exception):
+    """取り込めないCSVファイル（メッセージはそのまま利用者に表示する）"""
+
+def iter_decoded_lines(stream, encoding):
+    """バイトストリームを ENCODING_SAMPLE_BYTES ずつデコードし、改行を残したまま1行ずつ返す
+
+    TextIOWrapper(newline='') と同じく \r\n・\n・\r を行末とみなす。ストリームには read() だけを
+    要求する（Python 3.10 の SpooledTemporaryFile は readable() を持たないため）。
+    """
+    decoder = codecs.getincrementaldecoder(encoding)()
+    pending = ''
+    while True:
+        chunk = stream.read(ENCODING_SAMPLE_BYTES)
+        pieces = (pending + decoder.decode(chunk, final=not chunk)).splitlines(keepends=True)
+        if chunk and pieces:
+            # 最後の断片は次のチャンクに続く可能性がある（末尾の \r は \r\n の前半かもしれない）
+            pending = pieces.pop()
+        else:
+            pending = ''
+        line = ''
+        for piece in pieces:
+            # splitlines は \v や \u2028 などでも区切るため、\r・\n 以外の区切りはつなぎ直す
+            line += piece
+            if piece.endswith(('\n', '\r')):
+                yield line
+                line = ''
+        pending = line + pending
+        if not chunk:
+            if pending:
+                yield pending
+            return
+
+class CsvUpload:
+    """アップロードされたCSVを先頭から少しずつデコード・解析して正規化した行を返す
+
+    エンコーディングは先頭サンプルで判定し、1つのインクリメンタルデコーダーと
+    csvリーダーでファイル全体を1回だけ処理する。ヘッダーは最初の行で検証し、行数は
+    取り出しながら数える。サンプル以降でデコードに失敗した場合のみ、次の候補で読み直す。
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        sample = stream.read(ENCODING_SAMPLE_BYTES)
+        self._candidates = csv_encoding_candidates(sample)
+        self.encoding = self._candidates[0]
+        self.delimiter = None
+        self.row_count = 0
+
+    def next_encoding(self):
+        """次のエンコーディング候補に切り替える（候補がない場合はFalse）"""
+        position = self._candidates.index(self.encoding) + 1
+        if position >= len(self._candidates):
+            return False
+        self.encoding = self._candidates[position]
+        return True
+
+    def rows(self):
+        """正規化した行を順に返す（不正なファイルの場合は CsvImportError）"""
+        self.stream.seek(0)
+        self.row_count = 0
+        lines = iter_decoded_lines(self.stream, self.encoding)
+        first_line = next(lines, '')
+        self.delimiter = detect_delimiter(first_line)
+        reader = csv.DictReader(itertools.chain([first_line], lines), delimiter=self.delimiter)
+        
+        # ヘッダーを取得
+        if not reader.fieldnames:
+            raise CsvImportError('ヘッダー行が見つかりません。')
+        
+        # フィールド名を正規化（前後の空白を除去）してフォーマットを検証
+        header_fields = [field.strip() for field in reader.fieldnames]
+        has_question = '質問' in header_fields or 'question' in header_fields
+        has_answer = '回答' in header_fields or 'answer' in header_fields
+        if not (has_question and has_answer):
+            raise CsvImportError('無効なCSV形式です。"質問"と"回答"（または"question"と"answer"）の列が必要です。')
+        print(f"Header fields: {header_fields}")
+        
+        for row in iter_dataset_rows(reader):
+            self.row_count += 1
+            yield row
+        
+        # データ行の存在チェック
+        if self.row_count == 0:
+            raise CsvImportError('データ行が見つかりません。ヘッダー行のみのファイルです。')
+
+def import_save_encoding(encoding):
+    """取り込んだCSVを保存するエンコーディング
+
+    デコードできた文字はそのまま書き戻せるよう、Shift_JIS系のファイルは同じエンコーディングで保存する。
+    """
+    if encoding in ('utf-8', CANONICAL_ENCODING):
+        return CANONICAL_ENCODING
+    return encoding
+
+def import_csv_upload(filename, stream):
+    """アップロードされたCSVを保存先に取り込み、取り込んだ行数を返す
+
+    取り込みは保存先ごとに一時ファイル・トランザクション内で行うため、失敗した場合は既存の
+    データセットは変更されない。
+    """
+    upload = CsvUpload(stream)
+    while True:
+        try:
+            row_count = get_dataset_store().import_csv_rows(filename, upload.rows(),
+                                                            import_save_encoding(upload.encoding))
+        except UnicodeDecodeError:
+            if not upload.next_encoding():
+                raise
+            print(f"Retrying import of {filename} with {upload.encoding} encoding")
+            continue
+        delimiter_name = 'TAB' if upload.delimiter == '\t' else 'COMMA'
+        print(f"CSV import successful: {row_count} rows ({upload.encoding}, {delimiter_name})")
+        return row_count
+
+def parse_import_file(path, output_path):
+    """一括インポート用に1つのCSVファイルを解析・検証する（プロセスプールのワーカーで実行）
+
+    正規化した行は output_path にUTF-8のCSVとして書き出し、行数・エンコーディング・区切り文字だけを
+    返す（行データをプロセス間で受け渡さない）。取り込めない場合は 'error' にメッセージを入れる。
+    """
+    result = {'path': output_path, 'row_count': 0, 'encoding': None, 'delimiter': None, 'error': None}
+    try:
+        with open(path, 'rb') as f:
+            upload = CsvUpload(f)
+            while True:
+                try:
+                    # 読み直す場合は書き出しも最初からやり直す
+                    with open(output_path, 'w', encoding='utf-8', newline='') as output:
+                        writer = csv.DictWriter(output, fieldnames=DATASET_FIELDNAMES, extrasaction='ignore')
+                        writer.writeheader()
+                        writer.writerows(upload.rows())
+                    break
+                except UnicodeDecodeError:
+                    if not upload.next_encoding():
+                        raise
+        result['row_count'] = upload.row_count
+        result['encoding'] = upload.encoding
+        result['delimiter'] = 'TAB' if upload.delimiter == '\t' else 'COMMA'
+    except UnicodeDecodeError:
+        result['error'] = 'ファイルの文字エンコーディングが認識できません。'
+    except CsvImportError as e:
+        result['error'] = str(e)
+    except csv.Error as e:
+        result['error'] = f'CSVファイルの解析に失敗しました: {str(e)}'
+    except Exception as e:
+        result['error'] = f'ファイルの読み込みに失敗しました: {str(e)}'
+    return result
+
+def collect_import_sources(files, directory):
+    """アップロードされたCSV・ZIPからインポート対象を取り出して directory に書き出す
+
+    (データセット名, 元のファイル名, 書き出したパス) のリストと、対象外として除外した
+    ファイルの結果のリストを返す。ZIPはファイルごとに展開し、全体をメモリに読み込まない。
+    """
+    sources = []
+    rejected = []
+    total_bytes = 0
+    
+    def add_source(name, origin, fileobj, size):
+        nonlocal total_bytes
+        filename = os.path.basename(name.replace('\\', '/'))
+        if not filename.endswith('.csv') or filename.startswith('.'):
+            rejected.append(import_result(filename or name, origin, error='CSVファイルではありません。'))
+            return
+        if len(sources) >= IMPORT_MAX_FILES:
+            rejected.append(import_result(filename, origin,
+                                          error=f'一度にインポートできるのは{IMPORT_MAX_FILES}ファイルまでです。'))
+            return
+        if size is not None and total_bytes + size > IMPORT_MAX_TOTAL_BYTES:
+            rejected.append(import_result(filename, origin, error='ファイルの合計サイズが上限を超えています。'))
+            return
+        path = os.path.join(directory, f'{len(sources)}.csv')
+        written = 0
+        with open(path, 'wb') as out:
+            while True:
+                chunk = fileobj.read(1024 * 1024)
+                if not chunk:
+                    break
+                written += len(chunk)
+                if total_bytes + written > IMPORT_MAX_TOTAL_BYTES:
+                    break
+                out.write(chunk)
+        if total_bytes + written > IMPORT_MAX_TOTAL_BYTES:
+            os.remove(path)
+            rejected.append(import_result(filename, origin, error='ファイルの合計サイズが上限を超えています。'))
+            return
+        total_bytes += written
+        sources.append((filename, origin, path))
+    
+    for file in files:
+        if not file or not file.filename:
+            continue
+        if file.filename.lower().endswith('.zip'):
+            try:
+                with zipfile.ZipFile(file.stream) as archive:
+                    for info in archive.infolist():
+                        # フォルダやmacOSのメタデータは対象外
+                        if info.is_dir() or info.filename.startswith('__MACOSX/'):
+                            continue
+                        with archive.open(info) as member:
+                            add_source(info.filename, file.filename, member, info.file_size)
+            except (zipfile.BadZipFile, RuntimeError, NotImplementedError) as e:
+                rejected.append(import_result(file.filename, file.filename,
+                                              error=f'ZIPファイルを展開できません: {str(e)}'))
+        else:
+            add_source(file.filename, file.filename, file.stream, None)
+    
+    return sources, rejected
+
+def import_result(filename, origin, row_count=0, encoding=None, delimiter=None, error=None):
+    """一括インポートの1ファイル分の結果"""
+    return {
+        'filename': filename,
+        'source': origin,
+        'success': error is None,
+        'row_count': row_count,
+        'encoding': encoding,
+        'delimiter': delimiter,
+        'error': error
+    }
+
+def import_dataset_files(files, force_overwrite=False):
+    """複数のCSV（ZIP内のCSVを含む）をまとめてインポートし、ファイルごとの結果を返す
+
+    解析と検証はプロセスプールで並列に行い、ワーカーが書き出した正規化済みのCSVを
+    完了した順に1ファイルずつ保存する（全ファイルの行を同時にメモリに持たない）。
+    CSV保存先のカタログは最後に1回だけ書き出す。1ファイルの失敗は他のファイルの取り込みに影響しない。
+    """
+    store = get_dataset_store()
+    with tempfile.TemporaryDirectory(prefix='studycards_import_') as directory:
+        sources, rejected = collect_import_sources(files, directory)
+        results = [None] * len(sources)
+        
+        # 保存先の重複と既存データセットを解析前に除外
+        targets = []
+        seen = set()
+        for index, (filename, origin, path) in enumerate(sources):
+            if filename in seen:
+                results[index] = import_result(filename, origin, error='同じ名前のファイルが複数含まれています。')
+            elif store.exists(filename) and not force_overwrite:
+                results[index] = import_result(
+                    filename, origin,
+                    error=f'データセット "{filename[:-4]}" は既に存在します。上書きする場合はチェックボックスを選択してください。')
+            else:
+                targets.append((index, filename, origin, path))
+            seen.add(filename)
+        
+        def save_parsed(target, parsed):
+            """正規化済みのCSVを読みながら保存し、一時ファイルを削除"""
+            index, filename, origin, _ = target
+            if parsed['error']:
+                results[index] = import_result(filename, origin, error=parsed['error'])
+                return
+            try:
+                with open(parsed['path'], 'r', encoding='utf-8', newline='') as f:
+                    row_count = store.import_csv_rows(filename, iter_dataset_rows(csv.DictReader(f)),
+                                                      import_save_encoding(parsed['encoding']))
+                results[index] = import_result(filename, origin, row_count, parsed['encoding'], parsed['delimiter'])
+            except Exception as e:
+                print(f"Bulk import error for {filename}: {e}")
+                results[index] = import_result(filename, origin, error=f'保存に失敗しました: {str(e)}')
+            finally:
+                try:
+                    os.remove(parsed['path'])
+                except OSError:
+                    pass
+        
+        with dataset_catalog.batch():
+            if len(targets) > 1 and IMPORT_WORKERS > 1:
+                # 判定ジャーナルのスレッドやSQLite接続を子プロセスに引き継がないよう、spawnで起動
+                with ProcessPoolExecutor(max_workers=min(IMPORT_WORKERS, len(targets)),
+                                         mp_context=multiprocessing.get_context('spawn')) as executor:
+                    futures = {executor.submit(parse_import_file, target[3], target[3] + '.normalized'): target
+                               for target in targets}
+                    for future in as_completed(futures):
+                        save_parsed(futures[future], future.result())
+            else:
+                for target in targets:
+                    save_parsed(target, parse_import_file(target[3], target[3] + '.normalized'))
+    
+    results.extend(rejected)
+    imported = sum(1 for result in results if result['success'])
+    print(f"Bulk import: {imported}/{len(results)} files imported")
+    return results
+
+def with_item_ids(rows):
+    """IDがない・使えない文字を含む・重複している行に新しいIDを付与しながら順に返す"""
+    seen = set()
+    for row in rows:
+        item_id = row.get('ID')
+        if not is_valid_item_id(item_id) or item_id in seen:
+            item_id = generate_item_id()
+            while item_id in seen:
+                item_id = generate_item_id()
+            row['ID'] = item_id
+        seen.add(item_id)
+        yield row
+
+def read_dataset_file(filename, filepath):
+    """CSVファイルを解析して (行データ, ファイル情報) を返す（キャッシュを介さない）
+    
+    ファイルはバイト列として1回だけ読み込み、判定済みのエンコーディングで1回だけデコードする。
+    """
+    data = []
+    file_info = {'encoding': None, 'delimiter': None}
+    try:
+        with open(filepath, 'rb') as f:
+            raw = f.read()
+    except OSError as e:
+        print(f"Error loading dataset {filename}: {e}")
+        return data, file_info
+    
+    # 前回の判定結果（カタログに記録済み）を優先して試す
+    encoding_hint = dataset_catalog.get_format(filename)['encoding']
+    try:
+        content, encoding, delimiter = decode_csv_bytes(raw, encoding_hint)
+    except UnicodeDecodeError as decode_error:
+        print(f"Failed to decode {filename}: {decode_error}")
+        print(f"Failed to load any data from {filename}")
+        return data, file_info
+    
+    file_info = {'encoding': encoding, 'delimiter': delimiter}
+    delimiter_name = 'TAB' if delimiter == '\t' else 'COMMA'
+    print(f"Detected delimiter: {delimiter_name}, encoding: {encoding} for file {filename}")
+    
+    data = parse_dataset_rows(content, delimiter, filename)
+    print(f"Successfully loaded {len(data)} rows from {filename} with {encoding} encoding")
+    return data, file_info
+
+# 判定ジャーナル機能
+_journal_compactor = None
+_journal_compactor_guard = threading.Lock()
+_journal_compact_event = threading.Event()
+
+def journal_path(filename):
+    """データセットの判定ジャーナルファイルのパス"""
+    return os.path.join(DATASETS_DIR, f"{filename}.journal")
+
+def get_journal_size(filename):
+    """判定ジャーナルのバイト数（存在しない場合は0）"""
+    try:
+        return os.path.getsize(journal_path(filename))
+    except OSError:
+        return 0
+
+def read_journal(filename, offset=0):
+    """offset 以降のジャーナルを読み込み、([(問題ID, 正解かどうか)], 読み込み済み位置) を返す
+
+    書き込み途中の末尾行は読み飛ばし、次回に持ち越す。一括送信の記録行（@キー,時刻）は読み飛ばす。
+    """
+    try:
+        with open(journal_path(filename), 'rb') as f:
+            f.seek(offset)
+            chunk = f.read()
+    except OSError:
+        return [], offset
+    
+    complete = chunk.rfind(b'\n') + 1
+    judgments = []
+    for line in chunk[:complete].decode('ascii', errors='ignore').splitlines():
+        if line.startswith('@'):
+            continue
+        try:
+            item_id, is_correct = line.split(',')
+            judgments.append((item_id, is_correct == '1'))
+        except ValueError:
+            print(f"Invalid journal line in {filename}: {line!r}")
+    return judgments, offset + complete
+
+def apply_journal_to_rows(rows, judgments, id_index, row_indexes=()):
+    """判定を反映した新しい行リストを返す（変更した行のみコピーし、row_indexes の索引も更新）"""
+    if not judgments:
+        return rows
+    rows = list(rows)
+    for item_id, is_correct in judgments:
+        position = id_index.get(item_id)
+        if position is not None:
+            item = rows[position].copy()
+            apply_judgment_to_item(item, is_correct)
+            rows[position] = item
+            for row_index in row_indexes:
+                row_index.update(position, item)
+    return rows
+
+def read_journal_batch_keys(filename, since=0):
+    """ジャーナル内の一括送信の記録 {キー: 記録時刻} のうち since 以降のもの"""
+    try:
+        with open(journal_path(filename), 'rb') as f:
+            lines = f.read().decode('ascii', errors='ignore').splitlines()
+    except OSError:
+        return {}
+    batch_keys = {}
+    for line in lines:
+        if line.startswith('@'):
+            batch_key, _, recorded_at = line[1:].partition(',')
+            if recorded_at.isdigit() and int(recorded_at) >= since:
+                batch_keys[batch_key] = int(recorded_at)
+    return batch_keys
+
+def append_judgments(filename, judgments, batch_key=None):
+    """判定結果 [(問題ID, 正解かどうか)] をジャーナルに追記（CSVは書き換えない）
+
+    batch_key を指定した場合は判定と同じ書き込みでキーを記録し、同じキーで記録済みなら
+    追記しない。追記した場合はTrue、失敗時はFalse、記録済みの場合はNoneを返す。
+    """
+    if not judgments:
+        return True
+    
+    lines = ''.join(f"{item_id},{1 if is_correct else 0}\n"
+                    for item_id, is_correct in judgments)
+    try:
+        if batch_key is None:
+            # 追記同士は共有ロックで並行に行い、コンパクション（排他）とだけ競合させる
+            with dataset_lock(filename):
+                with open(journal_path(filename), 'a', encoding='ascii') as f:
+                    f.write(lines)
+                    journal_size = f.tell()
+        else:
+            # キーの確認と追記の間に同じキーの送信が割り込まないよう排他ロックで行う
+            with dataset_lock(filename, exclusive=True):
+                if batch_key in read_journal_batch_keys(filename):
+                    return None
+                with open(journal_path(filename), 'a', encoding='ascii') as f:
+                    f.write(f"@{batch_key},{int(time.time())}\n" + lines)
+                    journal_size = f.tell()
+    except (OSError, UnicodeError) as e:
+        print(f"Journal append error for {filename}: {e}")
+        return False
+    
+    ensure_journal_compactor()
+    # しきい値を超えたらバックグラウンドでのコンパクションを要求
+    if journal_size > JOURNAL_COMPACT_THRESHOLD:
+        _journal_compact_event.set()
+    return True
+
+def truncate_journal(filename, keep_batch_keys=False):
+    """ジャーナルを削除（CSVへの反映後に排他ロック下で呼び出す）
+
+    keep_batch_keys=True の場合、セッションの有効期間内の一括送信の記録だけを残し、
+    反映済みの一括送信が再送されても二重に記録しないようにする。
+    """
+    path = journal_path(filename)
+    batch_keys = read_journal_batch_keys(filename, time.time() - ONLINE_TEST_SESSION_TTL) if keep_batch_keys else {}
+    if batch_keys:
+        lines = [f"@{batch_key},{recorded_at}\n" for batch_key, recorded_at in batch_keys.items()]
+        atomic_write(path, 'ascii', lambda f: f.writelines(lines))
+        return
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def compact_journal(filename):
+    """ジャーナルの内容をCSVの習熟度列に畳み込む"""
+    with dataset_lock(filename, exclusive=True):
+        # 一括送信の記録行だけが残っている場合は畳み込むものがない
+        if not read_journal(filename)[0]:
+            return False
+        # load_csv_dataset はジャーナル反映済みの行を返し、save_csv_dataset がジャーナルを消去する
+        data = load_csv_dataset(filename)
+        if not data:
+            return False
+        return save_csv_dataset(filename, data)
+
+def compact_all_journals(min_size=1):
+    """min_size バイト以上のジャーナルを持つデータセットを全てコンパクション"""
+    if not os.path.isdir(DATASETS_DIR):
+        return 0
+    compacted = 0
+    for name in os.listdir(DATASETS_DIR):
+        if not name.endswith('.csv.journal'):
+            continue
+        filename = name[:-len('.journal')]
+        if get_journal_size(filename) >= min_size:
+            try:
+                if compact_journal(filename):
+                    compacted += 1
+            except Exception as e:
+                print(f"Journal compaction error for {filename}: {e}")
+    return compacted
+
+def run_journal_compactor():
+    """定期的、またはしきい値超過時にジャーナルをコンパクションするループ"""
+    while True:
+        triggered = _journal_compact_event.wait(JOURNAL_COMPACT_INTERVAL)
+        _journal_compact_event.clear()
+        # しきい値による起動時は大きいジャーナルのみ、定期実行時は全て対象
+        compact_all_journals(JOURNAL_COMPACT_THRESHOLD if triggered else 1)
+
+def ensure_journal_compactor():
+    """コンパクション用のバックグラウンドスレッドを起動（初回のみ）"""
+    global _journal_compactor
+    if _journal_compactor is not None and _journal_compactor.is_alive():
+        return
+    with _journal_compactor_guard:
+        if _journal_compactor is None or not _journal_compactor.is_alive():
+            _journal_compactor = threading.Thread(target=run_journal_compactor,
+                                                  name='journal-compactor', daemon=True)
+            _journal_compactor.start()
+
+def compute_text_signature(rows):
+    """問題ID・問題文・回答だけから計算する署名（習熟度の更新やCSVの書き直しでは変わらない）"""
+    digest = hashlib.blake2b(digest_size=16)
+    for row in rows:
+        digest.update(f"{row.get('ID', '')}\x1f{row.get('質問', '')}\x1f{row.get('回答', '')}\x1e".encode('utf-8'))
+    return digest.hexdigest()
+
+def save_csv_dataset(filename, data, fieldnames=None, encoding=None):
+    """データセットをCSVファイルに保存（習熟度データ含む）
+
+    encoding 省略時は、UTF-8に移行済みのファイルはUTF-8のまま、それ以外は
+    DATASET_DEFAULT_ENCODING（既定はShift_JIS）で保存する。
+    """
+    ensure_datasets_dir()
+    filepath = os.path.join(DATASETS_DIR, filename)
+    
+    # 拡張フォーマット: 番号,質問,回答,正解数,総試行回数,習熟度スコア,ID
+    if fieldnames is None:
+        fieldnames = DATASET_FIELDNAMES
+    
+    # データの習熟度フィールドを確保
+    enhanced_data = []
+    for i, item in enumerate(data):
+        enhanced_item = item.copy()
+        # 番号がない場合は自動設定
+        if '番号' not in enhanced_item:
+            enhanced_item['番号'] = i + 1
+        # 習熟度データがない場合はデフォルト値を設定
+        if '正解数' not in enhanced_item:
+            enhanced_item['正解数'] = 0
+        if '総試行回数' not in enhanced_item:
+            enhanced_item['総試行回数'] = 0
+        if '習熟度スコア' not in enhanced_item:
+            enhanced_item['習熟度スコア'] = 0.0
+        enhanced_data.append(enhanced_item)
+    # 永続IDがない行にはIDを付与
+    assign_item_ids(enhanced_data)
+    
+    def write_rows(f):
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(enhanced_data)
+    
+    # 排他ロック下で一時ファイルに書き込み、完成後に置き換える
+    with dataset_lock(filename, exclusive=True):
+        if encoding is None:
+            current_encoding = dataset_catalog.get_format(filename)['encoding']
+            if current_encoding in ('utf-8', CANONICAL_ENCODING):
+                encoding = CANONICAL_ENCODING
+            else:
+                encoding = DATASET_DEFAULT_ENCODING
+        
+        try:
+            # 指定エンコーディング（通常はShift_JIS）での保存を試行（エラー時はUTF-8で保存）
+            try:
+                atomic_write(filepath, encoding, write_rows)
+                print(f"Dataset saved successfully with {encoding} encoding: {filename}")
+            except UnicodeEncodeError as encode_error:
+                print(f"{encoding} encoding failed for {filename}: {encode_error}")
+                print("Saving with UTF-8 encoding instead...")
+                encoding = CANONICAL_ENCODING
+                atomic_write(filepath, encoding, write_rows)
+                print(f"Dataset saved successfully with UTF-8 encoding: {filename}")
+            
+            # 保存したデータには判定ジャーナルが反映済みのため消去
+            truncate_journal(filename, keep_batch_keys=True)
+            
+            # カタログと読み込み済みの検索インデックスを保存済みデータで更新（再解析は不要）
+            dataset_catalog.update(filename, enhanced_data, {'encoding': encoding, 'delimiter': ','})
+            search_indexes.refresh(filename, enhanced_data, compute_text_signature(enhanced_data))
+            return True
+        except Exception as e:
+            print(f"Error saving dataset {filename}: {e}")
+            return False
+        finally:
+            # 書き込みの成否に関わらず、キャッシュ上の旧データを破棄
+            dataset_cache.invalidate(filename)
+
+def migrate_dataset_encodings():
+    """Shift_JIS等の旧形式のデータセットを全てBOM付きUTF-8に変換（変換した件数を返す）"""
+    ensure_datasets_dir()
+    migrated = 0
+    for filename in sorted(os.listdir(DATASETS_DIR)):
+        if not filename.endswith('.csv'):
+            continue
+        with dataset_lock(filename, exclusive=True):
+            data, info = load_dataset_entry(filename)
+            if info['encoding'] in (None, 'utf-8', CANONICAL_ENCODING):
+                continue
+            if save_csv_dataset(filename, [row.copy() for row in data], encoding=CANONICAL_ENCODING):
+                print(f"Migrated {filename}: {info['encoding']} -> {CANONICAL_ENCODING}")
+                migrated += 1
+    return migrated
+
+@app.cli.command('migrate-encoding')
+def migrate_encoding_command():
+    """データセットをUTF-8に一括変換（flask --app app migrate-encoding）"""
+    migrated = migrate_dataset_encodings()
+    print(f"{migrated}件のデータセットをUTF-8に変換しました。")
+
+# 編集ページの問題一覧（items API）の1ページあたりの件数
+ITEMS_PAGE_SIZE = 100
+ITEMS_PAGE_MAX_LIMIT = 500
+
+# データセット保存先（ストア）
+DATASET_STORE = os.environ.get('DATASET_STORE', 'csv')  # 'csv' または 'sqlite'
+SQLITE_DB_FILENAME = 'study_cards.sqlite3'
+
+class DatasetStore(ABC):
+    """データセット保存先の共通インターフェース
+
+    行データは 番号,質問,回答,正解数,総試行回数,習熟度スコア,ID をキーとする辞書。
+    インポート・エクスポートはどの保存先でもCSV形式で行う。
+    """
+
+    @abstractmethod
+    def list_datasets(self):
+        """データセット一覧（名前順、統計情報付き）"""
+
+    @abstractmethod
+    def exists(self, filename):
+        pass
+
+    @abstractmethod
+    def load(self, filename, readonly=False):
+        """全行を番号順に読み込み（readonly=True の場合は変更しないこと）"""
+
+    @abstractmethod
+    def save(self, filename, data, encoding=None):
+        """データセット全体を置き換えて保存（成功時はTrue）"""
+
+    @abstractmethod
+    def delete(self, filename):
+        """データセットを削除（存在しない場合はFalse）"""
+
+    @abstractmethod
+    def import_csv_rows(self, filename, rows, encoding=None):
+        """正規化済みの行を順に取り込んでデータセットを置き換え、取り込んだ行数を返す
+
+        rows はイテレータで、途中で例外が発生した場合は既存のデータセットを変更しない。
+        encoding はCSVで保存する場合のエンコーディング（省略時はBOM付きUTF-8）。
+        """
+
+    @abstractmethod
+    def add_item(self, filename, question, answer):
+        """末尾に問題を追加（成功時はTrue）"""
+
+    @abstractmethod
+    def delete_item(self, filename, index):
+        """問題を削除して番号を振り直す（無効な位置の場合はNone）"""
+
+    @abstractmethod
+    def reset_mastery(self, filename, index=None):
+        """習熟度をリセット（index 省略時は全問題）。リセットした問題数、失敗時はNone"""
+
+    @abstractmethod
+    def apply_judgments(self, filename, judgments):
+        """[(行位置, 正解かどうか)] を反映し、更新した問題数を返す"""
+
+    @abstractmethod
+    def record_judgments(self, filename, judgments, batch_key=None):
+        """オンラインテストの判定 [(問題ID, 正解かどうか)] を記録（成功時はTrue）
+
+        batch_key を指定した場合、同じキーで記録済みなら何もせずTrueを返す（一括送信の再送用）。
+        """
+
+    @abstractmethod
+    def get_item(self, filename, item_id):
+        """IDから問題を取得（読み取り専用、見つからない場合はNone）"""
+
+    def get_weak_items(self, filename, threshold):
+        """習熟度が閾値未満の問題を番号順に取得（読み取り専用）"""
+        return get_weak_problems(self.load(filename, readonly=True), threshold)
+
+    def get_mastery_distribution(self, filename):
+        """習熟度分布を取得（get_mastery_distribution と同じ形式）"""
+        return get_mastery_distribution(self.load(filename, readonly=True))
+
+    def sample_weighted_items(self, filename, count, start=0, end=None, rng=None):
+        """行位置 start 以上 end 未満から count 問を習熟度に応じた重み付きで非復元抽出（読み取り専用）"""
+        return weighted_sample(self.load(filename, readonly=True)[start:end], count, rng)
+
+    def get_stats(self, filename):
+        """データセットの統計情報を取得"""
+        return get_dataset_stats(self.load(filename, readonly=True))
+
+    @abstractmethod
+    def get_text_signature(self, filename):
+        """問題文・回答の変更を検出するための署名（存在しない場合はNone）"""
+
+    def get_items_by_ids(self, filename, item_ids):
+        """IDの一覧から {ID: (行位置, 行データ)} を取得（読み取り専用）"""
+        rows, info = load_dataset_entry(filename)
+        found = {}
+        for item_id in item_ids:
+            position = info['id_index'].get(item_id)
+            if position is not None:
+                found[item_id] = (position, rows[position])
+        return found
+
+    def get_items_page(self, filename, offset, limit, sort='number', descending=False):
+        """並べ替えた問題の一部を取得し、(総数, [(行位置, 行データ)]) を返す（読み取り専用）
+
+        sort は 'number'（番号順）または 'mastery'（習熟度スコア順）。
+        """
+        data = self.load(filename, readonly=True)
+        if sort == 'mastery':
+            positions = sorted(range(len(data)), key=lambda i: (get_mastery_score(data[i]), i),
+                               reverse=descending)
+        else:
+            positions = range(len(data) - 1, -1, -1) if descending else range(len(data))
+        return len(data), [(i, data[i]) for i in positions[offset:offset + limit]]
+
+
+class CsvDatasetStore(DatasetStore):
+    """DATASETS_DIR 内のCSVファイルを使う保存先（既定）"""
+
+    def list_datasets(self):
+        ensure_datasets_dir()
+        entries = dataset_catalog.list_entries()
+        
+        # 日本語対応の名前順でソート（ソートキーはカタログに保存済み）
+        datasets = []
+        for filename, entry in sorted(entries.items(), key=lambda x: x[1]['sort_key']):
+            datasets.append({
+                'name': filename[:-4],  # .csvを除去
+                'filename': filename,
+                'path': os.path.join(DATASETS_DIR, filename),
+                'stats': entry['stats']
+            })
+        return datasets
+
+    def exists(self, filename):
+        return os.path.exists(os.path.join(DATASETS_DIR, filename))
+
+    def get_text_signature(self, filename):
+        # 読み込み時に計算した問題文・回答の署名（コンパクションなどの書き直しでは変わらない）
+        return load_dataset_entry(filename)[1]['text_signature']
+
+    def load(self, filename, readonly=False):
+        return load_csv_dataset(filename, readonly)
+
+    def save(self, filename, data, encoding=None):
+        return save_csv_dataset(filename, data, DATASET_FIELDNAMES, encoding)
+
+    def delete(self, filename):
+        filepath = os.path.join(DATASETS_DIR, filename)
+        if not os.path.exists(filepath):
+            return False
+        with dataset_lock(filename, exclusive=True):
+            os.remove(filepath)
+            truncate_journal(filename)
+            dataset_cache.invalidate(filename)
+        dataset_catalog.remove(filename)
+        search_indexes.drop(filename)
+        review_schedules.drop(filename)
+        return True
+
+    def import_csv_rows(self, filename, rows, encoding=None):
+        ensure_datasets_dir()
+        filepath = os.path.join(DATASETS_DIR, filename)
+        encoding = encoding or CANONICAL_ENCODING
+        written = {}
+        
+        def write_rows(f):
+            # 拡張フォーマットで書き出しながら統計情報を集計
+            writer = csv.DictWriter(f, fieldnames=DATASET_FIELDNAMES, extrasaction='ignore')
+            writer.writeheader()
+            def write_each():
+                for row in with_item_ids(rows):
+                    writer.writerow(row)
+                    yield row
+            written['stats'] = get_dataset_stats(write_each())
+        
+        # 一時ファイル経由で置き換え、書き込み中のファイルを他のワーカーに見せない
+        with dataset_lock(filename, exclusive=True):
+            atomic_write(filepath, encoding, write_rows)
+            # 上書きした場合は旧データの判定ジャーナルを破棄
+            truncate_journal(filename)
+            dataset_cache.invalidate(filename)
+            dataset_catalog.update(filename, None, {'encoding': encoding, 'delimiter': ','},
+                                   stats=written['stats'])
+        # 検索インデックスは次回の検索時に作り直し、復習予定は新しいデータで始め直す
+        search_indexes.drop(filename)
+        review_schedules.drop(filename)
+        return written['stats']['total_problems']
+
+    def add_item(self, filename, question, answer):
+        # 読み込みから保存までを排他ロック下で行い、同時更新による取りこぼしを防ぐ
+        with dataset_lock(filename, exclusive=True):
+            data = load_csv_dataset(filename)
+            
+            # 次の番号を計算
+            next_number = max([int(item.get('番号', 0)) for item in data], default=0) + 1
+            data.append({
+                '番号': next_number,
+                '質問': question,
+                '回答': answer,
+                '正解数': 0,
+                '総試行回数': 0,
+                '習熟度スコア': 0.0,
+                'ID': generate_item_id()
+            })
+            return save_csv_dataset(filename, data, DATASET_FIELDNAMES)
+
+    def delete_item(self, filename, index):
+        with dataset_lock(filename, exclusive=True):
+            data = load_csv_dataset(filename)
+            if not 0 <= index < len(data):
+                return None
+            
+            removed = data.pop(index)
+            
+            # 削除後、番号を振り直し
+            for i, item in enumerate(data):
+                item['番号'] = i + 1
+            
+            if not save_csv_dataset(filename, data, DATASET_FIELDNAMES):
+                return False
+        review_schedules.forget(filename, [removed.get('ID')])
+        return True
+
+    def reset_mastery(self, filename, index=None):
+        with dataset_lock(filename, exclusive=True):
+            data = load_csv_dataset(filename)
+            if index is None:
+                targets = data
+            elif 0 <= index < len(data):
+                targets = [data[index]]
+            else:
+                return 0
+            if not targets:
+                return 0
+            
+            # 習熟度データをリセット
+            for item in targets:
+                item['正解数'] = 0
+                item['総試行回数'] = 0
+                item['習熟度スコア'] = 0.0
+            
+            if not save_csv_dataset(filename, data, DATASET_FIELDNAMES):
+                return None
+        # 習熟度と一緒に復習予定もリセット
+        if index is None:
+            review_schedules.drop(filename)
+        else:
+            review_schedules.forget(filename, [targets[0].get('ID')])
+        return len(targets)
+
+    def apply_judgments(self, filename, judgments):
+        with dataset_lock(filename, exclusive=True):
+            data = load_csv_dataset(filename)
+            
+            reviewed = []
+            for question_index, is_correct in judgments:
+                if 0 <= question_index < len(data):
+                    apply_judgment_to_item(data[question_index], is_correct)
+                    reviewed.append((data[question_index].get('ID'), is_correct))
+            
+            if not reviewed:
+                return 0
+            
+            # データセットを保存
+            if not save_csv_dataset(filename, data, DATASET_FIELDNAMES):
+                return 0
+        review_schedules.record(filename, reviewed)
+        return len(reviewed)
+
+    def record_judgments(self, filename, judgments, batch_key=None):
+        # ジャーナルに追記し、CSVへはコンパクション時に反映
+        appended = append_judgments(filename, judgments, batch_key)
+        if appended is None:
+            return True  # 同じ batch_key で記録済み
+        if not appended:
+            return False
+        review_schedules.record(filename, judgments)
+        return True
+
+    def get_item(self, filename, item_id):
+        return get_item_by_id(filename, item_id)
+
+    def get_weak_items(self, filename, threshold):
+        # 習熟度の索引から該当する行位置だけを取り出す（スコアを変換し直さない）
+        rows, info = load_dataset_entry(filename)
+        positions = info['mastery_index'].positions_below(threshold)
+        if positions is None:
+            return get_weak_problems(rows, threshold)
+        return [rows[position] for position in positions]
+
+    def get_mastery_distribution(self, filename):
+        _, info = load_dataset_entry(filename)
+        return info['mastery_index'].distribution()
+
+    def sample_weighted_items(self, filename, count, start=0, end=None, rng=None):
+        # 判定のたびに差分更新している重みの木から抽出（全行の重みを計算し直さない）
+        rows, info = load_dataset_entry(filename)
+        return [rows[position] for position in info['weighted_sampler'].sample(count, rng, start, end)]
+
+
+def open_sqlite_connection(db_path):
+    """WALモードのSQLite接続を作成（複数プロセスからの同時アクセス用）"""
+    os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA foreign_keys=ON')
+    return conn
+
+
+class SqliteDatasetStore(DatasetStore):
+    """SQLite（WALモード）を使う保存先
+
+    1問の更新は行単位の UPDATE/INSERT で済み、習熟度スコアの索引で弱点問題を抽出する。
+    データセットごとの version 列でキャッシュを検証する。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS datasets (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0,
+            text_version INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS items (
+            dataset TEXT NOT NULL REFERENCES datasets(name) ON DELETE CASCADE,
+            id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            number INTEGER NOT NULL,
+            question TEXT NOT NULL DEFAULT '',
+            answer TEXT NOT NULL DEFAULT '',
+            correct INTEGER NOT NULL DEFAULT 0,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            score REAL NOT NULL DEFAULT 0.0,
+            PRIMARY KEY (dataset, id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_items_position ON items(dataset, position);
+        CREATE INDEX IF NOT EXISTS idx_items_score ON items(dataset, score);
+        CREATE TABLE IF NOT EXISTS judgment_batches (
+            dataset TEXT NOT NULL REFERENCES datasets(name) ON DELETE CASCADE,
+            batch_key TEXT NOT NULL,
+            recorded_at REAL NOT NULL,
+            PRIMARY KEY (dataset, batch_key)
+        );
+    """
+
+    COLUMNS = 'number, question, answer, correct, attempts, score, id'
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._cache = DatasetCache(DATASET_CACHE_MAX_ENTRIES, DATASET_CACHE_MAX_BYTES)
+
+    def _connect(self):
+        """スレッドごとの接続を取得（fork後は作り直す）"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        conn = open_sqlite_connection(self.db_path)
+        conn.executescript(self.SCHEMA)
+        # 以前のスキーマで作成されたデータベースには列を追加
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(datasets)')}
+        if 'text_version' not in columns:
+            conn.execute('ALTER TABLE datasets ADD COLUMN text_version INTEGER NOT NULL DEFAULT 0')
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _row_to_item(row):
+        return {
+            '番号': row[0],
+            '質問': row[1],
+            '回答': row[2],
+            '正解数': row[3],
+            '総試行回数': row[4],
+            '習熟度スコア': row[5],
+            'ID': row[6]
+        }
+
+    @staticmethod
+    def _bump_version(conn, filename, text_changed=False):
+        """変更のたびに version を、問題文・回答が変わった場合は text_version も進める"""
+        if text_changed:
+            conn.execute('UPDATE datasets SET version = version + 1, text_version = text_version + 1 '
+                         'WHERE name = ?', (filename,))
+        else:
+            conn.execute('UPDATE datasets SET version = version + 1 WHERE name = ?', (filename,))
+
+    def get_text_signature(self, filename):
+        row = self._connect().execute('SELECT text_version FROM datasets WHERE name = ?', (filename,)).fetchone()
+        return [row[0]] if row else None
+
+    def get_items_by_ids(self, filename, item_ids):
+        found = {}
+        item_ids = list(item_ids)
+        # SQLiteの変数上限を超えないよう分割して取得
+        for start in range(0, len(item_ids), 500):
+            chunk = item_ids[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            for row in self._connect().execute(
+                    f'SELECT position, {self.COLUMNS} FROM items WHERE dataset = ? AND id IN ({placeholders})',
+                    (filename, *chunk)):
+                item = self._row_to_item(row[1:])
+                found[item['ID']] = (row[0], item)
+        return found
+
+    def _version(self, conn, filename):
+        row = conn.execute('SELECT version FROM datasets WHERE name = ?', (filename,)).fetchone()
+        return row[0] if row else None
+
+    def _aggregate_stats(self, filename=None):
+        """get_dataset_stats と同じ統計情報をSQLで集計し、{データセット名: 統計} を返す"""
+        where, params = ('WHERE d.name = ?', (filename,)) if filename else ('', ())
+        rows = self._connect().execute(f"""
+            SELECT d.name, COUNT(i.id), COALESCE(SUM(i.correct), 0), COALESCE(SUM(i.attempts), 0),
+                   COALESCE(SUM(i.score), 0.0),
+                   COALESCE(SUM(i.score >= 0.8), 0),
+                   COALESCE(SUM(i.score >= 0.6 AND i.score < 0.8), 0),
+                   COALESCE(SUM(i.score > 0.0 AND i.score < 0.6), 0)
+            FROM datasets d LEFT JOIN items i ON i.dataset = d.name
+            {where}
+            GROUP BY d.name
+        """, params).fetchall()
+        
+        all_stats = {}
+        for name, total, correct, attempts, score_sum, mastered, learning, struggling in rows:
+            if total == 0:
+                all_stats[name] = get_dataset_stats([])
+                continue
+            untouched = total - mastered - learning - struggling
+            all_stats[name] = {
+                'total_problems': total,
+                'average_mastery': round(score_sum / total * 100, 1),
+                'total_attempts': attempts,
+                'total_correct': correct,
+                'mastered_problems': mastered,
+                'learning_problems': learning,
+                'struggling_problems': struggling,
+                'untouched_problems': untouched,
+                'attempted_problems': total - untouched,
+                'studied_problems': total - untouched
+            }
+        return all_stats
+
+    def list_datasets(self):
+        datasets = []
+        for name, stats in self._aggregate_stats().items():
+            datasets.append({
+                'name': name[:-4],
+                'filename': name,
+                'path': self.db_path,
+                'stats': stats
+            })
+        
+        # 日本語対応の名前順でソート
+        datasets.sort(key=lambda x: make_sort_key(x['name']))
+        return datasets
+
+    def exists(self, filename):
+        return self._version(self._connect(), filename) is not None
+
+    def _load_entry(self, filename):
+        """キャッシュを介して (全行, 付随情報) を取得（存在しない場合はNone）"""
+        conn = self._connect()
+        version = self._version(conn, filename)
+        if version is None:
+            return None
+        
+        entry = self._cache.get(filename, version)
+        if entry is None:
+            rows = [self._row_to_item(row) for row in conn.execute(
+                f'SELECT {self.COLUMNS} FROM items WHERE dataset = ? ORDER BY position', (filename,))]
+            info = {'id_index': build_id_index(rows), 'weighted_sampler': WeightedSampler(rows)}
+            # キャッシュの容量は行数から概算
+            self._cache.put(filename, version, rows, info, len(rows) * 200)
+            entry = (rows, info)
+        return entry
+
+    def load(self, filename, readonly=False):
+        entry = self._load_entry(filename)
+        if entry is None:
+            return []
+        rows = entry[0]
+        if readonly:
+            return rows
+        return [row.copy() for row in rows]
+
+    def sample_weighted_items(self, filename, count, start=0, end=None, rng=None):
+        # 重みの木はキャッシュした行と一緒に保持し、データが変わるまで作り直さない
+        entry = self._load_entry(filename)
+        if entry is None:
+            return []
+        rows, info = entry
+        return [rows[position] for position in info['weighted_sampler'].sample(count, rng, start, end)]
+
+    def _insert_rows(self, conn, filename, data):
+        assign_item_ids(data)
+        conn.executemany(
+            'INSERT INTO items (dataset, id, position, number, question, answer, correct, attempts, score) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [(filename, item['ID'], position, int(item.get('番号') or position + 1),
+              item.get('質問', ''), item.get('回答', ''), int(item.get('正解数') or 0),
+              int(item.get('総試行回数') or 0), float(item.get('習熟度スコア') or 0.0))
+             for position, item in enumerate(data)])
+
+    def save(self, filename, data, encoding=None):
+        data = [item.copy() for item in data]
+        try:
+            conn = self._connect()
+            with conn:
+                conn.execute('INSERT OR IGNORE INTO datasets (name) VALUES (?)', (filename,))
+                conn.execute('DELETE FROM items WHERE dataset = ?', (filename,))
+                self._insert_rows(conn, filename, data)
+                self._bump_version(conn, filename, text_changed=True)
+            search_indexes.refresh(filename, data, self.get_text_signature(filename))
+            return True
+        except (sqlite3.Error, ValueError) as e:
+            print(f"Error saving dataset {filename}: {e}")
+            return False
+
+    def delete(self, filename):
+        conn = self._connect()
+        with conn:
+            deleted = conn.execute('DELETE FROM datasets WHERE name = ?', (filename,)).rowcount
+        self._cache.invalidate(filename)
+        search_indexes.drop(filename)
+        review_schedules.drop(filename)
+        return deleted > 0
+
+    def import_csv_rows(self, filename, rows, encoding=None):
+        row_count = [0]
+        def values():
+            for position, item in enumerate(with_item_ids(rows)):
+                row_count[0] += 1
+                yield (filename, item['ID'], position, int(item.get('番号') or position + 1),
+                       item.get('質問', ''), item.get('回答', ''), int(item.get('正解数') or 0),
+                       int(item.get('総試行回数') or 0), float(item.get('習熟度スコア') or 0.0))
+        
+        # 1つのトランザクションで置き換え、途中で失敗した場合はロールバック
+        conn = self._connect()
+        with conn:
+            conn.execute('INSERT OR IGNORE INTO datasets (name) VALUES (?)', (filename,))
+            conn.execute('DELETE FROM items WHERE dataset = ?', (filename,))
+            conn.executemany(
+                'INSERT INTO items (dataset, id, position, number, question, answer, correct, attempts, score) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', values())
+            self._bump_version(conn, filename, text_changed=True)
+        search_indexes.drop(filename)
+        review_schedules.drop(filename)
+        return row_count[0]
+
+    def add_item(self, filename, question, answer):
+        try:
+            conn = self._connect()
+            with conn:
+                conn.execute('INSERT OR IGNORE INTO datasets (name) VALUES (?)', (filename,))
+                before = self.get_text_signature(filename)
+                position, number = conn.execute(
+                    'SELECT COUNT(*), COALESCE(MAX(number), 0) + 1 FROM items WHERE dataset = ?',
+                    (filename,)).fetchone()
+                item_id = generate_item_id()
+                conn.execute(
+                    'INSERT INTO items (dataset, id, position, number, question, answer) VALUES (?, ?, ?, ?, ?, ?)',
+                    (filename, item_id, position, number, question, answer))
+                self._bump_version(conn, filename, text_changed=True)
+                after = self.get_text_signature(filename)
+            # 検索インデックスは1件分だけ更新
+            search_indexes.apply(filename, before, after, lambda search_index: search_index.add(item_id, question, answer))
+            return True
+        except sqlite3.Error as e:
+            print(f"Error adding item to {filename}: {e}")
+            return False
+
+    def delete_item(self, filename, index):
+        try:
+            conn = self._connect()
+            with conn:
+                before = self.get_text_signature(filename)
+                row = conn.execute('SELECT id FROM items WHERE dataset = ? AND position = ?',
+                                   (filename, index)).fetchone()
+                if row is None:
+                    return None
+                conn.execute('DELETE FROM items WHERE dataset = ? AND id = ?', (filename, row[0]))
+                # 削除後、位置と番号を振り直し
+                conn.execute('UPDATE items SET position = position - 1 WHERE dataset = ? AND position > ?',
+                             (filename, index))
+                conn.execute('UPDATE items SET number = position + 1 WHERE dataset = ?', (filename,))
+                self._bump_version(conn, filename, text_changed=True)
+                after = self.get_text_signature(filename)
+            search_indexes.apply(filename, before, after, lambda search_index: search_index.remove(row[0]))
+            review_schedules.forget(filename, [row[0]])
+            return True
+        except sqlite3.Error as e:
+            print(f"Error deleting item from {filename}: {e}")
+            return False
+
+    def reset_mastery(self, filename, index=None):
+        try:
+            conn = self._connect()
+            with conn:
+                if index is None:
+                    count = conn.execute(
+                        'UPDATE items SET correct = 0, attempts = 0, score = 0.0 WHERE dataset = ?',
+                        (filename,)).rowcount
+                else:
+                    count = conn.execute(
+                        'UPDATE items SET correct = 0, attempts = 0, score = 0.0 WHERE dataset = ? AND position = ?',
+                        (filename, index)).rowcount
+                self._bump_version(conn, filename)
+            # 習熟度と一緒に復習予定もリセット
+            if index is None:
+                review_schedules.drop(filename)
+            elif count:
+                review_schedules.forget(filename, self._ids_at_positions(filename, [index]).values())
+            return count
+        except sqlite3.Error as e:
+            print(f"Error resetting mastery in {filename}: {e}")
+            return None
+
+    def _update_proficiency(self, filename, where, judgments, batch_key=None):
+        """判定結果を行単位の UPDATE で反映し、更新した問題数を返す
+
+        batch_key は判定と同じトランザクションで記録し、記録済みの場合は何もせずNoneを返す。
+        """
+        try:
+            conn = self._connect()
+            updated_count = 0
+            with conn:
+                if batch_key is not None:
+                    conn.execute('DELETE FROM judgment_batches WHERE dataset = ? AND recorded_at < ?',
+                                 (filename, time.time() - ONLINE_TEST_SESSION_TTL))
+                    if not conn.execute(
+                            'INSERT OR IGNORE INTO judgment_batches (dataset, batch_key, recorded_at) VALUES (?, ?, ?)',
+                            (filename, batch_key, time.time())).rowcount:
+                        return None
+                for key, is_correct in judgments:
+                    correct_delta = 1 if is_correct else 0
+                    updated_count += conn.execute(
+                        'UPDATE items SET attempts = attempts + 1, correct = correct + ?, '
+                        'score = ROUND(CAST(correct + ? AS REAL) / (attempts + 1), 3) '
+                        f'WHERE dataset = ? AND {where} = ?',
+                        (correct_delta, correct_delta, filename, key)).rowcount
+                if updated_count:
+                    self._bump_version(conn, filename)
+            return updated_count
+        except sqlite3.Error as e:
+            print(f"Error updating proficiency in {filename}: {e}")
+            return 0
+
+    def _ids_at_positions(self, filename, positions):
+        """行位置 → 問題ID"""
+        positions = list(positions)
+        placeholders = ','.join('?' * len(positions))
+        return dict(self._connect().execute(
+            f'SELECT position, id FROM items WHERE dataset = ? AND position IN ({placeholders})',
+            [filename] + positions).fetchall()) if positions else {}
+
+    def apply_judgments(self, filename, judgments):
+        updated_count = self._update_proficiency(filename, 'position', judgments)
+        if updated_count:
+            ids = self._ids_at_positions(filename, {position for position, _ in judgments})
+            review_schedules.record(filename, [(ids[position], is_correct) for position, is_correct in judgments
+                                               if position in ids])
+        return updated_count
+
+    def record_judgments(self, filename, judgments, batch_key=None):
+        updated_count = self._update_proficiency(filename, 'id', judgments, batch_key)
+        if updated_count is None:
+            return True  # 同じ batch_key で記録済み
+        if updated_count > 0:
+            review_schedules.record(filename, judgments)
+            return True
+        return not judgments
+
+    def get_item(self, filename, item_id):
+        row = self._connect().execute(
+            f'SELECT {self.COLUMNS} FROM items WHERE dataset = ? AND id = ?', (filename, item_id)).fetchone()
+        return self._row_to_item(row) if row else None
+
+    def get_weak_items(self, filename, threshold):
+        # 習熟度スコアの索引で絞り込み、番号順に並べ替える
+        return [self._row_to_item(row) for row in self._connect().execute(
+            f'SELECT {self.COLUMNS} FROM items WHERE dataset = ? AND score < ? ORDER BY position',
+            (filename, threshold))]
+
+    def get_stats(self, filename):
+        return self._aggregate_stats(filename).get(filename) or get_dataset_stats([])
+
+    def get_mastery_distribution(self, filename):
+        total, untouched, weak, moderate = self._connect().execute(
+            'SELECT COUNT(*), COALESCE(SUM(score < 0.6 AND attempts = 0), 0), '
+            'COALESCE(SUM(score < 0.6), 0), COALESCE(SUM(score >= 0.6 AND score < 0.8), 0) '
+            'FROM items WHERE dataset = ?', (filename,)).fetchone()
+        return {
+            'weak': weak,
+            'moderate': moderate,
+            'strong': total - weak - moderate,
+            'total': total,
+            'untouched': untouched
+        }
+
+    def get_items_page(self, filename, offset, limit, sort='number', descending=False):
+        # 索引に沿って必要な範囲だけを読み込む
+        conn = self._connect()
+        total = conn.execute('SELECT COUNT(*) FROM items WHERE dataset = ?', (filename,)).fetchone()[0]
+        direction = 'DESC' if descending else 'ASC'
+        order = f'score {direction}, position' if sort == 'mastery' else f'position {direction}'
+        rows = conn.execute(
+            f'SELECT position, {self.COLUMNS} FROM items WHERE dataset = ? ORDER BY {order} LIMIT ? OFFSET ?',
+            (filename, limit, offset)).fetchall()
+        return total, [(row[0], self._row_to_item(row[1:])) for row in rows]
+
+
+# 全文検索（問題文・回答の文字n-gram転置インデックス）
+SEARCH_INDEX_SUFFIX = '.search.json'
+SEARCH_RESULT_LIMIT = 50
+SEARCH_VERIFY_CANDIDATES = 64  # この件数以下になれば本文の照合に切り替える
+
+def normalize_search_text(text):
+    """検索用に正規化（全角・半角の統一、大文字・小文字の同一視）"""
+    return unicodedata.normalize('NFKC', str(text or '')).casefold()
+
+def search_grams(text):
+    """1〜3文字のn-gramの集合（分かち書き不要で日本語にも対応）"""
+    grams = set(text)
+    grams.update(text[i:i + 2] for i in range(len(text) - 1))
+    grams.update(text[i:i + 3] for i in range(len(text) - 2))
+    return grams
+
+def query_grams(query):
+    """検索語の照合に使うn-gram（3文字以上の検索語はトライグラムで絞り込む）"""
+    size = min(len(query), 3)
+    return {query[i:i + size] for i in range(len(query) - size + 1)}
+
+def match_score(text, query):
+    """完全一致 3、前方一致 2、部分一致 1、不一致 0"""
+    if text == query:
+        return 3
+    if text.startswith(query):
+        return 2
+    return 1 if query in text else 0
+
+class SearchIndex:
+    """1データセット分のn-gram転置インデックス
+
+    文書は追加順の番号で管理し、削除は墓標（None）として残す。
+    signature はインデックス作成元のデータ（get_text_signature）と照合する。
+    """
+
+    VERSION = 1
+
+    def __init__(self, signature=None):
+        self.signature = signature
+        self.docs = []       # 文書番号 → [ID, 正規化した質問, 正規化した回答]
+        self.doc_ids = {}    # ID → 文書番号
+        self.postings = {}   # n-gram → 文書番号の集合
+        self.dirty = False
+        self.lock = threading.Lock()  # 検索と更新の排他（データセットごと）
+
+    def _add_normalized(self, item_id, question, answer):
+        if item_id in self.doc_ids:
+            self.remove(item_id)
+        doc = len(self.docs)
+        self.docs.append([item_id, question, answer])
+        self.doc_ids[item_id] = doc
+        postings_map = self.postings
+        for gram in search_grams(question) | search_grams(answer):
+            postings = postings_map.get(gram)
+            if postings is None:
+                postings_map[gram] = {doc}
+            else:
+                postings.add(doc)
+        self.dirty = True
+
+    def add(self, item_id, question, answer):
+        self._add_normalized(item_id, normalize_search_text(question), normalize_search_text(answer))
+
+    def remove(self, item_id):
+        doc = self.doc_ids.pop(item_id, None)
+        if doc is None:
+            return
+        _, question, answer = self.docs[doc]
+        self.docs[doc] = None
+        for gram in search_grams(question) | search_grams(answer):
+            postings = self.postings.get(gram)
+            if postings is not None:
+                postings.discard(doc)
+                if not postings:
+                    del self.postings[gram]
+        self.dirty = True
+
+    def sync(self, rows, signature):
+        """現在の行データとの差分（追加・変更・削除された問題）だけを反映"""
+        seen = set()
+        for item in rows:
+            item_id = item.get('ID')
+            if not item_id:
+                continue
+            seen.add(item_id)
+            question = normalize_search_text(item.get('質問', ''))
+            answer = normalize_search_text(item.get('回答', ''))
+            doc = self.doc_ids.get(item_id)
+            if doc is None or self.docs[doc][1] != question or self.docs[doc][2] != answer:
+                self._add_normalized(item_id, question, answer)
+        for item_id in [item_id for item_id in self.doc_ids if item_id not in seen]:
+            self.remove(item_id)
+        
+        # 墓標が増えすぎた場合は詰め直す
+        if len(self.docs) > 2 * len(self.doc_ids) + 1024:
+            live = [doc for doc in self.docs if doc is not None]
+            self.docs, self.doc_ids, self.postings = [], {}, {}
+            for item_id, question, answer in live:
+                self._add_normalized(item_id, question, answer)
+        
+        if signature != self.signature:
+            self.signature = signature
+            self.dirty = True
+
+    def search(self, query, limit=SEARCH_RESULT_LIMIT):
+        """(一致件数, [(ID, スコア)]) を返す（質問の一致を回答の一致より優先）"""
+        query = normalize_search_text(query).strip()
+        if not query:
+            return 0, []
+        
+        # 件数の少ないn-gramから順に積集合を取り、候補を十分に絞り込めたら打ち切る
+        postings_lists = []
+        for gram in query_grams(query):
+            postings = self.postings.get(gram)
+            if not postings:
+                return 0, []
+            postings_lists.append(postings)
+        postings_lists.sort(key=len)
+        candidates = postings_lists[0]
+        for postings in postings_lists[1:]:
+            if len(candidates) <= SEARCH_VERIFY_CANDIDATES:
+                break
+            candidates = candidates & postings
+        
+        # n-gramの一致だけでは部分文字列とは限らないため、本文で確認して採点
+        scored = []
+        for doc in candidates:
+            _, question, answer = self.docs[doc]
+            score = match_score(question, query) * 2 + match_score(answer, query)
+            if score:
+                scored.append((-score, doc))
+        top = heapq.nsmallest(limit, scored)
+        return len(scored), [(self.docs[doc][0], -negative_score) for negative_score, doc in top]
+
+    def to_json(self):
+        return {
+            'version': self.VERSION,
+            'signature': self.signature,
+            'docs': self.docs,
+            'postings': {gram: sorted(docs) for gram, docs in self.postings.items()}
+        }
+
+    @classmethod
+    def from_json(cls, payload):
+        if payload.get('version') != cls.VERSION:
+            return None
+        index = cls(payload.get('signature'))
+        index.docs = payload['docs']
+        index.doc_ids = {doc[0]: position for position, doc in enumerate(index.docs) if doc is not None}
+        index.postings = {gram: set(docs) for gram, docs in payload['postings'].items()}
+        return index
+
+
+class SearchIndexRegistry:
+    """データセットごとの検索インデックスを初回検索時に作成し、CSVの隣に保存する
+
+    差分更新したインデックスは終了時（atexit）にまとめて保存する。保存前に
+    プロセスが終了しても、次回読み込み時に署名の不一致から差分を反映する。
+    レジストリのロックは一覧の操作だけに使い、検索・更新は各インデックスのロックで行う。
+    """
+
+    def __init__(self):
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def index_path(filename):
+        return os.path.join(DATASETS_DIR, filename + SEARCH_INDEX_SUFFIX)
+
+    def _read(self, filename):
+        try:
+            with open(self.index_path(filename), 'r', encoding='utf-8') as f:
+                return SearchIndex.from_json(json.load(f))
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def _write(self, filename, index):
+        try:
+            atomic_write(self.index_path(filename), 'utf-8',
+                         lambda f: json.dump(index.to_json(), f, ensure_ascii=False, separators=(',', ':')))
+            index.dirty = False
+        except OSError as e:
+            print(f"Error saving search index for {filename}: {e}")
+
+    def _loaded(self, filename):
+        """読み込み済み（なければファイルから読み込んだ）インデックス"""
+        with self._lock:
+            index = self._indexes.get(filename)
+            if index is None:
+                index = self._indexes[filename] = self._read(filename) or SearchIndex()
+            return index
+
+    def get(self, filename):
+        """最新のデータに追従した検索インデックスを取得"""
+        store = get_dataset_store()
+        signature = store.get_text_signature(filename)
+        index = self._loaded(filename)
+        if index.signature == signature:
+            return index
+        
+        # 読み込みはロック外で行う（データセットのロック → インデックスのロック の順序を守る）
+        rows = store.load(filename, readonly=True)
+        with index.lock:
+            if index.signature != signature:
+                index.sync(rows, signature)
+                self._write(filename, index)
+        return index
+
+    def search(self, filename, query, limit=SEARCH_RESULT_LIMIT):
+        """検索して (一致件数, [(ID, スコア)]) を返す（他のデータセットの検索・更新を待たない）"""
+        index = self.get(filename)
+        with index.lock:
+            return index.search(query, limit)
+
+    def refresh(self, filename, rows, signature):
+        """保存したデータで読み込み済みのインデックスを差分更新（問題文・回答が同じなら何もしない）"""
+        with self._lock:
+            index = self._indexes.get(filename)
+        if index is not None and index.signature != signature:
+            with index.lock:
+                index.sync(rows, signature)
+
+    def apply(self, filename, before, after, change):
+        """1件単位の更新を反映（インデックスが更新前の状態と一致する場合のみ）"""
+        with self._lock:
+            index = self._indexes.get(filename)
+        if index is not None:
+            with index.lock:
+                if index.signature == before:
+                    change(index)
+                    index.signature = after
+
+    def drop(self, filename):
+        with self._lock:
+            self._indexes.pop(filename, None)
+            try:
+                os.remove(self.index_path(filename))
+            except FileNotFoundError:
+                pass
+
+    def flush(self):
+        """差分更新したインデックスを保存"""
+        with self._lock:
+            indexes = list(self._indexes.items())
+        for filename, index in indexes:
+            with index.lock:
+                if index.dirty:
+                    self._write(filename, index)
+
+search_indexes = SearchIndexRegistry()
+atexit.register(search_indexes.flush)
+
+
+# 間隔反復（SM-2方式）の復習スケジュール
+REVIEW_SCHEDULE_SUFFIX = '.schedule'
+REVIEW_INITIAL_EASE = 2.5
+REVIEW_MIN_EASE = 1.3
+REVIEW_SCHEDULE_COMPACT_LINES = 4096  # 現在の問題数よりこの行数以上多くなれば書き直す
+
+def next_review_state(state, is_correct, now):
+    """SM-2方式で次の復習予定を計算し、(間隔日数, 容易度, 連続正解数, 次回復習時刻) を返す
+
+    判定は正解・不正解の2値のため、SM-2の品質は正解を4、不正解を2として容易度を更新する。
+    不正解の場合は連続正解数を0に戻して翌日に復習する（Leitner方式で最初の箱に戻すのと同じ）。
+    """
+    interval, ease, streak = state[:3] if state else (0, REVIEW_INITIAL_EASE, 0)
+    quality = 4 if is_correct else 2
+    if is_correct:
+        streak += 1
+        interval = 1 if streak == 1 else 6 if streak == 2 else max(1, round(interval * ease))
+    else:
+        streak = 0
+        interval = 1
+    ease = max(REVIEW_MIN_EASE, round(ease + 0.1 - (5 - quality) * (0.08 + (5 - quality) * 0.02), 2))
+    return interval, ease, streak, int(now + interval * 86400)
+
+def end_of_today():
+    """今日の終わり（翌日0時）の時刻"""
+    tomorrow = datetime.now().date() + timedelta(days=1)
+    return datetime.combine(tomorrow, datetime.min.time()).timestamp()
+
+class ReviewSchedule:
+    """1データセット分の復習予定（問題ID → 状態）と、次回復習時刻の最小ヒープ
+
+    更新のたびにヒープへ (次回復習時刻, ID) を追加し、古くなった要素は状態と照合して
+    読み飛ばす（遅延削除）。古い要素が増えすぎた場合は現在の状態から作り直す。
+    """
+
+    def __init__(self, generation=None):
+        self.generation = generation  # 読み込んだファイルの先頭行（書き直すたびに変わる）
+        self.offset = 0
+        self.lines = 0
+        self.states = {}  # ID → (間隔日数, 容易度, 連続正解数, 次回復習時刻)
+        self.heap = []
+
+    def apply(self, item_id, state):
+        """1行分の更新を反映（state が None の場合は予定を削除）"""
+        self.lines += 1
+        if state is None:
+            self.states.pop(item_id, None)
+            return
+        self.states[item_id] = state
+        heapq.heappush(self.heap, (state[3], item_id))
+        if len(self.heap) > 2 * len(self.states) + 1024:
+            self.heap = [(state[3], item_id) for item_id, state in self.states.items()]
+            heapq.heapify(self.heap)
+
+    def iter_due(self, before):
+        """次回復習時刻が before より前の問題IDを時刻順に返す
+
+        ヒープを配列のまま、before より前の要素だけを小さい順にたどるため、k件で O(k log k)。
+        """
+        heap = self.heap
+        frontier = [(heap[0][0], 0)] if heap else []
+        seen = set()
+        while frontier:
+            due, position = heapq.heappop(frontier)
+            if due >= before:
+                return
+            item_id = heap[position][1]
+            state = self.states.get(item_id)
+            if state is not None and state[3] == due and item_id not in seen:
+                seen.add(item_id)
+                yield item_id
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < len(heap):
+                    heapq.heappush(frontier, (heap[child][0], child))
+
+
+class ReviewScheduleRegistry:
+    """データセットごとの復習予定を追記型のファイル（<CSV名>.schedule）で共有する
 
-def get_mastery_distribution(data):
-    """習熟度分布を取得（UI表示用）"""
-    total_problems = len(data)
-    if total_problems == 0:
-        return {'weak': 0, 'moderate': 0, 'strong': 0, 'total': 0}
-    
-    weak_count = 0
-    moderate_count = 0
-    strong_count = 0
-    
-    for item in data:
-        try:
-            mastery_score = float(item.get('習熟度スコア', 0.0) or 0.0)
-            if mastery_score < 0.6:
-                weak_count += 1
-            elif mastery_score < 0.8:
-                moderate_count += 1
-            else:
-                strong_count += 1
-        except (ValueError, TypeError):
-            # 習熟度スコアが不正な場合は弱点問題として扱う
-            weak_count += 1
-    
-    return {
-        'weak': weak_count,
-        'moderate': moderate_count,
-        'strong': strong_count,
-        'total': total_problems
-    }
+    更新は1問1行で追記し、各プロセスは前回の読み込み位置から追記分だけを反映する。判定の記録は
+    直前の状態に依存するため排他ロック、削除の追記は共有ロックで行う。行数が増えすぎた場合は
+    現在の状態だけを書き直す（排他ロック）。
+    CSVの行とは別に保存するため、復習予定の件数はCSVを読み込まずに数えられる。
+    """
 
-def load_dataset(filename):
-    """CSVファイルからデータセットを読み込み（習熟度データ対応）"""
-    filepath = os.path.join(DATASETS_DIR, filename)
-    data = []
-    if os.path.exists(filepath):
-        # エンコーディングを試行する順序
-        encodings = ['shift_jis', 'utf-8', 'cp932']
+    def __init__(self):
+        self._schedules = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def schedule_path(filename):
+        return os.path.join(DATASETS_DIR, filename + REVIEW_SCHEDULE_SUFFIX)
+
+    def _sync(self, filename):
+        """ファイルの追記分を反映した復習予定を返す（self._lock を保持して呼び出す）"""
+        path = self.schedule_path(filename)
+        try:
+            with open(path, 'rb') as f:
+                generation = f.readline()
+                size = os.fstat(f.fileno()).st_size
+                schedule = self._schedules.get(path)
+                if schedule is None or schedule.generation != generation or size < schedule.offset:
+                    # 初回、または他のプロセスが書き直した場合は最初から読み込む
+                    schedule = self._schedules[path] = ReviewSchedule(generation)
+                    schedule.offset = len(generation)
+                if size == schedule.offset:
+                    return schedule
+                f.seek(schedule.offset)
+                chunk = f.read()
+        except OSError:
+            schedule = self._schedules[path] = ReviewSchedule()
+            return schedule
         
-        for encoding in encodings:
+        # 書き込み途中の末尾行は次回に持ち越す
+        complete = chunk.rfind(b'\n') + 1
+        for line in chunk[:complete].decode('ascii', errors='ignore').splitlines():
+            fields = line.split(',')
             try:
-                with open(filepath, 'r', encoding=encoding) as f:
-                    # ファイルの最初の行を読んでCSVかTSVかを判定
-                    first_line = f.readline()
-                    f.seek(0)  # ファイルポインタを先頭に戻す
-                    
-                    # タブかカンマで区切られているかを判定
-                    delimiter = '\t' if '\t' in first_line and ',' not in first_line else ','
-                    delimiter_name = 'TAB' if delimiter == '\t' else 'COMMA'
-                    print(f"Detected delimiter: {delimiter_name} for file {filename}")
-                    
-                    reader = csv.DictReader(f, delimiter=delimiter)
-                    
-                    for row_num, row in enumerate(reader, 1):
-                        try:
-                            # フィールド名の前後の空白を除去
-                            cleaned_row = {key.strip(): value.strip() if value else '' for key, value in row.items()}
-                            
-                            # 番号がない旧形式の場合はデフォルト値を設定
-                            if '番号' not in cleaned_row:
-                                cleaned_row['番号'] = len(data) + 1
-                            
-                            # 習熟度データがない旧形式の場合はデフォルト値を設定
-                            if '正解数' not in cleaned_row:
-                                cleaned_row['正解数'] = 0
-                            if '総試行回数' not in cleaned_row:
-                                cleaned_row['総試行回数'] = 0
-                            if '習熟度スコア' not in cleaned_row:
-                                cleaned_row['習熟度スコア'] = 0.0
-                            
-                            # 数値型に変換
-                            try:
-                                cleaned_row['番号'] = int(cleaned_row['番号']) if cleaned_row['番号'] else len(data) + 1
-                                cleaned_row['正解数'] = int(cleaned_row['正解数']) if cleaned_row['正解数'] else 0
-                                cleaned_row['総試行回数'] = int(cleaned_row['総試行回数']) if cleaned_row['総試行回数'] else 0
-                                cleaned_row['習熟度スコア'] = float(cleaned_row['習熟度スコア']) if cleaned_row['習熟度スコア'] else 0.0
-                            except (ValueError, TypeError) as conv_error:
-                                print(f"Number conversion error in row {row_num}: {conv_error}")
-                                cleaned_row['番号'] = len(data) + 1
-                                cleaned_row['正解数'] = 0
-                                cleaned_row['総試行回数'] = 0
-                                cleaned_row['習熟度スコア'] = 0.0
-                            
-                            data.append(cleaned_row)
-                            
-                        except Exception as row_error:
-                            print(f"Error processing row {row_num}: {row_error}")
-                            continue
-                    
-                    print(f"Successfully loaded {len(data)} rows from {filename} with {encoding} encoding")
-                    break  # 成功したらループを抜ける
-                    
-            except UnicodeDecodeError as decode_error:
-                print(f"Failed to decode {filename} with {encoding}: {decode_error}")
-                continue
-            except Exception as e:
-                print(f"Error loading dataset {filename} with {encoding}: {e}")
-                continue
-        
-        if not data:
-            print(f"Failed to load any data from {filename}")
-    
-    return data
+                if len(fields) == 2 and fields[1] == '-':
+                    schedule.apply(fields[0], None)
+                elif not line.startswith('#'):
+                    item_id, interval, ease, streak, due = fields
+                    schedule.apply(item_id, (int(interval), float(ease), int(streak), int(due)))
+            except ValueError:
+                print(f"Invalid schedule line in {filename}: {line!r}")
+        schedule.offset += complete
+        return schedule
 
-def save_dataset(filename, data, fieldnames=None):
-    """データセットをCSVファイルに保存（習熟度データ含む）"""
-    ensure_datasets_dir()
-    filepath = os.path.join(DATASETS_DIR, filename)
-    
-    # 拡張フォーマット: 番号,質問,回答,正解数,総試行回数,習熟度スコア
-    if fieldnames is None:
-        fieldnames = ['番号', '質問', '回答', '正解数', '総試行回数', '習熟度スコア']
-    
-    # データの習熟度フィールドを確保
-    enhanced_data = []
-    for i, item in enumerate(data):
-        enhanced_item = item.copy()
-        # 番号がない場合は自動設定
-        if '番号' not in enhanced_item:
-            enhanced_item['番号'] = i + 1
-        # 習熟度データがない場合はデフォルト値を設定
-        if '正解数' not in enhanced_item:
-            enhanced_item['正解数'] = 0
-        if '総試行回数' not in enhanced_item:
-            enhanced_item['総試行回数'] = 0
-        if '習熟度スコア' not in enhanced_item:
-            enhanced_item['習熟度スコア'] = 0.0
-        enhanced_data.append(enhanced_item)
-    
-    try:
-        # Shift_JISでの保存を試行（エラー時はUTF-8で保存）
+    @staticmethod
+    def _header():
+        # 書き直しを他のプロセスが検出できるよう、ファイルごとに異なる先頭行を付ける
+        return f"# {uuid.uuid4().hex}\n"
+
+    def _append(self, filename, lines):
+        """更新行を追記して反映し、書き直しが必要かどうかを返す（共有ロック下で呼び出す）"""
+        ensure_datasets_dir()
+        with open(self.schedule_path(filename), 'a', encoding='ascii') as f:
+            if f.tell() == 0:
+                f.write(self._header())
+            f.write(''.join(lines))
+        schedule = self._sync(filename)
+        return schedule.lines > len(schedule.states) + REVIEW_SCHEDULE_COMPACT_LINES
+
+    def record(self, filename, judgments, now=None):
+        """判定結果 [(問題ID, 正解かどうか)] から次回の復習予定を更新"""
+        if not judgments:
+            return
+        now = time.time() if now is None else now
         try:
-            with open(filepath, 'w', encoding='shift_jis', newline='') as f:
-                writer = csv.DictWriter(f, fieldnames=fieldnames)
-                writer.writeheader()
-                writer.writerows(enhanced_data)
-            print(f"Dataset saved successfully with shift_jis encoding: {filename}")
-        except UnicodeEncodeError as encode_error:
-            print(f"Shift_JIS encoding failed for {filename}: {encode_error}")
-            print("Saving with UTF-8 encoding instead...")
-            with open(filepath, 'w', encoding='utf-8', newline='') as f:
-                writer = csv.DictWriter(f, fieldnames=fieldnames)
-                writer.writeheader()
-                writer.writerows(enhanced_data)
-            print(f"Dataset saved successfully with UTF-8 encoding: {filename}")
-        return True
-    except Exception as e:
-        print(f"Error saving dataset {filename}: {e}")
-        return False
+            # 直前の状態から次の状態を計算して追記するため、他のプロセスの記録と排他にする
+            with dataset_lock(filename, exclusive=True):
+                with self._lock:
+                    states = self._sync(filename).states
+                    updated = {}
+                    lines = []
+                    for item_id, is_correct in judgments:
+                        if not is_valid_item_id(item_id):
+                            continue  # 1行1件の形式で書けないIDは記録しない
+                        state = next_review_state(updated.get(item_id) or states.get(item_id), is_correct, now)
+                        updated[item_id] = state
+                        lines.append(f"{item_id},{state[0]},{state[1]},{state[2]},{state[3]}\n")
+                    needs_compaction = lines and self._append(filename, lines)
+                if needs_compaction:
+                    self.compact(filename)
+        except (OSError, UnicodeError) as e:
+            print(f"Review schedule update error for {filename}: {e}")
+
+    def forget(self, filename, item_ids):
+        """削除・リセットした問題の復習予定を削除"""
+        try:
+            with dataset_lock(filename):
+                with self._lock:
+                    states = self._sync(filename).states
+                    lines = [f"{item_id},-\n" for item_id in item_ids if item_id in states]
+                    if lines:
+                        self._append(filename, lines)
+        except (OSError, UnicodeError) as e:
+            print(f"Review schedule update error for {filename}: {e}")
+
+    def retain(self, filename, item_ids):
+        """データセットにない問題（item_ids 以外）の復習予定を削除"""
+        item_ids = set(item_ids)
+        with self._lock:
+            stale = [item_id for item_id in self._sync(filename).states if item_id not in item_ids]
+        if stale:
+            self.forget(filename, stale)
+
+    def compact(self, filename):
+        """現在の状態だけを書き直して追記分を畳み込む"""
+        with dataset_lock(filename, exclusive=True):
+            with self._lock:
+                schedule = self._sync(filename)
+                lines = [self._header()] + [f"{item_id},{state[0]},{state[1]},{state[2]},{state[3]}\n"
+                                            for item_id, state in schedule.states.items()]
+                atomic_write(self.schedule_path(filename), 'ascii', lambda f: f.writelines(lines))
+                self._sync(filename)
+
+    def drop(self, filename):
+        """データセットの削除・置き換え・全リセット時に復習予定をすべて削除"""
+        with dataset_lock(filename, exclusive=True):
+            with self._lock:
+                path = self.schedule_path(filename)
+                self._schedules.pop(path, None)
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def due_items(self, filename, limit, before=None):
+        """復習時期が来た問題IDを期限の早い順に最大 limit 件返す"""
+        before = end_of_today() if before is None else before
+        with self._lock:
+            return list(itertools.islice(self._sync(filename).iter_due(before), limit))
+
+    def due_count(self, filename, before=None):
+        """復習時期が来た問題数（既定は今日中に期限が来るもの）"""
+        before = end_of_today() if before is None else before
+        with self._lock:
+            return sum(1 for _ in self._sync(filename).iter_due(before))
+
+review_schedules = ReviewScheduleRegistry()
+
+
+_dataset_store = None
+_dataset_store_guard = threading.Lock()
+
+def get_dataset_store():
+    """設定（DATASET_STORE）に応じた保存先を取得"""
+    global _dataset_store
+    if _dataset_store is None:
+        with _dataset_store_guard:
+            if _dataset_store is None:
+                if DATASET_STORE == 'sqlite':
+                    _dataset_store = SqliteDatasetStore(os.path.join(DATASETS_DIR, SQLITE_DB_FILENAME))
+                else:
+                    _dataset_store = CsvDatasetStore()
+    return _dataset_store
+
+def load_dataset(filename, readonly=False):
+    """データセットを読み込み（保存先に応じてCSVまたはSQLiteから）"""
+    return get_dataset_store().load(filename, readonly)
+
+def save_dataset(filename, data, fieldnames=None, encoding=None):
+    """データセット全体を保存（保存先に応じてCSVまたはSQLiteへ）"""
+    return get_dataset_store().save(filename, data, encoding)
+
+@app.cli.command('import-csv-to-sqlite')
+def import_csv_to_sqlite_command():
+    """DATASETS_DIR 内のCSVをSQLiteの保存先に取り込む（flask --app app import-csv-to-sqlite）"""
+    sqlite_store = SqliteDatasetStore(os.path.join(DATASETS_DIR, SQLITE_DB_FILENAME))
+    imported = 0
+    for filename in sorted(os.listdir(DATASETS_DIR)):
+        if filename.endswith('.csv') and sqlite_store.save(filename, load_csv_dataset(filename)):
+            imported += 1
+    print(f"{imported}件のデータセットをSQLiteに取り込みました。")
 
 @app.route('/')
 def index():
     """メインダッシュボードページ"""
-    datasets = get_datasets()
+    datasets = add_due_counts(get_datasets())
     message, message_type = get_message_and_type(request)
     return render_template('index.html', datasets=datasets, message=message, message_type=message_type)
 
 @app.route('/api/datasets')
 def api_datasets():
     """データセット一覧API（AJAX用）"""
-    datasets = get_datasets()
+    datasets = add_due_counts(get_datasets())
     return jsonify(datasets)
 
+def item_to_json(position, item):
+    """items API・検索APIの1問分の応答データ"""
+    return {
+        'index': position,  # 削除・リセット用の行位置
+        '番号': item.get('番号', position + 1),
+        '質問': item.get('質問', ''),
+        '回答': item.get('回答', ''),
+        '正解数': int(item.get('正解数', 0) or 0),
+        '総試行回数': int(item.get('総試行回数', 0) or 0),
+        '習熟度スコア': get_mastery_score(item),
+        'ID': item.get('ID', '')
+    }
+
+@app.route('/api/fonts')
+def api_fonts():
+    """PDF用フォントの登録状況API（管理用）"""
+    return jsonify(font_registry.get())
+
+@app.route('/api/fonts/refresh', methods=['POST'])
+def api_refresh_fonts():
+    """PDF用フォントを再検出して登録し直す（フォント追加後の管理用）"""
+    return jsonify(font_registry.refresh())
+
+@app.route('/api/test_sessions/stats')
+def api_test_session_stats():
+    """オンラインテストセッションの件数API（監視用）"""
+    return jsonify(get_online_test_session_store().stats())
+
+@app.route('/api/datasets/<filename>/items')
+def api_dataset_items(filename):
+    """データセットの問題一覧API（ページ単位、編集ページのスクロール読み込み用）
+
+    クエリ: offset, limit, sort（number / mastery）, order（asc / desc）
+    """
+    store = get_dataset_store()
+    if not store.exists(filename):
+        return jsonify({'error': 'データセットが見つかりません'}), 404
+    
+    try:
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = min(max(1, int(request.args.get('limit', ITEMS_PAGE_SIZE))), ITEMS_PAGE_MAX_LIMIT)
+    except ValueError:
+        return jsonify({'error': 'offset と limit は整数で指定してください'}), 400
+    sort = request.args.get('sort', 'number')
+    if sort not in ('number', 'mastery'):
+        return jsonify({'error': 'sort は number または mastery を指定してください'}), 400
+    descending = request.args.get('order', 'asc') == 'desc'
+    
+    total, page = store.get_items_page(filename, offset, limit, sort, descending)
+    
+    return jsonify({
+        'total': total,
+        'offset': offset,
+        'limit': limit,
+        'sort': sort,
+        'order': 'desc' if descending else 'asc',
+        'items': [item_to_json(position, item) for position, item in page]
+    })
+
+@app.route('/api/datasets/<filename>/search')
+def api_dataset_search(filename):
+    """問題文・回答の全文検索API（一致度の高い順）
+
+    クエリ: q（検索語）, limit
+    """
+    store = get_dataset_store()
+    if not store.exists(filename):
+        return jsonify({'error': 'データセットが見つかりません'}), 404
+    
+    query = request.args.get('q', '')
+    try:
+        limit = min(max(1, int(request.args.get('limit', SEARCH_RESULT_LIMIT))), ITEMS_PAGE_MAX_LIMIT)
+    except ValueError:
+        return jsonify({'error': 'limit は整数で指定してください'}), 400
+    
+    total, results = search_indexes.search(filename, query, limit)
+    found = store.get_items_by_ids(filename, [item_id for item_id, _ in results])
+    items = []
+    for item_id, score in results:
+        if item_id in found:
+            position, item = found[item_id]
+            items.append(dict(item_to_json(position, item), score=score))
+    
+    return jsonify({
+        'query': query,
+        'total': total,
+        'items': items
+    })
+
 @app.route('/create_dataset')
 def create_dataset():
     """新しいデータセット作成ページ"""
@@ -550,12 +3385,12 @@ def save_dataset_route():
     filename = f"{name}.csv"
     
     # 重複チェック
-    if os.path.exists(os.path.join(DATASETS_DIR, filename)):
+    if get_dataset_store().exists(filename):
         set_flash_message(f'データセット "{name}" は既に存在します。別の名前を使用してください。', 'error')
         return redirect(url_for('create_dataset'))
     
-    # 拡張フォーマット: 番号,質問,回答,正解数,総試行回数,習熟度スコア
-    fieldnames = ['番号', '質問', '回答', '正解数', '総試行回数', '習熟度スコア']
+    # 拡張フォーマット: 番号,質問,回答,正解数,総試行回数,習熟度スコア,ID
+    fieldnames = DATASET_FIELDNAMES
     data = []
     
     if save_dataset(filename, data, fieldnames):
@@ -567,54 +3402,38 @@ def save_dataset_route():
 
 @app.route('/edit_dataset/<filename>')
 def edit_dataset(filename):
-    """データセット編集ページ"""
-    data = load_dataset(filename)
+    """データセット編集ページ（問題一覧はスクロールに合わせて items API から取得）"""
     dataset_name = filename[:-4]  # .csvを除去
     
     # 統計情報を取得
-    stats = get_dataset_stats(data)
+    stats = get_dataset_store().get_stats(filename)
     
-    # 拡張フォーマット: 番号,質問,回答,正解数,総試行回数,習熟度スコア
-    fieldnames = ['番号', '質問', '回答', '正解数', '総試行回数', '習熟度スコア']
+    # 拡張フォーマット: 番号,質問,回答,正解数,総試行回数,習熟度スコア,ID
+    fieldnames = DATASET_FIELDNAMES
     
     message, message_type = get_message_and_type(request)
     
     return render_template('edit_dataset.html', 
                          dataset_name=dataset_name,
                          filename=filename,
-                         data=data,
                          stats=stats,
                          fieldnames=fieldnames,
+                         page_size=ITEMS_PAGE_SIZE,
                          message=message,
                          message_type=message_type)
 
 @app.route('/add_item/<filename>', methods=['POST'])
 def add_item(filename):
     """データセットにアイテム追加"""
-    data = load_dataset(filename)
-    
-    # 次の番号を計算
-    next_number = max([int(item.get('番号', 0)) for item in data], default=0) + 1
-    
-    # 拡張フォーマット: 番号,質問,回答,正解数,総試行回数,習熟度スコア
-    fieldnames = ['番号', '質問', '回答', '正解数', '総試行回数', '習熟度スコア']
-    new_item = {
-        '番号': next_number,
-        '質問': request.form.get('question', ''),
-        '回答': request.form.get('answer', ''),
-        '正解数': 0,
-        '総試行回数': 0,
-        '習熟度スコア': 0.0
-    }
+    question = request.form.get('question', '')
+    answer = request.form.get('answer', '')
     
     # 空のフィールドチェック（必須フィールドのみ）
-    if not new_item['質問'] or not new_item['回答']:
+    if not question or not answer:
         set_flash_message('質問と回答を入力してください。', 'error')
         return redirect(url_for('edit_dataset', filename=filename))
     
-    data.append(new_item)
-    
-    if save_dataset(filename, data, fieldnames):
+    if get_dataset_store().add_item(filename, question, answer):
         set_flash_message('アイテムを追加しました。', 'success')
         return redirect(url_for('edit_dataset', filename=filename))
     else:
@@ -624,19 +3443,10 @@ def add_item(filename):
 @app.route('/delete_item/<filename>/<int:index>')
 def delete_item(filename, index):
     """データセットからアイテム削除"""
-    data = load_dataset(filename)
+    saved = get_dataset_store().delete_item(filename, index)
     
-    if 0 <= index < len(data):
-        # 拡張フォーマット: 番号,質問,回答,正解数,総試行回数,習熟度スコア
-        fieldnames = ['番号', '質問', '回答', '正解数', '総試行回数', '習熟度スコア']
-        
-        data.pop(index)
-        
-        # 削除後、番号を振り直し
-        for i, item in enumerate(data):
-            item['番号'] = i + 1
-        
-        if save_dataset(filename, data, fieldnames):
+    if saved is not None:
+        if saved:
             set_flash_message('アイテムを削除しました。', 'success')
             return redirect(url_for('edit_dataset', filename=filename))
         else:
@@ -649,17 +3459,10 @@ def delete_item(filename, index):
 @app.route('/reset_mastery/<filename>/<int:index>')
 def reset_single_mastery(filename, index):
     """個別問題の習熟度をリセット"""
-    data = load_dataset(filename)
+    reset_count = get_dataset_store().reset_mastery(filename, index)
     
-    if 0 <= index < len(data):
-        # 習熟度データをリセット
-        data[index]['正解数'] = 0
-        data[index]['総試行回数'] = 0
-        data[index]['習熟度スコア'] = 0.0
-        
-        fieldnames = ['番号', '質問', '回答', '正解数', '総試行回数', '習熟度スコア']
-        
-        if save_dataset(filename, data, fieldnames):
+    if reset_count != 0:
+        if reset_count:
             set_flash_message('習熟度をリセットしました。', 'success')
             return redirect(url_for('edit_dataset', filename=filename))
         else:
@@ -672,22 +3475,14 @@ def reset_single_mastery(filename, index):
 @app.route('/reset_all_mastery/<filename>')
 def reset_all_mastery(filename):
     """全問題の習熟度を一括リセット"""
-    data = load_dataset(filename)
+    reset_count = get_dataset_store().reset_mastery(filename)
     
-    if not data:
+    if reset_count == 0:
         set_flash_message('データセットが空です。', 'error')
         return redirect(url_for('edit_dataset', filename=filename))
     
-    # 全問題の習熟度データをリセット
-    for item in data:
-        item['正解数'] = 0
-        item['総試行回数'] = 0
-        item['習熟度スコア'] = 0.0
-    
-    fieldnames = ['番号', '質問', '回答', '正解数', '総試行回数', '習熟度スコア']
-    
-    if save_dataset(filename, data, fieldnames):
-        set_flash_message(f'全{len(data)}問の習熟度をリセットしました。', 'success')
+    if reset_count:
+        set_flash_message(f'全{reset_count}問の習熟度をリセットしました。', 'success')
         return redirect(url_for('edit_dataset', filename=filename))
     else:
         set_flash_message('習熟度の一括リセットに失敗しました。', 'error')
@@ -696,7 +3491,7 @@ def reset_all_mastery(filename):
 @app.route('/input_results/<filename>')
 def input_results(filename):
     """印刷したテストの結果を手動で入力"""
-    data = load_dataset(filename)
+    data = load_dataset(filename, readonly=True)
     dataset_name = filename[:-4]
     message, message_type = get_message_and_type(request)
     
@@ -715,20 +3510,20 @@ def input_results(filename):
 @app.route('/save_results/<filename>', methods=['POST'])
 def save_results(filename):
     """手動入力した結果を保存して習熟度を更新"""
-    data = load_dataset(filename)
+    data = load_dataset(filename, readonly=True)
     
     if not data:
         set_flash_message('データセットが空です。', 'error')
         return redirect(url_for('input_results', filename=filename))
     
-    # 各問題の結果を処理
-    updated_count = 0
+    # 各問題の結果を集めて一括で反映
+    judgments = []
     for i in range(len(data)):
         result = request.form.get(f'result_{i}')
         if result in ['correct', 'incorrect']:
-            is_correct = (result == 'correct')
-            if update_question_proficiency(filename, i, is_correct):
-                updated_count += 1
+            judgments.append((i, result == 'correct'))
+    
+    updated_count = apply_proficiency_judgments(filename, judgments) if judgments else 0
     
     if updated_count > 0:
         set_flash_message(f'{updated_count}問の結果を保存し、習熟度を更新しました。', 'success')
@@ -741,57 +3536,60 @@ def save_results(filename):
 @app.route('/online_test/<filename>')
 def online_test_setup(filename):
     """オンラインテスト設定画面"""
-    data = load_dataset(filename)
+    # 習熟度分布を取得（データセット全体は走査しない）
+    mastery_dist = get_dataset_store().get_mastery_distribution(filename)
     
-    if not data:
+    if mastery_dist['total'] == 0:
         set_flash_message('データセットが見つかりません。', 'error')
         return redirect(url_for('index'))
     
-    # 既存の統計データがあれば取得
-    total_items = len(data)
-    
-    # 習熟度分布を取得
-    mastery_dist = get_mastery_distribution(data)
+    total_items = mastery_dist['total']
     
     return render_template('online_test_setup.html',
                          filename=filename,
                          dataset_name=filename[:-4],
                          total_items=total_items,
-                         mastery_distribution=mastery_dist)
+                         mastery_distribution=mastery_dist,
+                         due_count=review_schedules.due_count(filename))
 
 @app.route('/quick_10/<filename>')
 def quick_10_test(filename):
     """クイック10テスト: 習熟度が低い問題から10問をランダム選択して即開始"""
-    data = load_dataset(filename)
-    
-    if not data:
+    store = get_dataset_store()
+    if not store.exists(filename):
         set_flash_message('データセットが見つかりません。', 'error')
         return redirect(url_for('index'))
     
-    # 習熟度が低い問題（60%未満）を抽出
-    weak_problems = get_weak_problems(data, threshold=0.6)
-    
-    # 習熟度の低い問題が10問未満の場合、閾値を上げて問題を追加
-    if len(weak_problems) < 10:
-        # 80%未満まで拡張
-        weak_problems = get_weak_problems(data, threshold=0.8)
+    if request.args.get('selection_method') == 'weighted':
+        # 重み付き選択：全問題から習熟度の低い問題ほど選ばれやすく10問を選択
+        selected_problems = store.sample_weighted_items(filename, 10)
+        if not selected_problems:
+            set_flash_message('出題可能な問題がありません。', 'error')
+            return redirect(url_for('index'))
+    else:
+        # 習熟度の低い問題（60%未満）が10問未満の場合は80%未満まで、それでも足りない場合は全問題から選択
+        # （件数は習熟度分布から判定し、問題の抽出は1回だけ行う）
+        mastery_dist = store.get_mastery_distribution(filename)
+        if mastery_dist['weak'] >= 10:
+            weak_problems = store.get_weak_items(filename, 0.6)
+        elif mastery_dist['weak'] + mastery_dist['moderate'] >= 10:
+            weak_problems = store.get_weak_items(filename, 0.8)
+        else:
+            weak_problems = load_dataset(filename, readonly=True)
         
-        # まだ足りない場合は全問題から選択
-        if len(weak_problems) < 10:
-            weak_problems = data
-    
-    # 最大10問を選択
-    num_questions = min(10, len(weak_problems))
-    if num_questions == 0:
-        set_flash_message('出題可能な問題がありません。', 'error')
-        return redirect(url_for('index'))
-    
-    # ランダムに問題を選択
-    selected_problems = random.sample(weak_problems, num_questions)
+        # 最大10問を選択
+        num_questions = min(10, len(weak_problems))
+        if num_questions == 0:
+            set_flash_message('出題可能な問題がありません。', 'error')
+            return redirect(url_for('index'))
+        
+        # ランダムに問題を選択
+        selected_problems = random.sample(weak_problems, num_questions)
     
-    # テスト設定
+    # テスト設定（test_mode=offline の場合は全問題をページに埋め込み、結果はまとめて送信）
     settings = {
-        'quiz_type': 'question_to_answer'
+        'quiz_type': 'question_to_answer',
+        'test_mode': 'offline' if request.args.get('test_mode') == 'offline' else 'online'
     }
     
     # オンラインテストセッションを作成
@@ -802,7 +3600,7 @@ def quick_10_test(filename):
 @app.route('/start_online_test/<filename>', methods=['POST'])
 def start_online_test(filename):
     """オンラインテスト開始"""
-    data = load_dataset(filename)
+    data = load_dataset(filename, readonly=True)
     
     if not data:
         set_flash_message('データセットが空です。', 'error')
@@ -817,13 +3615,20 @@ def start_online_test(filename):
         # 弱点問題特化モードの処理
         if problem_mode == 'weak':
             # 弱点問題のみを対象とする
-            weak_data = get_weak_problems(data, threshold=0.6)
+            weak_data = get_dataset_store().get_weak_items(filename, 0.6)
             if not weak_data:
                 set_flash_message('弱点問題が見つかりません。通常モードをお試しください。', 'warning')
                 return redirect(url_for('online_test_setup', filename=filename))
             range_data = weak_data
             # 弱点問題モードでは範囲指定は無効
             num_questions = min(max(1, num_questions), len(range_data))
+        elif problem_mode == 'due':
+            # 今日の復習モード：復習時期が来た問題を期限の早い順に取り出す（範囲指定は無効）
+            range_data = get_due_items(filename, max(1, num_questions))
+            if not range_data:
+                set_flash_message('今日復習する問題はありません。', 'warning')
+                return redirect(url_for('online_test_setup', filename=filename))
+            num_questions = len(range_data)
         else:
             # 通常モード：範囲設定の取得
             range_start = request.form.get('range_start')
@@ -856,13 +3661,23 @@ def start_online_test(filename):
         if selection_method == 'sequential':
             # 順番選択：範囲の最初から指定数を選択
             selected_items = range_data[:num_questions]
+        elif selection_method == 'weighted':
+            # 重み付き選択：習熟度の低い問題ほど選ばれやすい
+            # 弱点・復習モードは行位置の範囲ではないため、取り出した問題の中から選ぶ
+            # （復習モードでは期限が来た問題すべてを、習熟度の低いものほど先に出題する順番になる）
+            if problem_mode in ('weak', 'due'):
+                selected_items = weighted_sample(range_data, num_questions)
+            else:
+                selected_items = get_dataset_store().sample_weighted_items(
+                    filename, num_questions, start_index, end_index + 1)
         else:
             # ランダム選択：範囲からランダムに選択
             selected_items = random.sample(range_data, num_questions)
         
         # テスト設定
         settings = {
-            'quiz_type': quiz_type
+            'quiz_type': quiz_type,
+            'test_mode': 'offline' if request.form.get('test_mode') == 'offline' else 'online'
         }
         
         # オンラインテストセッションを作成
@@ -886,63 +3701,62 @@ def online_test_session(session_id):
         set_flash_message('テストセッションが見つかりません。', 'error')
         return redirect(url_for('index'))
     
+    if test_session['settings'].get('test_mode') == 'offline':
+        # 全問題（両方向の出題に使えるよう質問・回答の両方）を埋め込み、ページ内で実施
+        questions = [{
+            '質問': question.get('質問', ''),
+            '回答': question.get('回答', ''),
+            '正解数': int(question.get('正解数', 0) or 0),
+            '総試行回数': int(question.get('総試行回数', 0) or 0)
+        } for question in test_session['questions']]
+        return render_template('offline_test.html',
+                             session_id=session_id,
+                             test_session=test_session,
+                             questions=questions)
+    
     return render_template('online_test.html',
                          session_id=session_id,
-                         test_session=test_session)
+                         test_session=test_session,
+                         initial_state=build_test_state(test_session))
 
 @app.route('/show_answer/<session_id>', methods=['POST'])
 def show_answer(session_id):
     """回答を表示"""
-    test_session = get_online_test_session(session_id)
-    
-    if not test_session:
-        return jsonify({'error': 'セッションが見つかりません'}), 404
-    
-    current_index = test_session['current_question']
-    
-    # 状態を"answer"に変更
-    test_session['question_states'][current_index] = 'answer'
+    with update_online_test_session(session_id) as test_session:
+        if not test_session:
+            return jsonify({'error': 'セッションが見つかりません'}), 404
+        
+        current_index = test_session['current_question']
+        
+        # 状態を"answer"に変更
+        test_session['question_states'][current_index] = 'answer'
     
     return jsonify({'success': True})
 
 @app.route('/submit_judgment/<session_id>', methods=['POST'])
 def submit_judgment(session_id):
     """自己判定を提出"""
-    test_session = get_online_test_session(session_id)
-    
-    if not test_session:
-        return jsonify({'error': 'セッションが見つかりません'}), 404
-    
-    current_index = test_session['current_question']
     is_correct = request.json.get('is_correct', False)
-    
-    # 判定結果を記録
-    test_session['user_judgments'][current_index] = is_correct
-    test_session['question_states'][current_index] = 'judged'
-    
-    # スコアを更新
-    if is_correct:
-        test_session['results']['score'] += 1
-    
-    # 習熟度データを更新（オンラインテストの結果をCSVに反映）
-    try:
-        # 現在の問題のオリジナルインデックスを取得
-        current_question = test_session['questions'][current_index]
-        filename = test_session['filename']
+    with update_online_test_session(session_id) as test_session:
+        if not test_session:
+            return jsonify({'error': 'セッションが見つかりません'}), 404
         
-        # 元のデータセットを読み込んで該当問題のインデックスを見つける
-        all_data = load_dataset(filename)
-        original_index = None
+        current_index = test_session['current_question']
         
-        for i, item in enumerate(all_data):
-            if (item.get('質問') == current_question.get('質問') and 
-                item.get('回答') == current_question.get('回答')):
-                original_index = i
-                break
+        # 判定結果を記録
+        test_session['user_judgments'][current_index] = is_correct
+        test_session['question_states'][current_index] = 'judged'
         
-        # 習熟度データを更新
-        if original_index is not None:
-            update_question_proficiency(filename, original_index, is_correct)
+        # スコアを更新
+        if is_correct:
+            test_session['results']['score'] += 1
+        
+        filename = test_session['filename']
+        current_question = test_session['questions'][current_index]
+    
+    # 習熟度データを更新（ジャーナルに追記し、CSVへはコンパクション時に反映）
+    try:
+        get_dataset_store().record_judgments(filename, [(current_question['ID'], is_correct)])
             
     except Exception as e:
         print(f"習熟度更新エラー: {e}")
@@ -953,81 +3767,224 @@ def submit_judgment(session_id):
 @app.route('/next_question/<session_id>', methods=['POST'])
 def next_question(session_id):
     """次の問題へ移動"""
-    test_session = get_online_test_session(session_id)
-    
-    if not test_session:
-        return jsonify({'error': 'セッションが見つかりません'}), 404
-    
-    current_index = test_session['current_question']
-    total_questions = len(test_session['questions'])
-    
-    if current_index + 1 < total_questions:
-        test_session['current_question'] = current_index + 1
-        return jsonify({'success': True, 'next_question_index': current_index + 1})
-    else:
-        # テスト終了
-        return jsonify({'success': True, 'test_completed': True})
+    with update_online_test_session(session_id) as test_session:
+        if not test_session:
+            return jsonify({'error': 'セッションが見つかりません'}), 404
+        
+        current_index = test_session['current_question']
+        total_questions = len(test_session['questions'])
+        
+        if current_index + 1 < total_questions:
+            test_session['current_question'] = current_index + 1
+            return jsonify({'success': True, 'next_question_index': current_index + 1})
+        else:
+            # テスト終了
+            return jsonify({'success': True, 'test_completed': True})
 
 @app.route('/finish_test/<session_id>', methods=['POST'])
 def finish_test(session_id):
     """テストを終了"""
-    test_session = get_online_test_session(session_id)
-    
-    if not test_session:
-        return jsonify({'error': 'セッションが見つかりません'}), 404
-    
-    # テスト終了フラグを設定
-    test_session['finished'] = True
+    with update_online_test_session(session_id) as test_session:
+        if not test_session:
+            return jsonify({'error': 'セッションが見つかりません'}), 404
+        
+        # テスト終了フラグを設定
+        test_session['finished'] = True
     
     return jsonify({'success': True, 'test_completed': True})
 
 @app.route('/skip_question/<session_id>', methods=['POST'])
 def skip_question(session_id):
     """問題をスキップ"""
-    test_session = get_online_test_session(session_id)
-    
-    if not test_session:
-        return jsonify({'error': 'セッションが見つかりません'}), 404
-    
-    current_index = test_session['current_question']
-    
-    # スキップは不正解として記録
-    test_session['user_judgments'][current_index] = False
-    test_session['question_states'][current_index] = 'judged'
-    
-    # 習熟度データを更新（スキップは不正解として記録）
-    try:
-        current_question = test_session['questions'][current_index]
-        filename = test_session['filename']
+    with update_online_test_session(session_id) as test_session:
+        if not test_session:
+            return jsonify({'error': 'セッションが見つかりません'}), 404
         
-        # 元のデータセットを読み込んで該当問題のインデックスを見つける
-        all_data = load_dataset(filename)
-        original_index = None
+        current_index = test_session['current_question']
         
-        for i, item in enumerate(all_data):
-            if (item.get('質問') == current_question.get('質問') and 
-                item.get('回答') == current_question.get('回答')):
-                original_index = i
-                break
+        # スキップは不正解として記録
+        test_session['user_judgments'][current_index] = False
+        test_session['question_states'][current_index] = 'judged'
         
-        # 習熟度データを更新（不正解として記録）
-        if original_index is not None:
-            update_question_proficiency(filename, original_index, False)
+        # 次の問題へ移動
+        total_questions = len(test_session['questions'])
+        test_completed = current_index + 1 >= total_questions
+        if not test_completed:
+            test_session['current_question'] = current_index + 1
+        
+        filename = test_session['filename']
+        current_question = test_session['questions'][current_index]
+    
+    # 習熟度データを更新（スキップは不正解としてジャーナルに記録）
+    try:
+        get_dataset_store().record_judgments(filename, [(current_question['ID'], False)])
             
     except Exception as e:
         print(f"習熟度更新エラー: {e}")
         # エラーが発生してもテストは継続
     
-    # 次の問題へ移動
-    total_questions = len(test_session['questions'])
-    
-    if current_index + 1 < total_questions:
-        test_session['current_question'] = current_index + 1
+    if not test_completed:
         return jsonify({'success': True, 'next_question_index': current_index + 1})
     else:
         # テスト終了
         return jsonify({'success': True, 'test_completed': True})
 
+def build_test_state(test_session):
+    """現在の問題・進捗・過去の正解率をまとめた表示用データ
+
+    過去の正解率はセッション作成時に読み込んだ問題データから求め、データセットは読み込まない。
+    """
+    current_index = test_session['current_question']
+    current_question = test_session['questions'][current_index]
+    
+    # 問題文と回答文を決定
+    if test_session['settings']['quiz_type'] == 'question_to_answer':
+        question_text = current_question.get('質問', '')
+        answer_text = current_question.get('回答', '')
+    else:
+        question_text = current_question.get('回答', '')
+        answer_text = current_question.get('質問', '')
+    
+    correct_count = int(current_question.get('正解数', 0) or 0)
+    total_attempts = int(current_question.get('総試行回数', 0) or 0)
+    
+    return {
+        'question': {
+            'current_question': current_index,
+            'total_questions': test_session['results']['total_questions'],
+            'question_text': question_text,
+            'answer_text': answer_text
+        },
+        'progress': {
+            'score': test_session['results']['score'],
+            'answered_questions': sum(1 for judgment in test_session['user_judgments'] if judgment is not None),
+            'total_questions': test_session['results']['total_questions']
+        },
+        'history': {
+            'correct_count': correct_count,
+            'total_attempts': total_attempts,
+            'accuracy': correct_count / total_attempts if total_attempts > 0 else 0
+        }
+    }
+
+@app.route('/advance/<session_id>', methods=['POST'])
+def advance_question(session_id):
+    """判定を記録して次の問題へ進み、次の問題・進捗・過去の正解率を1回の応答で返す
+
+    リクエスト: {"action": "correct" | "incorrect" | "skip", "question_index": 判定した問題の位置}
+    question_index が現在の問題と異なる場合（再送など）は記録せずに現在の状態を返す。
+    """
+    payload = request.get_json(silent=True) or {}
+    action = payload.get('action')
+    if action not in ('correct', 'incorrect', 'skip'):
+        return jsonify({'error': 'action は correct / incorrect / skip のいずれかを指定してください'}), 400
+    is_correct = action == 'correct'  # スキップは不正解として記録
+    
+    judged_question = None
+    with update_online_test_session(session_id) as test_session:
+        if not test_session:
+            return jsonify({'error': 'セッションが見つかりません'}), 404
+        
+        current_index = test_session['current_question']
+        total_questions = len(test_session['questions'])
+        expected_index = payload.get('question_index', current_index)
+        test_completed = False
+        
+        if expected_index == current_index and test_session['user_judgments'][current_index] is None:
+            # 判定結果を記録
+            test_session['user_judgments'][current_index] = is_correct
+            test_session['question_states'][current_index] = 'judged'
+            if is_correct:
+                test_session['results']['score'] += 1
+            judged_question = test_session['questions'][current_index]
+            
+            # 次の問題へ移動
+            if current_index + 1 < total_questions:
+                test_session['current_question'] = current_index + 1
+            else:
+                test_completed = True
+        elif test_session['user_judgments'][current_index] is not None:
+            # 最後の問題を判定済み
+            test_completed = current_index + 1 >= total_questions
+        
+        filename = test_session['filename']
+        state = build_test_state(test_session)
+    
+    # 習熟度データを更新（ジャーナルに追記し、CSVへはコンパクション時に反映）
+    if judged_question is not None:
+        try:
+            get_dataset_store().record_judgments(filename, [(judged_question['ID'], is_correct)])
+        except Exception as e:
+            print(f"習熟度更新エラー: {e}")
+            # エラーが発生してもテストは継続
+    
+    return jsonify(dict(state, success=True, test_completed=test_completed))
+
+@app.route('/submit_batch/<session_id>', methods=['POST'])
+def submit_batch(session_id):
+    """オフラインモードの判定結果をまとめて記録
+
+    リクエスト: {"batch_key": セッションの冪等キー, "judgments": [{"question_index": 位置, "action": "correct" | "incorrect" | "skip"}, ...]}
+    同じキーでの再送は記録済みとして扱い、習熟度データは1回の書き込みで更新する。
+    """
+    payload = request.get_json(silent=True) or {}
+    judgments = payload.get('judgments')
+    if not isinstance(judgments, list):
+        return jsonify({'error': 'judgments を指定してください'}), 400
+    
+    test_session = get_online_test_session(session_id)
+    if not test_session:
+        return jsonify({'error': 'セッションが見つかりません'}), 404
+    batch_key = test_session.get('batch_key')
+    if payload.get('batch_key') != batch_key:
+        return jsonify({'error': '送信キーが一致しません'}), 409
+    if test_session['batch_applied']:
+        # 再送（記録済み）
+        return jsonify({'success': True, 'duplicate': True,
+                        'score': test_session['results']['score']})
+    
+    questions = test_session['questions']
+    results = {}
+    for judgment in judgments:
+        try:
+            question_index = int(judgment['question_index'])
+            action = judgment['action']
+        except (KeyError, TypeError, ValueError):
+            return jsonify({'error': '判定結果の形式が正しくありません'}), 400
+        if not 0 <= question_index < len(questions) or action not in ('correct', 'incorrect', 'skip'):
+            return jsonify({'error': '判定結果の形式が正しくありません'}), 400
+        results[question_index] = action == 'correct'  # スキップは不正解として記録
+    
+    # 習熟度データを1回の書き込みで更新する。冪等キーは判定と一緒に保存先へ記録されるため、
+    # セッションのロック外で同じ送信が重なっても二重に記録されない（失敗時は再送を待つ）
+    try:
+        recorded = get_dataset_store().record_judgments(
+            test_session['filename'],
+            [(questions[question_index]['ID'], is_correct) for question_index, is_correct in sorted(results.items())],
+            batch_key)
+    except Exception as e:
+        print(f"習熟度更新エラー: {e}")
+        recorded = False
+    if not recorded:
+        return jsonify({'error': '判定結果の記録に失敗しました。再送してください。'}), 503
+    
+    with update_online_test_session(session_id) as test_session:
+        if not test_session:
+            return jsonify({'error': 'セッションが見つかりません'}), 404
+        # 同時に送られた同じ一括送信が先に反映した場合は、その結果を返す
+        duplicate = test_session['batch_applied']
+        if not duplicate:
+            for question_index, is_correct in results.items():
+                test_session['user_judgments'][question_index] = is_correct
+                test_session['question_states'][question_index] = 'judged'
+            test_session['results']['score'] = sum(1 for judgment in test_session['user_judgments'] if judgment)
+            test_session['current_question'] = max(results, default=0)
+            test_session['finished'] = True
+            test_session['batch_applied'] = True
+        score = test_session['results']['score']
+    
+    return jsonify({'success': True, 'duplicate': duplicate, 'score': score})
+
 @app.route('/test_results/<session_id>')
 def test_results(session_id):
     """テスト結果表示"""
@@ -1079,20 +4036,11 @@ def get_historical_accuracy(session_id):
     try:
         current_index = test_session['current_question']
         current_question = test_session['questions'][current_index]
-        filename = test_session['filename']
-        
-        # 元のデータセットを読み込んで該当問題のインデックスを見つける
-        all_data = load_dataset(filename)
-        original_index = None
         
-        for i, item in enumerate(all_data):
-            if (item.get('質問') == current_question.get('質問') and 
-                item.get('回答') == current_question.get('回答')):
-                original_index = i
-                break
+        # IDインデックスから該当問題の最新データを取得
+        item = get_dataset_store().get_item(test_session['filename'], current_question.get('ID'))
         
-        if original_index is not None:
-            item = all_data[original_index]
+        if item is not None:
             correct_count = int(item.get('正解数', 0))
             total_attempts = int(item.get('総試行回数', 0))
             
@@ -1148,10 +4096,299 @@ def get_current_question(session_id):
         return jsonify({'error': '現在の問題取得に失敗しました'}), 500
 
 
+class PdfCache:
+    """生成したPDFをディスクに保存するキャッシュ（出題条件のハッシュをキーにしたLRU）
+
+    最終利用時刻はファイルのmtimeで管理するため、複数プロセスで共有できる。
+    合計サイズが max_bytes を超えたら最終利用の古いものから削除する。
+    キーが None の場合（再び同じ内容を作ることのない印刷）はキャッシュしない。
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def directory():
+        return PDF_CACHE_DIR or os.path.join(DATASETS_DIR, PDF_CACHE_DIRNAME)
+
+    @staticmethod
+    def make_key(**conditions):
+        """出題条件からキャッシュキーを作成"""
+        payload = json.dumps(conditions, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory(), key + '.pdf')
+
+    def get(self, key):
+        """キャッシュ済みのPDF（ない場合はNone）"""
+        if self.max_bytes <= 0 or key is None:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)  # 最終利用時刻を更新
+        except OSError:
+            return None
+        return data
+
+    def put(self, key, data):
+        """PDFを保存し、上限を超えた分を削除"""
+        if self.max_bytes <= 0 or key is None or len(data) > self.max_bytes:
+            return
+        directory = self.directory()
+        try:
+            os.makedirs(directory, exist_ok=True)
+            atomic_write_bytes(self._path(key), data)
+            self._evict()
+        except OSError as e:
+            # キャッシュに保存できなくてもPDFの返却は続行
+            print(f"PDFキャッシュ保存エラー: {e}")
+
+    def _evict(self):
+        with self._lock:
+            directory = self.directory()
+            entries = []
+            total = 0
+            for name in os.listdir(directory):
+                if not name.endswith('.pdf'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, name))
+                total += stat.st_size
+            if total <= self.max_bytes:
+                return
+            for _, size, name in sorted(entries):
+                try:
+                    os.remove(os.path.join(directory, name))
+                except OSError:
+                    continue
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+pdf_cache = PdfCache(PDF_CACHE_MAX_BYTES)
+
+def read_pdf_job_status(job_path):
+    """ジョブの状態ファイルを読み込む（存在しない場合はNone）"""
+    try:
+        with open(job_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def update_pdf_job_status(job_path, durable=True, **changes):
+    """ジョブの状態ファイルを更新（進捗だけの更新は durable=False で fsync を省く）"""
+    status = read_pdf_job_status(job_path)
+    if status is None:
+        return
+    status.update(changes)
+    atomic_write(job_path, 'utf-8', lambda f: json.dump(status, f, ensure_ascii=False), durable)
+
+def run_pdf_job(job_path, items, dataset_name, quiz_type, include_answers):
+    """PDF作成ジョブ本体（プールのプロセスで実行し、PDFのバイト列を返す）
+
+    job_path がNoneの場合は進捗を記録しない。
+    """
+    if job_path is None:
+        return create_test_pdf(items, dataset_name, quiz_type, include_answers).getvalue()
+    
+    # 進捗の書き込みは PDF_JOB_PROGRESS_INTERVAL 秒に1回まで（ページごとにファイルを書き直さない）
+    last_report = [time.monotonic()]
+    def on_page(page_number):
+        now = time.monotonic()
+        if now - last_report[0] >= PDF_JOB_PROGRESS_INTERVAL:
+            last_report[0] = now
+            update_pdf_job_status(job_path, durable=False, status='running', pages_done=page_number - 1)
+    
+    update_pdf_job_status(job_path, durable=False, status='running')
+    return create_test_pdf(items, dataset_name, quiz_type, include_answers, on_page=on_page).getvalue()
+
+class PdfJobQueue:
+    """PDF作成をプロセスプールで実行するジョブキュー
+
+    ReportLabの処理はCPUを使い続けるため、リクエストのスレッドではなく別プロセスで作成する。
+    ジョブの状態と作成したPDFは DATASETS_DIR/.pdf_jobs に保存し、どのワーカープロセスからも
+    進捗の確認とダウンロードができるようにする。実行中・待機中のジョブ数が上限に達している
+    場合は受け付けない（呼び出し側で429を返す）。
+    """
+
+    def __init__(self, workers, max_pending):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._executor = None
+        self._futures = {}
+
+    @staticmethod
+    def directory():
+        return os.path.join(DATASETS_DIR, PDF_JOB_DIRNAME)
+
+    def _path(self, job_id, suffix='.json'):
+        return os.path.join(self.directory(), job_id + suffix)
+
+    @staticmethod
+    def _valid_id(job_id):
+        return len(job_id) == 32 and all(c in '0123456789abcdef' for c in job_id)
+
+    def _get_executor(self):
+        if self._executor is None:
+            # 判定ジャーナルのスレッドやSQLite接続を子プロセスに引き継がないよう、forkではなくspawnで起動
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    def submit(self, quiz):
+        """ジョブを登録してIDを返す（混雑している場合はNone）
+
+        同じ条件のPDFがキャッシュにある場合は、作成せずに完了済みのジョブとして登録する。
+        """
+        job_id = uuid.uuid4().hex
+        job_path = self._path(job_id)
+        status = {
+            'job_id': job_id,
+            'status': 'queued',
+            'pages_done': 0,
+            'pages_total': max(1, -(-len(quiz['items']) // PDF_ITEMS_PER_PAGE)),
+            'cache_key': quiz['cache_key'],
+            'filename': quiz['filename'],
+            'download_name': quiz['download_name'],
+            'created': time.time()
+        }
+        cached = pdf_cache.get(quiz['cache_key'])
+        
+        with self._lock:
+            if cached is None and len(self._futures) >= self.max_pending:
+                return None
+            os.makedirs(self.directory(), exist_ok=True)
+            self._cleanup()
+            if cached is not None:
+                atomic_write_bytes(self._path(job_id, '.pdf'), cached)
+                status.update(status='done', pages_done=status['pages_total'])
+            atomic_write(job_path, 'utf-8', lambda f: json.dump(status, f, ensure_ascii=False))
+            if cached is not None:
+                return job_id
+            future = self._get_executor().submit(run_pdf_job, job_path, quiz['items'], quiz['dataset_name'],
+                                                 quiz['quiz_type'], quiz['include_answers'])
+            self._futures[job_id] = future
+        future.add_done_callback(lambda f: self._finish(job_id, f))
+        return job_id
+
+    def _finish(self, job_id, future):
+        """ジョブ完了時にPDFを保存して状態を更新"""
+        job_path = self._path(job_id)
+        try:
+            pdf_data = future.result()
+            atomic_write_bytes(self._path(job_id, '.pdf'), pdf_data)
+            status = read_pdf_job_status(job_path)
+            if status is not None:
+                pdf_cache.put(status['cache_key'], pdf_data)
+                update_pdf_job_status(job_path, status='done', pages_done=status['pages_total'])
+        except Exception as e:
+            print(f"PDF作成ジョブエラー: {e}")
+            try:
+                update_pdf_job_status(job_path, status='error')
+            except OSError:
+                pass
+        finally:
+            self._release(job_id)
+
+    def submit_batch(self, renders):
+        """複数のPDFをまとめてプールで作成し、Futureの一覧を返す（混雑している場合はNone）
+
+        renders は run_pdf_job に渡す (問題, データセット名, quiz_type, include_answers) の一覧。
+        1件ごとに受付枠を使い、空いている枠を超える場合は受け付けない。上限より大きいバッチは
+        他に作成中のPDFがない場合に限り受け付ける（完了するまで新しい依頼は受け付けない）。
+        """
+        with self._lock:
+            pending = len(self._futures)
+            if pending and pending + len(renders) > self.max_pending:
+                return None
+            executor = self._get_executor()
+            submitted = []
+            for render in renders:
+                render_id = uuid.uuid4().hex
+                future = executor.submit(run_pdf_job, None, *render)
+                self._futures[render_id] = future
+                submitted.append((render_id, future))
+        
+        for render_id, future in submitted:
+            future.add_done_callback(lambda f, render_id=render_id: self._release(render_id))
+        return [future for _, future in submitted]
+
+    def _release(self, job_id):
+        with self._lock:
+            self._futures.pop(job_id, None)
+
+    def get_status(self, job_id):
+        """ジョブの状態（存在しない場合はNone）"""
+        if not self._valid_id(job_id):
+            return None
+        return read_pdf_job_status(self._path(job_id))
+
+    def get_result(self, job_id):
+        """作成済みのPDF（ない場合はNone）"""
+        if not self._valid_id(job_id):
+            return None
+        try:
+            with open(self._path(job_id, '.pdf'), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _cleanup(self):
+        """保存期間を過ぎたジョブのファイルを削除"""
+        threshold = time.time() - PDF_JOB_TTL
+        directory = self.directory()
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                if os.path.getmtime(path) < threshold:
+                    os.remove(path)
+            except OSError:
+                continue
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+pdf_jobs = PdfJobQueue(PDF_JOB_WORKERS, PDF_JOB_MAX_PENDING)
+atexit.register(pdf_jobs.shutdown)
+
+class ZipStreamWriter:
+    """ZipFileの書き込み先（書き込まれた分を順に取り出してストリーミング送信する）"""
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def write(self, data):
+        self._buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        """ここまでに書き込まれたバイト列を取り出す"""
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+def attachment_header(download_name):
+    """日本語のファイル名にも対応した Content-Disposition ヘッダー"""
+    return f"attachment; filename*=UTF-8''{quote(download_name)}"
+
 @app.route('/generate_quiz/<filename>')
 def generate_quiz(filename):
     """テスト作成ページ"""
-    data = load_dataset(filename)
+    data = load_dataset(filename, readonly=True)
     dataset_name = filename[:-4]
     message, message_type = get_message_and_type(request)
     
@@ -1159,27 +4396,33 @@ def generate_quiz(filename):
                          dataset_name=dataset_name,
                          filename=filename,
                          total_items=len(data),
+                         max_variants=PDF_VARIANTS_MAX,
                          message=message,
                          message_type=message_type)
 
-@app.route('/create_quiz/<filename>', methods=['POST'])
-def create_quiz(filename):
-    """テスト作成・PDF生成"""
-    data = load_dataset(filename)
+def prepare_quiz(filename, form):
+    """出題条件を検証して問題を選択し、PDF作成の依頼内容を作る
+
+    戻り値は (依頼内容, エラーメッセージ)。入力が不正な場合、依頼内容はNone。
+    """
+    data = load_dataset(filename, readonly=True)
     
     if not data:
-        set_flash_message('データセットが空です。', 'error')
-        return redirect(url_for('generate_quiz', filename=filename))
+        return None, 'データセットが空です。'
     
     try:
-        num_questions = int(request.form.get('num_questions', 40))
-        quiz_type = request.form.get('quiz_type', 'question_to_answer')
-        selection_method = request.form.get('selection_method', 'random')
-        include_answers = request.form.get('include_answers', 'no')
+        num_questions = int(form.get('num_questions', 40))
+        quiz_type = form.get('quiz_type', 'question_to_answer')
+        selection_method = form.get('selection_method', 'random')
+        include_answers = form.get('include_answers', 'no')
+        
+        # 乱数シード（空欄の場合は新しく決め、ファイル名に残して同じ問題を再出題できるようにする）
+        seed_text = form.get('seed', '').strip()
+        seed = int(seed_text) if seed_text else random.randrange(1000000)
         
         # 範囲設定の取得
-        range_start = request.form.get('range_start')
-        range_end = request.form.get('range_end')
+        range_start = form.get('range_start')
+        range_end = form.get('range_end')
         
         # 範囲の設定（空欄の場合はデフォルト値）
         start_index = int(range_start) - 1 if range_start else 0  # 1-based to 0-based
@@ -1187,16 +4430,13 @@ def create_quiz(filename):
         
         # 範囲の妥当性チェック
         if start_index < 0 or start_index >= len(data):
-            set_flash_message('開始位置が無効です。', 'error')
-            return redirect(url_for('generate_quiz', filename=filename))
+            return None, '開始位置が無効です。'
         
         if end_index < 0 or end_index >= len(data):
-            set_flash_message('終了位置が無効です。', 'error')
-            return redirect(url_for('generate_quiz', filename=filename))
+            return None, '終了位置が無効です。'
         
         if start_index > end_index:
-            set_flash_message('開始位置は終了位置以下にしてください。', 'error')
-            return redirect(url_for('generate_quiz', filename=filename))
+            return None, '開始位置は終了位置以下にしてください。'
         
         # 指定範囲のデータを取得
         range_data = data[start_index:end_index + 1]
@@ -1205,37 +4445,252 @@ def create_quiz(filename):
         num_questions = min(max(1, num_questions), len(range_data))
         
         if num_questions < 1:
-            set_flash_message('問題数は1以上にしてください。', 'error')
-            return redirect(url_for('generate_quiz', filename=filename))
+            return None, '問題数は1以上にしてください。'
         
         # 問題の選択
         if selection_method == 'sequential':
             # 順番選択：範囲の最初から指定数を選択
             selected_items = range_data[:num_questions]
+            seed = None
+        elif selection_method == 'weighted':
+            # 重み付き選択：習熟度の低い問題ほど選ばれやすい（シードが同じでも習熟度が変われば変わる）
+            selected_items = get_dataset_store().sample_weighted_items(
+                filename, num_questions, start_index, end_index + 1, random.Random(seed))
         else:
-            # ランダム選択：範囲からランダムに選択
-            selected_items = random.sample(range_data, num_questions)
+            # ランダム選択：範囲からシードに応じてランダムに選択
+            selected_items = random.Random(seed).sample(range_data, num_questions)
             
     except ValueError as e:
-        set_flash_message('入力値が正しくありません。', 'error')
+        return None, '入力値が正しくありません。'
+    except Exception as e:
+        return None, '予期しないエラーが発生しました。'
+    
+    # 同じ内容のPDFはキャッシュから返す（使用フォントが変わった場合は作り直す）
+    # キーは選んだ問題の問題文・回答と出題順から作り、習熟度の更新やCSVの書き直しでは変えない。
+    # シードを指定しないランダム・重み付き選択は同じ内容を再び作ることがないためキャッシュしない
+    if seed is not None and not seed_text:
+        cache_key = None
+    else:
+        cache_key = pdf_cache.make_key(dataset=filename, content=compute_text_signature(selected_items),
+                                       quiz_type=quiz_type, include_answers=include_answers,
+                                       font=font_registry.get()['path'])
+    seed_suffix = f'_seed{seed}' if seed is not None else ''
+    
+    return {
+        'items': selected_items,
+        'filename': filename,
+        'dataset_name': filename[:-4],
+        'quiz_type': quiz_type,
+        'include_answers': include_answers,
+        'seed': seed,
+        'cache_key': cache_key,
+        'download_name': f'{filename[:-4]}_test{seed_suffix}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.pdf'
+    }, None
+
+def build_quiz_variants(quiz, num_variants):
+    """問題の順番を入れ替えたバージョンを作る
+
+    バージョン1は通常の出題と同じ順番（単独で作成したPDFとキャッシュを共有）、
+    2以降はシードとバージョン番号から決まる順番に並べ替える。
+    """
+    variants = []
+    for number in range(1, num_variants + 1):
+        items = list(quiz['items'])
+        if number > 1:
+            random.Random(f"{quiz['seed']}:{number}").shuffle(items)
+        variants.append({'number': number, 'items': items})
+    return variants
+
+def stream_quiz_variants(pdf_files, manifest):
+    """各バージョンの問題・解答PDFとマニフェストをZIPとして順に送信する
+
+    pdf_files は (ZIP内のファイル名, PDFのバイト列) の一覧（すべて作成済みのもの）。
+    """
+    writer = ZipStreamWriter()
+    # PDFは圧縮済みのため無圧縮で格納する
+    with zipfile.ZipFile(writer, 'w', zipfile.ZIP_STORED) as archive:
+        for name, pdf_data in pdf_files:
+            archive.writestr(name, pdf_data)
+            yield writer.take()
+        archive.writestr('manifest.json', json.dumps(manifest, ensure_ascii=False, indent=2))
+    yield writer.take()
+
+def create_quiz_variants(filename, quiz, num_variants):
+    """複数バージョンの問題と解答をZIPで返す（作成はプロセスプールで並列に行う）"""
+    variants = build_quiz_variants(quiz, num_variants)
+    dataset_name = quiz['dataset_name']
+    
+    def pdf_name(number, kind):
+        return f"{dataset_name}_v{number:02d}_{kind}.pdf"
+    
+    # キャッシュにないPDFだけをまとめて作成
+    planned = []
+    renders = []
+    for variant in variants:
+        for is_answer_key in (False, True):
+            include_answers = 'bottom' if is_answer_key else quiz['include_answers']
+            if variant['number'] == 1 and not is_answer_key or quiz['cache_key'] is None:
+                cache_key = quiz['cache_key']
+            else:
+                # 入れ替え後の出題順もキーに含める（選んだ問題が同じでもシードで順番が変わる）
+                cache_key = pdf_cache.make_key(base=quiz['cache_key'], answer_key=is_answer_key,
+                                               content=compute_text_signature(variant['items']))
+            name = pdf_name(variant['number'], '解答' if is_answer_key else '問題')
+            cached = pdf_cache.get(cache_key)
+            if cached is None:
+                renders.append((variant['items'], dataset_name, quiz['quiz_type'], include_answers))
+            planned.append((name, cache_key, cached))
+    
+    futures = pdf_jobs.submit_batch(renders) if renders else []
+    if futures is None:
+        set_flash_message('PDFの作成が混み合っています。しばらくしてから再度お試しください。', 'warning')
         return redirect(url_for('generate_quiz', filename=filename))
+    
+    # 応答を始める前にすべての作成結果を確認し、1つでも失敗した場合は途中までのZIPを返さない
+    pending = iter(futures)
+    pdf_files = []
+    try:
+        for name, cache_key, cached in planned:
+            if cached is None:
+                cached = next(pending).result()
+                pdf_cache.put(cache_key, cached)
+            pdf_files.append((name, cached))
     except Exception as e:
-        set_flash_message('予期しないエラーが発生しました。', 'error')
+        print(f"PDF作成エラー: {e}")
+        for future in futures:
+            future.cancel()
+        set_flash_message('PDFの作成に失敗しました。しばらくしてから再度お試しください。', 'error')
+        return generate_quiz(filename), 500
+    
+    manifest = {
+        'dataset': filename,
+        'seed': quiz['seed'],
+        'quiz_type': quiz['quiz_type'],
+        'include_answers': quiz['include_answers'],
+        'variants': [{
+            'variant': variant['number'],
+            'question_file': pdf_name(variant['number'], '問題'),
+            'answer_file': pdf_name(variant['number'], '解答'),
+            'items': [{'番号': item.get('番号', ''), 'ID': item.get('ID', '')} for item in variant['items']]
+        } for variant in variants]
+    }
+    
+    download_name = quiz['download_name'][:-4] + f'_{num_variants}versions.zip'
+    return Response(stream_quiz_variants(pdf_files, manifest),
+                    mimetype='application/zip',
+                    headers={'Content-Disposition': attachment_header(download_name)})
+
+@app.route('/create_quiz/<filename>', methods=['POST'])
+def create_quiz(filename):
+    """テスト作成・PDF生成（JavaScriptが使えない場合と複数バージョンの作成時の送信先）"""
+    quiz, error = prepare_quiz(filename, request.form)
+    if error:
+        set_flash_message(error, 'error')
         return redirect(url_for('generate_quiz', filename=filename))
     
-    # PDF生成
-    pdf_buffer = create_test_pdf(selected_items, filename[:-4], quiz_type, include_answers)
+    # バージョン数（2以上の場合は問題の順番を入れ替えた複数バージョンをZIPで返す）
+    try:
+        num_variants = int(request.form.get('variants') or 1)
+    except ValueError:
+        num_variants = 0
+    if not 1 <= num_variants <= PDF_VARIANTS_MAX:
+        set_flash_message(f'バージョン数は1〜{PDF_VARIANTS_MAX}で指定してください。', 'error')
+        return redirect(url_for('generate_quiz', filename=filename))
+    if num_variants > 1:
+        return create_quiz_variants(filename, quiz, num_variants)
+    
+    pdf_data = pdf_cache.get(quiz['cache_key'])
+    if pdf_data is None:
+        # PDF生成はプロセスプールのジョブとして登録し、完成を待たずに進捗ページへ移動（混雑時は受け付けない）
+        job_id = pdf_jobs.submit(quiz)
+        if job_id is None:
+            set_flash_message('PDFの作成が混み合っています。しばらくしてから再度お試しください。', 'warning')
+            return redirect(url_for('generate_quiz', filename=filename))
+        return redirect(url_for('pdf_job_page', job_id=job_id))
     
     # PDFをファイルとして返す
     return send_file(
-        pdf_buffer,
+        io.BytesIO(pdf_data),
+        as_attachment=True,
+        download_name=quiz['download_name'],
+        mimetype='application/pdf'
+    )
+
+@app.route('/api/pdf_jobs/<filename>', methods=['POST'])
+def api_submit_pdf_job(filename):
+    """PDF作成ジョブの登録API（混雑時は429）"""
+    quiz, error = prepare_quiz(filename, request.form)
+    if error:
+        return jsonify({'error': error}), 400
+    
+    job_id = pdf_jobs.submit(quiz)
+    if job_id is None:
+        return (jsonify({'error': 'PDFの作成が混み合っています。しばらくしてから再度お試しください。'}),
+                429, {'Retry-After': str(PDF_JOB_RETRY_AFTER)})
+    
+    return jsonify(pdf_job_to_json(pdf_jobs.get_status(job_id))), 202
+
+@app.route('/pdf_jobs/<job_id>')
+def pdf_job_page(job_id):
+    """PDF作成ジョブの進捗ページ（完成したらダウンロードを開始）"""
+    status = pdf_jobs.get_status(job_id)
+    if status is None:
+        set_flash_message('PDF作成ジョブが見つかりません。保存期限が切れた可能性があります。', 'error')
+        return redirect(url_for('index'))
+    return render_template('pdf_job.html', job=status, filename=status.get('filename'))
+
+@app.route('/api/pdf_jobs/<job_id>/status')
+def api_pdf_job_status(job_id):
+    """PDF作成ジョブの進捗API"""
+    status = pdf_jobs.get_status(job_id)
+    if status is None:
+        return jsonify({'error': 'ジョブが見つかりません'}), 404
+    return jsonify(pdf_job_to_json(status))
+
+@app.route('/api/pdf_jobs/<job_id>/download')
+def download_pdf_job(job_id):
+    """作成したPDFのダウンロード"""
+    status = pdf_jobs.get_status(job_id)
+    if status is None:
+        return jsonify({'error': 'ジョブが見つかりません'}), 404
+    if status['status'] != 'done':
+        return jsonify({'error': 'PDFはまだ作成されていません'}), 409
+    
+    pdf_data = pdf_jobs.get_result(job_id)
+    if pdf_data is None:
+        return jsonify({'error': 'PDFの保存期限が切れました。再度作成してください。'}), 410
+    
+    return send_file(
+        io.BytesIO(pdf_data),
         as_attachment=True,
-        download_name=f'{filename[:-4]}_test_{datetime.now().strftime("%Y%m%d_%H%M%S")}.pdf',
+        download_name=status['download_name'],
         mimetype='application/pdf'
     )
 
-def create_test_pdf(items, dataset_name, quiz_type, include_answers='no'):
-    """問題のPDFを作成（統一フォーマット：質問,回答）"""
+def pdf_job_to_json(status):
+    """ジョブの状態をAPIのレスポンス形式に変換"""
+    result = {
+        'job_id': status['job_id'],
+        'status': status['status'],
+        'pages_done': status['pages_done'],
+        'pages_total': status['pages_total'],
+        'status_url': url_for('api_pdf_job_status', job_id=status['job_id'])
+    }
+    if status['status'] == 'done':
+        result['download_url'] = url_for('download_pdf_job', job_id=status['job_id'])
+    return result
+
+def create_test_pdf(items, dataset_name, quiz_type, include_answers='no', on_page=None, renderer=None):
+    """問題のPDFを作成（統一フォーマット：質問,回答）
+
+    on_page を指定すると、各ページの作成開始時にページ番号を渡して呼び出す。
+    renderer は 'platypus'・'canvas'・'auto'（省略時は PDF_RENDERER）。'auto' の場合、
+    問題数が PDF_CANVAS_THRESHOLD 以上なら同じレイアウトを直接描画する canvas 版を使う。
+    """
+    renderer = renderer or PDF_RENDERER
+    if renderer == 'canvas' or (renderer == 'auto' and len(items) >= PDF_CANVAS_THRESHOLD):
+        return create_test_pdf_canvas(items, dataset_name, quiz_type, include_answers, on_page)
+    
     buffer = io.BytesIO()
     
     # フォント設定
@@ -1251,13 +4706,8 @@ def create_test_pdf(items, dataset_name, quiz_type, include_answers='no'):
     # 日本語文字をHTMLエンティティに変換する関数
     def escape_japanese(text):
         """日本語文字をHTMLエンティティに変換"""
-        result = ""
-        for char in text:
-            if ord(char) > 127:  # ASCII以外の文字
-                result += f"&#{ord(char)};"
-            else:
-                result += char
-        return result
+        # ASCII以外の文字を変換（文字列の連結を繰り返さないよう一度に結合）
+        return ''.join(f"&#{ord(char)};" if ord(char) > 127 else char for char in text)
     
     # 日本語対応のスタイル設定
     if font_available:
@@ -1304,7 +4754,7 @@ def create_test_pdf(items, dataset_name, quiz_type, include_answers='no'):
     
     # 全ての問題を処理（40問を超えた場合は複数ページ）
     total_items = len(items)
-    items_per_page = 40  # 1ページあたり最大40問（20行×2列）
+    items_per_page = PDF_ITEMS_PER_PAGE  # 1ページあたり最大40問（20行×2列）
     
     # ページごとに処理
     current_item_index = 0
@@ -1538,8 +4988,15 @@ def create_test_pdf(items, dataset_name, quiz_type, include_answers='no'):
         # 次のページの準備
         current_item_index += current_page_items
     
+    if on_page is not None:
+        def report_page(canvas, doc):
+            on_page(canvas.getPageNumber())
+        build_options = {'onFirstPage': report_page, 'onLaterPages': report_page}
+    else:
+        build_options = {}
+    
     try:
-        doc.build(story)
+        doc.build(story, **build_options)
     except Exception as e:
         print(f"PDF generation error: {e}")
         # フォールバック: 簡単な形式でPDFを作成
@@ -1572,13 +5029,229 @@ def create_test_pdf(items, dataset_name, quiz_type, include_answers='no'):
     buffer.seek(0)
     return buffer
 
+def get_quiz_texts(item, quiz_type):
+    """出題方向に応じた (問題文, 答え)（旧フォーマットの列名にも対応）"""
+    question = item.get('質問') or item.get('question') or ''
+    answer = item.get('回答') or item.get('answer') or ''
+    if quiz_type == 'answer_to_question':
+        return answer, question
+    return question, answer
+
+class CanvasTextMetrics:
+    """canvas描画用の文字幅キャッシュと折り返し"""
+
+    def __init__(self, font_name):
+        self.font_name = font_name
+        self._widths = {}
+
+    def width(self, text, size):
+        """文字列の幅（文字ごとの幅をキャッシュして合計）"""
+        widths = self._widths.setdefault(size, {})
+        total = 0
+        for char in text:
+            char_width = widths.get(char)
+            if char_width is None:
+                char_width = widths[char] = pdfmetrics.stringWidth(char, self.font_name, size)
+            total += char_width
+        return total
+
+    def wrap(self, text, size, max_width):
+        """幅に収まるように空白の位置で折り返した行の一覧（1行に収まらない語は文字単位で分割）"""
+        space_width = self.width(' ', size)
+        lines = []
+        line = ''
+        line_width = 0
+        for word in text.split():
+            word_width = self.width(word, size)
+            gap = space_width if line else 0
+            if line_width + gap + word_width <= max_width:
+                line = f'{line} {word}' if line else word
+                line_width += gap + word_width
+            elif word_width <= max_width:
+                lines.append(line)
+                line, line_width = word, word_width
+            else:
+                if line:
+                    line += ' '
+                    line_width += space_width
+                for char in word:
+                    char_width = self.width(char, size)
+                    if line.strip() and line_width + char_width > max_width:
+                        lines.append(line.rstrip())
+                        line, line_width = '', 0
+                    line += char
+                    line_width += char_width
+        lines.append(line)
+        return lines
+
+def create_test_pdf_canvas(items, dataset_name, quiz_type, include_answers='no', on_page=None):
+    """問題のPDFを canvas で直接描画して作成（create_test_pdf と同じレイアウト）
+
+    1ページ20行×2列の表は位置が固定のため、セルの座標を先に計算しておき、
+    段落や表のレイアウト計算をせずに描画する。問題数が多い場合に使う。
+    """
+    from reportlab.pdfgen import canvas as pdf_canvas
+    
+    buffer = io.BytesIO()
+    font_available = setup_fonts()
+    font_name = 'Japanese' if font_available else 'Helvetica'
+    bold_font_name = 'Japanese' if font_available else 'Helvetica-Bold'
+    metrics = CanvasTextMetrics(font_name)
+    red = colors.HexColor('#FF6666')
+    
+    # ページと表の座標（SimpleDocTemplate の余白10mmと枠の内側の余白6ptに合わせる）
+    page_width, page_height = A4
+    frame_left = 10*mm + 6
+    frame_width = page_width - 20*mm - 12
+    frame_top = page_height - 10*mm - 6
+    frame_bottom = 10*mm + 6
+    col_widths = [55*mm, 35*mm, 55*mm, 35*mm]
+    table_left = frame_left + (frame_width - sum(col_widths)) / 2
+    col_x = [table_left]
+    for width in col_widths:
+        col_x.append(col_x[-1] + width)
+    row_height = 8*mm
+    padding = 2
+    leading = 12
+    answer_col_width = 38*mm
+    answer_left = frame_left + (frame_width - answer_col_width * 5) / 2
+    
+    c = pdf_canvas.Canvas(buffer, pagesize=A4)
+    page_number = [1]
+    
+    def start_page():
+        if on_page is not None:
+            on_page(page_number[0])
+    
+    def new_page():
+        c.showPage()
+        page_number[0] += 1
+        start_page()
+    
+    def draw_title(text, y):
+        """タイトル（16pt・中央揃え）を描画し、次の要素の上端を返す"""
+        c.setFont(bold_font_name, 16)
+        c.setFillColor(colors.black)
+        c.drawString(frame_left + (frame_width - metrics.width(text, 16)) / 2, y - 16, text)
+        return y - 22 - 5 - 3*mm  # 行送り22pt + 段落後5pt + 余白3mm
+    
+    def draw_paragraph(lines, x, top, size, color):
+        """折り返し済みの行を上端 top から描画"""
+        c.setFont(font_name, size)
+        c.setFillColor(color)
+        baseline = top - size
+        for line in lines:
+            c.drawString(x, baseline, line)
+            baseline -= leading
+    
+    def draw_cell_text(text, x, row_bottom, width, size, color):
+        """表のセルに段落を上下中央揃えで描画"""
+        lines = metrics.wrap(text, size, width - padding * 2)
+        top = row_bottom + (row_height + len(lines) * leading) / 2
+        draw_paragraph(lines, x + padding, top, size, color)
+    
+    def draw_cell_string(text, x, row_bottom, size, font):
+        """表のセルに1行の文字列を上下中央揃えで描画"""
+        c.setFont(font, size)
+        c.setFillColor(colors.black)
+        c.drawString(x + padding, row_bottom + (row_height + leading) / 2 - size, text)
+    
+    def draw_table(rows, top):
+        """問題の表（見出し行＋問題行）を描画し、表の下端を返す"""
+        bottom = top - row_height * (len(rows) + 1)
+        
+        # 見出し行の背景と罫線
+        c.setFillColor(colors.lightgrey)
+        c.rect(col_x[0], top - row_height, col_x[-1] - col_x[0], row_height, stroke=0, fill=1)
+        c.setStrokeColor(colors.black)
+        c.setLineWidth(0.5)
+        c.setLineCap(1)
+        c.setLineJoin(1)
+        for row in range(len(rows) + 2):
+            c.line(col_x[0], top - row_height * row, col_x[-1], top - row_height * row)
+        for x in col_x:
+            c.line(x, top, x, bottom)
+        
+        for col, header in enumerate(['問題', '解答欄', '問題', '解答欄']):
+            draw_cell_string(header, col_x[col], top - row_height, 10, bold_font_name)
+        
+        for row, cells in enumerate(rows, 2):
+            row_bottom = top - row_height * row
+            for col, (kind, text) in enumerate(cells):
+                if kind == 'paragraph':
+                    draw_cell_text(text, col_x[col], row_bottom, col_widths[col], 10, colors.black)
+                elif kind == 'red':
+                    draw_cell_text(text, col_x[col], row_bottom, col_widths[col], 10, red)
+                elif text:
+                    draw_cell_string(text, col_x[col], row_bottom, 9, font_name)
+        return bottom
+    
+    def draw_answers(page_items, item_offset, y):
+        """ページ下部の回答一覧（1行5個、薄い赤字）を描画し、次の要素の上端を返す"""
+        y -= 5*mm + 12  # 余白5mm + 見出しの段落前12pt
+        if y - 18 < frame_bottom:
+            new_page()
+            y = frame_top
+        c.setFont(bold_font_name, 12)
+        c.setFillColor(colors.black)
+        c.drawString(frame_left, y - 12, '回答')
+        y -= 18 + 3
+        
+        for start in range(0, len(page_items), 5):
+            cells = []
+            for i, item in enumerate(page_items[start:start + 5], start):
+                _, answer_text = get_quiz_texts(item, quiz_type)
+                number = item.get('番号', item_offset + i + 1)
+                cells.append(metrics.wrap(f"{number}. {answer_text}", 8, answer_col_width - padding * 2))
+            height = max(len(lines) for lines in cells) * leading + padding * 2
+            if y - height < frame_bottom:
+                new_page()
+                y = frame_top
+            for col, lines in enumerate(cells):
+                draw_paragraph(lines, answer_left + answer_col_width * col + padding, y - padding, 8, red)
+            y -= height
+        return y
+    
+    start_page()
+    y = draw_title(f"{dataset_name} - 問題 ({len(items)}問)", frame_top)
+    
+    for item_offset in range(0, len(items), PDF_ITEMS_PER_PAGE):
+        page_items = items[item_offset:item_offset + PDF_ITEMS_PER_PAGE]
+        if item_offset > 0:
+            new_page()
+            y = draw_title(f"{dataset_name} - 問題 (ページ {item_offset // PDF_ITEMS_PER_PAGE + 1})", frame_top)
+        
+        # 行データ（左側20問、右側20問）。問題文が両方とも空の行は出力しない
+        rows = []
+        for i in range(20):
+            cells = []
+            for item, default_number in ((page_items[i] if i < len(page_items) else None, item_offset + i + 1),
+                                         (page_items[i + 20] if i + 20 < len(page_items) else None, item_offset + i + 26)):
+                question_text, answer_text = get_quiz_texts(item, quiz_type) if item else ('', '')
+                if not question_text:
+                    cells += [('string', ''), ('string', '')]
+                    continue
+                cells.append(('paragraph', f"{item.get('番号', default_number)}. {question_text}"))
+                if include_answers == 'red':
+                    cells.append(('red', answer_text))
+                else:
+                    cells.append(('string', '________________'))
+            if cells[0][1] or cells[2][1]:
+                rows.append(cells)
+        
+        y = draw_table(rows, y)
+        if include_answers == 'bottom':
+            y = draw_answers(page_items, item_offset, y)
+    
+    c.save()
+    buffer.seek(0)
+    return buffer
+
 @app.route('/delete_dataset/<filename>')
 def delete_dataset(filename):
     """データセット削除"""
-    filepath = os.path.join(DATASETS_DIR, filename)
     try:
-        if os.path.exists(filepath):
-            os.remove(filepath)
+        if get_dataset_store().delete(filename):
             set_flash_message('データセットを削除しました。', 'success')
             return redirect(url_for('index'))
         else:
@@ -1588,98 +5261,113 @@ def delete_dataset(filename):
         set_flash_message('データセットの削除に失敗しました。', 'error')
         return redirect(url_for('index'))
 
+def export_row(item):
+    """エクスポートする1行（拡張フォーマット：番号,質問,回答,正解数,総試行回数,習熟度スコア,ID）"""
+    return {
+        '番号': item.get('番号', ''),
+        '質問': item.get('質問', ''),
+        '回答': item.get('回答', ''),
+        '正解数': item.get('正解数', 0),
+        '総試行回数': item.get('総試行回数', 0),
+        '習熟度スコア': item.get('習熟度スコア', 0.0),
+        'ID': item.get('ID', '')
+    }
+
+def choose_export_encoding(data):
+    """エクスポートのエンコーディングを決める
+
+    日本語Excelで最も互換性が高いShift_JISを使い、Shift_JISで表せない文字がある場合は
+    BOM付きUTF-8（ExcelがUTF-8を正しく認識するため）にする。
+    """
+    for item in data:
+        try:
+            f"{item.get('番号', '')}{item.get('質問', '')}{item.get('回答', '')}{item.get('ID', '')}".encode('shift_jis')
+        except UnicodeEncodeError as encode_error:
+            print(f"Export: Shift_JIS encoding failed: {encode_error}")
+            print("Export: Using UTF-8 with BOM for Excel compatibility")
+            return 'utf-8-sig'
+    return 'shift_jis'
+
+def iter_dataset_csv(data, encoding):
+    """データセットをCSVとして EXPORT_CHUNK_ROWS 行ずつエンコードして返す（ヘッダー付き）"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=DATASET_FIELDNAMES)
+    writer.writeheader()
+    # BOMは先頭に1回だけ付ける
+    encoder = codecs.getincrementalencoder(encoding)()
+    
+    for start in range(0, len(data), EXPORT_CHUNK_ROWS):
+        for item in data[start:start + EXPORT_CHUNK_ROWS]:
+            writer.writerow(export_row(item))
+        yield encoder.encode(buffer.getvalue())
+        buffer.seek(0)
+        buffer.truncate()
+    
+    yield encoder.encode(buffer.getvalue(), final=True)
+
+def export_content_type(encoding):
+    return 'text/csv; charset=shift_jis' if encoding == 'shift_jis' else 'text/csv; charset=utf-8'
+
 @app.route('/export_dataset/<filename>')
 def export_dataset(filename):
-    """データセットをCSVでエクスポート（拡張フォーマット：番号,質問,回答,正解数,総試行回数,習熟度スコア）"""
-    filepath = os.path.join(DATASETS_DIR, filename)
-    if os.path.exists(filepath):
-        try:
-            # 現在のファイルを読み込み
-            data = load_dataset(filename)
-            
-            # 拡張フォーマット: 番号,質問,回答,正解数,総試行回数,習熟度スコア
-            fieldnames = ['番号', '質問', '回答', '正解数', '総試行回数', '習熟度スコア']
-            
-            if data:
-                # メモリ内でCSVを作成
-                import io
-                output = io.StringIO()
-                writer = csv.DictWriter(output, fieldnames=fieldnames)
-                writer.writeheader()
-                
-                # 各アイテムに習熟度データを含めて出力
-                for item in data:
-                    export_item = {
-                        '番号': item.get('番号', ''),
-                        '質問': item.get('質問', ''),
-                        '回答': item.get('回答', ''),
-                        '正解数': item.get('正解数', 0),
-                        '総試行回数': item.get('総試行回数', 0),
-                        '習熟度スコア': item.get('習熟度スコア', 0.0)
-                    }
-                    writer.writerow(export_item)
-                
-                csv_content = output.getvalue()
-                output.close()
-                
-                # Excel対応のエンコーディング処理
-                try:
-                    # まずShift_JISを試行（日本語Excelで最も互換性が高い）
-                    csv_bytes = csv_content.encode('shift_jis')
-                    mimetype = 'text/csv; charset=shift_jis'
-                except UnicodeEncodeError as encode_error:
-                    print(f"Export: Shift_JIS encoding failed: {encode_error}")
-                    print("Export: Using UTF-8 with BOM for Excel compatibility")
-                    # UTF-8 with BOM（ExcelがUTF-8を正しく認識するため）
-                    bom = '\ufeff'
-                    csv_content_with_bom = bom + csv_content
-                    csv_bytes = csv_content_with_bom.encode('utf-8')
-                    mimetype = 'text/csv; charset=utf-8'
-                
-                buffer = io.BytesIO(csv_bytes)
-                
-                # メモリから直接送信（一時ファイル不要）
-                return send_file(
-                    buffer,
-                    as_attachment=True,
-                    download_name=filename,
-                    mimetype=mimetype
-                )
-            else:
-                # 空のファイルの場合
-                import io
-                output = io.StringIO()
-                writer = csv.DictWriter(output, fieldnames=fieldnames)
-                writer.writeheader()
-                csv_content = output.getvalue()
-                output.close()
-                
-                # Excel対応のエンコーディング処理
-                try:
-                    csv_bytes = csv_content.encode('shift_jis')
-                    mimetype = 'text/csv; charset=shift_jis'
-                except UnicodeEncodeError:
-                    # UTF-8 with BOM（ExcelがUTF-8を正しく認識するため）
-                    bom = '\ufeff'
-                    csv_content_with_bom = bom + csv_content
-                    csv_bytes = csv_content_with_bom.encode('utf-8')
-                    mimetype = 'text/csv; charset=utf-8'
-                
-                buffer = io.BytesIO(csv_bytes)
-                
-                return send_file(
-                    buffer,
-                    as_attachment=True,
-                    download_name=filename,
-                    mimetype=mimetype
-                )
-        except Exception as e:
-            print(f"Export error: {e}")
-            set_flash_message('エクスポートに失敗しました。', 'error')
-            return redirect(url_for('index'))
-    else:
+    """データセットをCSVでエクスポート（拡張フォーマット：番号,質問,回答,正解数,総試行回数,習熟度スコア,ID）
+
+    CSV全体をメモリ上に作らず、エンコーディングを先に決めてから行ごとに送信する。
+    """
+    if not get_dataset_store().exists(filename):
         set_flash_message('データセットが見つかりません。', 'error')
         return redirect(url_for('index'))
+    
+    try:
+        # 現在のデータを読み込み（送信中に更新されても読み込んだ時点の内容を送る）
+        data = load_dataset(filename, readonly=True)
+        encoding = choose_export_encoding(data)
+    except Exception as e:
+        print(f"Export error: {e}")
+        set_flash_message('エクスポートに失敗しました。', 'error')
+        return redirect(url_for('index'))
+    
+    return Response(iter_dataset_csv(data, encoding),
+                    content_type=export_content_type(encoding),
+                    headers={'Content-Disposition': attachment_header(filename)})
+
+def stream_datasets_zip(filenames):
+    """データセットのCSVを1件ずつZIPに書き込みながら送信する"""
+    writer = ZipStreamWriter()
+    with zipfile.ZipFile(writer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for filename in filenames:
+            try:
+                data = load_dataset(filename, readonly=True)
+                encoding = choose_export_encoding(data)
+                with archive.open(filename, 'w') as entry:
+                    for chunk in iter_dataset_csv(data, encoding):
+                        entry.write(chunk)
+                        yield writer.take()
+            except Exception as e:
+                # 送信を始めた後はエラー画面を返せないため、ログに残して中断する
+                print(f"Bulk export error ({filename}): {e}")
+                raise
+    yield writer.take()
+
+@app.route('/export_datasets')
+def export_datasets():
+    """複数のデータセットをZIPでまとめてエクスポート（files を指定しない場合はすべて）"""
+    store = get_dataset_store()
+    filenames = request.args.getlist('files') or [dataset['filename'] for dataset in store.list_datasets()]
+    
+    if not filenames:
+        set_flash_message('エクスポートするデータセットがありません。', 'error')
+        return redirect(url_for('index'))
+    
+    for filename in filenames:
+        if os.path.basename(filename) != filename or not filename.endswith('.csv') or not store.exists(filename):
+            set_flash_message('データセットが見つかりません。', 'error')
+            return redirect(url_for('index'))
+    
+    download_name = f'datasets_{datetime.now().strftime("%Y%m%d_%H%M%S")}.zip'
+    return Response(stream_datasets_zip(filenames),
+                    mimetype='application/zip',
+                    headers={'Content-Disposition': attachment_header(download_name)})
 
 @app.route('/import_dataset')
 def import_dataset_page():
@@ -1687,6 +5375,32 @@ def import_dataset_page():
     message, message_type = get_message_and_type(request)
     return render_template('import_dataset.html', message=message, message_type=message_type)
 
+@app.route('/upload_datasets', methods=['POST'])
+def upload_datasets():
+    """複数のCSV・ZIPファイルの一括インポート（ファイルごとの結果を表示）"""
+    files = request.files.getlist('files')
+    if not any(file.filename for file in files):
+        set_flash_message('ファイルが選択されていません。', 'error')
+        return redirect(url_for('import_dataset_page'))
+    
+    results = import_dataset_files(files, bool(request.form.get('force_overwrite')))
+    return render_template('import_report.html', results=results,
+                           imported_count=sum(1 for result in results if result['success']))
+
+@app.route('/api/import_datasets', methods=['POST'])
+def api_import_datasets():
+    """複数のCSV・ZIPファイルの一括インポートAPI（ファイルごとの結果をJSONで返す）"""
+    files = request.files.getlist('files')
+    if not any(file.filename for file in files):
+        return jsonify({'success': False, 'error': 'ファイルが選択されていません。'}), 400
+    
+    results = import_dataset_files(files, bool(request.form.get('force_overwrite')))
+    return jsonify({
+        'success': all(result['success'] for result in results),
+        'imported_count': sum(1 for result in results if result['success']),
+        'results': results
+    })
+
 @app.route('/upload_dataset', methods=['POST'])
 def upload_dataset():
     """データセットファイルのアップロード処理（統一フォーマット：質問,回答）"""
@@ -1702,122 +5416,32 @@ def upload_dataset():
         set_flash_message('CSVファイルを選択してください。', 'error')
         return redirect(url_for('import_dataset_page'))
     
+    # ファイル名の重複チェック
+    base_name = file.filename[:-4]  # .csvを除去
+    filename = file.filename
+    force_overwrite = request.form.get('force_overwrite')
+    
+    if get_dataset_store().exists(filename) and not force_overwrite:
+        set_flash_message(f'データセット "{base_name}" は既に存在します。上書きする場合はチェックボックスを選択してください。', 'error')
+        return redirect(url_for('import_dataset_page'))
+    
     try:
-        # ファイル内容を読み込んで検証（エンコーディング自動判定）
-        content = None
-        encodings = ['shift_jis', 'utf-8', 'cp932']
-        
-        for encoding in encodings:
-            try:
-                content = file.read().decode(encoding)
-                print(f"File decoded successfully with {encoding}")
-                break
-            except UnicodeDecodeError:
-                file.seek(0)  # ファイルポインタを先頭に戻す
-                continue
-        
-        if content is None:
-            set_flash_message('ファイルの文字エンコーディングが認識できません。', 'error')
-            return redirect(url_for('import_dataset_page'))
-        
-        file.seek(0)  # ファイルポインタを先頭に戻す
-        
-        # CSV形式の検証（CSVのパースを実際に試行して検証）
-        try:
-            # StringIOを使ってCSVを実際にパースしてみる
-            from io import StringIO
-            csv_data = StringIO(content)
-            
-            # 最初の行を読んで区切り文字を判定
-            first_line = csv_data.readline()
-            csv_data.seek(0)  # ファイルポインタを先頭に戻す
-            
-            # タブかカンマで区切られているかを判定
-            delimiter = '\t' if '\t' in first_line and first_line.count('\t') > first_line.count(',') else ','
-            delimiter_name = 'TAB' if delimiter == '\t' else 'COMMA'
-            
-            reader = csv.DictReader(csv_data, delimiter=delimiter)
-            
-            # ヘッダーを取得
-            header_fields = reader.fieldnames
-            if not header_fields:
-                set_flash_message('ヘッダー行が見つかりません。', 'error')
-                return redirect(url_for('import_dataset_page'))
-            
-            # フィールド名を正規化（前後の空白を除去）
-            header_fields = [field.strip() for field in header_fields]
-            
-            # フォーマットの検証
-            has_number = '番号' in header_fields
-            has_question = '質問' in header_fields or 'question' in header_fields
-            has_answer = '回答' in header_fields or 'answer' in header_fields
-            has_proficiency = all(field in header_fields for field in ['正解数', '総試行回数', '習熟度スコア'])
-            
-            if not (has_question and has_answer):
-                set_flash_message('無効なCSV形式です。"質問"と"回答"（または"question"と"answer"）の列が必要です。', 'error')
-                return redirect(url_for('import_dataset_page'))
-            
-            # データ行の存在チェック
-            data_rows = list(reader)
-            if len(data_rows) == 0:
-                set_flash_message('データ行が見つかりません。ヘッダー行のみのファイルです。', 'error')
-                return redirect(url_for('import_dataset_page'))
-            
-            print(f"CSV validation successful: {len(data_rows)} data rows found")
-            print(f"Header fields: {header_fields}")
-            
-        except Exception as csv_error:
-            print(f"CSV parsing error: {csv_error}")
-            set_flash_message(f'CSVファイルの解析に失敗しました: {str(csv_error)}', 'error')
-            return redirect(url_for('import_dataset_page'))
+        # 先頭から少しずつデコード・検証しながら保存（ファイル全体をメモリに読み込まない）
+        row_count = import_csv_upload(filename, file.stream)
         
-        # ファイル名の重複チェック
-        base_name = file.filename[:-4]  # .csvを除去
-        filename = file.filename
-        force_overwrite = request.form.get('force_overwrite')
-        
-        if os.path.exists(os.path.join(DATASETS_DIR, filename)) and not force_overwrite:
-            set_flash_message(f'データセット "{base_name}" は既に存在します。上書きする場合はチェックボックスを選択してください。', 'error')
-            return redirect(url_for('import_dataset_page'))
-        
-        # ファイルを保存（エンコーディング処理を改善）
-        ensure_datasets_dir()
-        filepath = os.path.join(DATASETS_DIR, filename)
-        
-        # Shift_JISでエンコードできない文字を処理
-        try:
-            # まずShift_JISで保存を試行
-            with open(filepath, 'w', encoding='shift_jis', newline='') as f:
-                f.write(content)
-            print(f"File saved successfully with shift_jis encoding")
-        except UnicodeEncodeError as encode_error:
-            print(f"Shift_JIS encoding failed: {encode_error}")
-            print("Trying to save with UTF-8 encoding and convert problematic characters...")
-            
-            # Shift_JISでエンコードできない文字を置換
-            content_fixed = content.replace('～', '~')  # 全角チルダを半角チルダに
-            content_fixed = content_fixed.replace('　', ' ')  # 全角スペースを半角スペースに
-            content_fixed = content_fixed.replace('－', '-')  # 全角ハイフンを半角ハイフンに
-            content_fixed = content_fixed.replace('＋', '+')  # 全角プラスを半角プラスに
-            
-            try:
-                # 修正後の内容でShift_JIS保存を再試行
-                with open(filepath, 'w', encoding='shift_jis', newline='') as f:
-                    f.write(content_fixed)
-                print(f"File saved successfully with shift_jis encoding after character conversion")
-            except UnicodeEncodeError:
-                # それでも失敗する場合はUTF-8で保存
-                print("Still failed with shift_jis, saving with UTF-8 encoding")
-                with open(filepath, 'w', encoding='utf-8', newline='') as f:
-                    f.write(content)
-                print(f"File saved with UTF-8 encoding")
-        
-        # データ数をカウント
-        data = load_dataset(filename)
-        
-        set_flash_message(f'データセット "{filename[:-4]}" をインポートしました。({len(data)}件)', 'success')
+        set_flash_message(f'データセット "{filename[:-4]}" をインポートしました。({row_count}件)', 'success')
         return redirect(url_for('edit_dataset', filename=filename))
-        
+    
+    except UnicodeDecodeError:
+        set_flash_message('ファイルの文字エンコーディングが認識できません。', 'error')
+        return redirect(url_for('import_dataset_page'))
+    except CsvImportError as e:
+        set_flash_message(str(e), 'error')
+        return redirect(url_for('import_dataset_page'))
+    except csv.Error as csv_error:
+        print(f"CSV parsing error: {csv_error}")
+        set_flash_message(f'CSVファイルの解析に失敗しました: {str(csv_error)}', 'error')
+        return redirect(url_for('import_dataset_page'))
     except Exception as e:
         import traceback
         error_details = traceback.format_exc()
@@ -1832,6 +5456,10 @@ def cleanup_on_request():
     if random.random() < 0.1:  # 10%の確率でクリーンアップ実行
         cleanup_expired_messages()
 
+# PDF用フォントは起動時に1回だけ登録（PDF_FONT_PRELOAD=0 の場合は初回のPDF作成時）
+if os.environ.get('PDF_FONT_PRELOAD', '1') != '0':
+    font_registry.get()
+
 if __name__ == '__main__':
     ensure_datasets_dir()
     app.run(debug=True, host='0.0.0.0', port=5000)